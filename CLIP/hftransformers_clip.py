@@ -3,11 +3,14 @@ from concurrent.futures import ThreadPoolExecutor
 import torch
 from PIL import Image
 import yaml
+from Index.shared_image import SharedImage, open_image as open_shared_image
 
 # Load the configuration file
 with open("config.yaml", "r") as f:
     config = yaml.safe_load(f)
 checkpoint = config["clip"]["HF_transformers_clip"]
+# Decode JPEGs at reduced resolution, down to the model input size
+draft = config.get("decode", {}).get("draft", True)
 
 # load model and tokenizer
 model = CLIPModel.from_pretrained(checkpoint)
@@ -19,6 +22,8 @@ device = (
     else ("cuda" if torch.cuda.is_available() else "cpu")
 )
 model.to(device)
+# Shortest side images are resized to before cropping
+input_size = processor.image_processor.size.get("shortest_edge", 224)
 
 
 def open_image(image_path):
@@ -26,33 +31,54 @@ def open_image(image_path):
     Opens an image from the specified file path.
 
     Args:
-        image_path (str): The path to the image file.
+        image_path (str or PIL.Image.Image): The path to the image file, or an already decoded image.
 
     Returns:
         Image: An Image object representing the opened image.
     """
-    image = Image.open(image_path)
+    if isinstance(image_path, Image.Image):
+        return image_path
+    image = open_shared_image(image_path, input_size if draft else None)
     return image
 
 
+def preprocess_image(image_path):
+    """
+    Opens and preprocesses a single image.
+
+    For a SharedImage, the result is cached as its "clip" view.
+
+    Args:
+        image_path (str, PIL.Image.Image or SharedImage): The path to the image file, or an already decoded image.
+
+    Returns:
+        torch.Tensor: The preprocessed pixel values.
+    """
+    if isinstance(image_path, SharedImage):
+        return image_path.view("clip", preprocess_image)
+    image = open_image(image_path)
+    return processor(images=image, return_tensors="pt")["pixel_values"][0]
+
+
 def get_clip_image(image_paths):
     """
-    Computes the image embeddings for a batch of images and calculates the average pixel value of the first channel of each image.
+    Computes the image embeddings for a batch of images.
 
-    This function opens each image from the specified paths, preprocesses them for the model, and computes their embeddings. Additionally, it calculates the average pixel value of the first channel as a simple feature for each image.
+    This function opens each image from the specified paths, preprocesses them for the model, and computes their embeddings. SharedImages that already have a "clip" view are not preprocessed again.
 
     Args:
-        image_paths (list): List of image paths with length equal to batch_size
+        image_paths (list): List of image paths (or PIL images / SharedImages) with length equal to batch_size
 
     Returns:
         list: A list containing the image embeddings for each image in the batch.
     """
     with ThreadPoolExecutor() as executor:
-        images = list(executor.map(open_image, image_paths))
-    processed_image = processor(images=images, return_tensors="pt").to(device)
+        pixel_values = list(executor.map(preprocess_image, image_paths))
+    pixel_values = torch.stack(pixel_values).to(device)
     with torch.no_grad():
-        image_features = model.get_image_features(**processed_image)
-    return image_features.cpu().squeeze(0).numpy().tolist()
+        image_features = model.get_image_features(pixel_values=pixel_values)
+    # One list per image, also for a batch of one
+    return image_features.cpu().numpy().tolist()
 
 
 def get_clip_text(text):
@@ -1,13 +1,44 @@
 from PIL import Image
 from CLIP.MLX import clip
+import yaml
 import mlx.core as mx
 from mlx.core import linalg as LA
+from Index.shared_image import SharedImage, open_image
 
 
 # Getting text embeddings
 # 1. Load the model, tokenizer, and image processor
 model, tokenizer, img_processor = clip.load("CLIP/MLX/mlx_model")
 
+# Load the configuration file
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+# Decode JPEGs at reduced resolution, down to the model input size
+draft = config.get("decode", {}).get("draft", True)
+# Shortest side images are resized to before cropping
+input_size = img_processor.size
+
+
+def preprocess_image(image_path):
+    """
+    Opens and preprocesses a single image for the MLX CLIP model.
+
+    For a SharedImage, the result is cached as its "clip" view.
+
+    Args:
+        image_path (str, PIL.Image.Image or SharedImage): The path to the image file, or an already decoded image.
+
+    Returns:
+        mx.array: The preprocessed image.
+    """
+    if isinstance(image_path, SharedImage):
+        return image_path.view("clip", preprocess_image)
+    if isinstance(image_path, Image.Image):
+        image = image_path
+    else:
+        image = open_image(image_path, input_size if draft else None)
+    return img_processor._preprocess(image.convert("RGB"))
+
 
 def get_clip_image(image_paths):
     """
@@ -17,14 +48,14 @@ def get_clip_image(image_paths):
     and computes their embeddings using L2 normalization.
 
     Args:
-        image_paths (list): List of image paths with length equal to batch_size
+        image_paths (list): List of image paths (or PIL images / SharedImages) with length equal to batch_size
 
     Returns:
         list: A list containing the image embeddings for each image in the batch.
     """
-    images = [Image.open(path) for path in image_paths]
-    images = [img.convert("RGB") for img in images]
-    pixel_values = img_processor(images)
+    pixel_values = mx.concatenate(
+        [preprocess_image(path)[None] for path in image_paths], axis=0
+    )
     image_embeds_raw = model.get_image_features(pixel_values)
     image_embeds = image_embeds_raw / LA.norm(image_embeds_raw, axis=-1, keepdims=True)
     return image_embeds.tolist()
@@ -6,6 +6,7 @@ from PIL import Image
 import os
 import yaml
 import warnings
+from Index.shared_image import SharedImage, open_image
 
 try:
     import mobileclip
@@ -29,6 +30,8 @@ warnings.filterwarnings("ignore")
 with open("config.yaml", "r") as f:
     config = yaml.safe_load(f)
 checkpoint = config["clip"]["mobileclip_checkpoint"]
+# Decode JPEGs at reduced resolution, down to the model input size
+draft = config.get("decode", {}).get("draft", True)
 
 
 def download_mobile_clip(checkpoint):
@@ -78,30 +81,39 @@ device = (
 )
 
 model.to(device)
+# Input resolution of all MobileCLIP image encoders
+input_size = 256
 
 
 def preprocess_image(image_path):
     """
     Opens and preprocesses a single image.
 
+    For a SharedImage, the result is cached as its "clip" view.
+
     Args:
-        image_path (str): The path to the image file.
+        image_path (str, PIL.Image.Image or SharedImage): The path to the image file, or an already decoded image.
 
     Returns:
         torch.Tensor: The preprocessed image tensor.
     """
-    image = Image.open(image_path)
+    if isinstance(image_path, SharedImage):
+        return image_path.view("clip", preprocess_image)
+    if isinstance(image_path, Image.Image):
+        image = image_path
+    else:
+        image = open_image(image_path, input_size if draft else None)
     return preprocess(image.convert("RGB"))
 
 
 def get_clip_image(image_paths):
     """
-    Computes the image embeddings for a batch of images and calculates the average pixel value of the first channel of each image.
+    Computes the image embeddings for a batch of images.
 
-    This function opens each image from the specified paths, preprocesses them for the model, and computes their embeddings. Additionally, it calculates the average pixel value of the first channel as a simple feature for each image.
+    This function opens each image from the specified paths, preprocesses them for the model, and computes their embeddings. SharedImages that already have a "clip" view are not preprocessed again.
 
     Args:
-        image_paths (list): List of image paths with length equal to batch_size
+        image_paths (list): List of image paths (or PIL images / SharedImages) with length equal to batch_size
 
     Returns:
         list: A list containing the image embeddings for each image in the batch.
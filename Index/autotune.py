@@ -0,0 +1,277 @@
+import json
+import os
+import random
+import threading
+import time
+
+
+def is_out_of_memory(error):
+    """
+    Returns:
+        bool: Whether `error` is a failed allocation (host memory, or CUDA/MPS memory as reported by torch).
+    """
+    if isinstance(error, MemoryError):
+        return True
+    name = type(error).__name__
+    message = str(error).lower()
+    return name == "OutOfMemoryError" or (
+        isinstance(error, RuntimeError) and "out of memory" in message
+    )
+
+
+def free_device_memory():
+    """
+    Returns cached allocations of torch to the device after a failed allocation.
+    """
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    elif torch.backends.mps.is_available():
+        torch.mps.empty_cache()
+
+
+class AdaptiveBatch:
+    """
+    The batch size of one model stage, which halves itself when an allocation fails.
+
+    `map` runs the model on a list of inputs in chunks of `size`. If a chunk runs out of memory,
+    device caches are freed, the size is halved and the chunk is retried, so indexing slows down
+    instead of crashing. The smaller size is kept for the rest of the run.
+
+    Args:
+        name (str): The name of the stage, e.g. "clip".
+        size (int): The initial batch size.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(1, int(size))
+        self.lock = threading.Lock()
+
+    def map(self, fn, inputs):
+        """
+        Args:
+            fn (callable): Takes a list of inputs and returns a list with one result per input.
+            inputs (list): The inputs.
+
+        Returns:
+            list: The results of `fn` on all inputs, in order.
+
+        Raises:
+            Exception: The out of memory error, if even a single input does not fit.
+        """
+        results = []
+        i = 0
+        while i < len(inputs):
+            size = self.size
+            chunk = inputs[i : i + size]
+            try:
+                results += list(fn(chunk))
+            except Exception as e:
+                if not is_out_of_memory(e) or len(chunk) == 1:
+                    raise
+                free_device_memory()
+                with self.lock:
+                    self.size = min(self.size, max(1, len(chunk) // 2))
+                print(
+                    f"{self.name} ran out of memory on {len(chunk)} images, "
+                    f"batch size lowered to {self.size}"
+                )
+                continue
+            i += len(chunk)
+        return results
+
+
+class MemoryProbe:
+    """
+    Measures the peak memory used while a block runs, for batch size tuning.
+
+    On CUDA, torch's peak allocation counter is used. Otherwise the resident set size of the
+    process is sampled in a background thread (with psutil if installed, else from /proc);
+    where neither is available, `peak` stays None and memory is not measured. Host memory that
+    the allocator kept from an earlier block is reused without growing the resident set, so on
+    the host the peak is a lower bound.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = None
+        self.cuda = False
+        try:
+            import torch
+
+            self.cuda = torch.cuda.is_available()
+        except ImportError:
+            pass
+
+    @staticmethod
+    def rss():
+        """
+        Returns:
+            int: The resident set size of this process (bytes), or None if it cannot be read.
+        """
+        try:
+            import psutil
+
+            return psutil.Process().memory_info().rss
+        except ImportError:
+            pass
+        try:
+            with open("/proc/self/statm", "r") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def __enter__(self):
+        if self.cuda:
+            import torch
+
+            torch.cuda.synchronize()
+            self.baseline = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+            return self
+        self.baseline = self.rss()
+        self.sampled = self.baseline
+        self.stopped = threading.Event()
+        if self.baseline is not None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            rss = self.rss()
+            if rss is not None and rss > self.sampled:
+                self.sampled = rss
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            import torch
+
+            torch.cuda.synchronize()
+            self.peak = torch.cuda.max_memory_allocated() - self.baseline
+        elif self.baseline is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.peak = max(self.sampled, self.rss() or 0) - self.baseline
+        return False
+
+
+def measure(fn, inputs, size, repeats=2):
+    """
+    Times `fn` on `inputs` in chunks of `size`, after one warm-up chunk.
+
+    Returns:
+        tuple: (items per second, peak memory in bytes or None).
+    """
+    fn(inputs[:size])
+    with MemoryProbe() as probe:
+        start = time.perf_counter()
+        count = 0
+        for _ in range(repeats):
+            for i in range(0, len(inputs) - size + 1, size):
+                fn(inputs[i : i + size])
+                count += size
+        elapsed = time.perf_counter() - start
+    return count / elapsed if elapsed else 0.0, probe.peak
+
+
+def tune_batch_size(name, fn, inputs, candidates, memory_budget):
+    """
+    Picks the batch size with the highest throughput whose peak memory fits the budget.
+
+    Candidates are tried from smallest to largest. Tuning stops at the first one that runs out
+    of memory or exceeds `memory_budget`, or once throughput stops improving by more than 5%
+    (larger batches only cost memory from then on).
+
+    Args:
+        name (str): The name of the stage, for the report.
+        fn (callable): Runs the model on a list of inputs.
+        inputs (list): Sample inputs; candidates larger than the sample are skipped.
+        candidates (list): Batch sizes to try.
+        memory_budget (int): The peak memory (bytes) a batch may use.
+
+    Returns:
+        int: The best batch size, at least 1.
+    """
+    best, best_rate = 1, 0.0
+    for size in sorted(candidates):
+        if size > len(inputs):
+            break
+        try:
+            rate, peak = measure(fn, inputs, size)
+        except Exception as e:
+            if not is_out_of_memory(e):
+                raise
+            free_device_memory()
+            print(f"{name}: batch size {size} ran out of memory")
+            break
+        memory = f"{peak / 2**20:.0f} MB" if peak is not None else "unknown"
+        print(f"{name}: batch size {size}: {rate:.1f} images/s, peak memory {memory}")
+        if peak is not None and peak > memory_budget:
+            break
+        if rate <= best_rate * 1.05:
+            break
+        best, best_rate = size, rate
+    return best
+
+
+def device_name():
+    """
+    Returns:
+        str: Identifies the device models run on, so batch sizes tuned on one machine are not reused on another.
+    """
+    try:
+        import torch
+    except ImportError:
+        return f"cpu:{os.cpu_count()}"
+    if torch.cuda.is_available():
+        return f"cuda:{torch.cuda.get_device_name(0)}"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return f"cpu:{os.cpu_count()}"
+
+
+def sample_paths(paths, count, seed=0):
+    """
+    Picks `count` paths uniformly at random from an iterable of any length, in one pass (reservoir sampling).
+    """
+    rng = random.Random(seed)
+    sample = []
+    for i, path in enumerate(paths):
+        if i < count:
+            sample.append(path)
+        else:
+            j = rng.randint(0, i)
+            if j < count:
+                sample[j] = path
+    return sample
+
+
+def load_tuned(path, key):
+    """
+    Returns:
+        dict: The batch sizes tuned for `key` (see `save_tuned`), or None if there are none.
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def save_tuned(path, key, sizes):
+    """
+    Stores tuned batch sizes under `key`, which identifies the models, device and memory budget they were tuned for.
+    """
+    try:
+        with open(path, "r") as f:
+            tuned = json.load(f)
+    except (OSError, ValueError):
+        tuned = {}
+    tuned[key] = sizes
+    with open(path, "w") as f:
+        json.dump(tuned, f, indent=2)
@@ -0,0 +1,118 @@
+import threading
+import time
+
+from Index.create_db import (
+    clean_index,
+    config,
+    export_snapshots,
+    index_images,
+    journal_file,
+    open_ocr_backlog,
+    rebuild_hnsw,
+)
+from Index.journal import Journal
+from Index.progress import progress
+from Index.scan import scan_and_save
+
+# Indexing inside the server process (see `start_background_indexing`)
+background_config = config.get("background_indexing", {})
+
+
+def run_indexing(
+    image_collection,
+    text_collection,
+    journal=None,
+    full_scan=False,
+    watch_changes=False,
+    duty_cycle=1.0,
+):
+    """
+    Brings the index up to date: scans, indexes new and changed images, then cleans up.
+
+    An interrupted run resumes from its journal, with the scan it was planned from, so the scan
+    is skipped. The collections are then exported to the snapshots the server starts from (see
+    `Index.create_db.export_snapshots`), and rebuilt if their HNSW parameters changed in
+    `config.yaml` (see `Index.create_db.rebuild_hnsw`). With deferred OCR, the OCR phase (see `Index.deferred_ocr.run_ocr`) then works
+    through its backlog. With `watch_changes`, the index is then kept up to date with file
+    changes until interrupted (see `Index.watch.watch`), while the OCR phase runs alongside.
+
+    Args:
+        image_collection (Collection): The image collection in the database.
+        text_collection (Collection): The text collection in the database.
+        journal (Journal, optional): The journal to record progress in. Defaults to the one at `journal_file`.
+        full_scan (bool, optional): If True, list every directory again (see `scan_and_save`). Defaults to False.
+        watch_changes (bool, optional): If True, keep watching for changes afterwards. Defaults to False.
+        duty_cycle (float, optional): The fraction of time pipeline workers may work (see `Index.pipeline.Pipeline`). Defaults to 1.
+
+    Raises:
+        Exception: If scanning failed.
+    """
+    if journal is None:
+        journal = Journal(journal_file)
+    if journal.unfinished_run() is None:
+        if not scan_and_save(full_scan):
+            raise Exception("Error scanning images")
+    backlog = open_ocr_backlog()
+    start = time.time()
+    index_images(
+        image_collection,
+        text_collection,
+        journal,
+        duty_cycle=duty_cycle,
+        backlog=backlog,
+    )
+    clean_index(image_collection, text_collection)
+    end = time.time()
+    print(f"Indexing took {end - start} seconds")
+    progress.start("exporting")
+    export_snapshots([image_collection, text_collection])
+    # Apply changed HNSW parameters (see `Index.create_db.rebuild_hnsw`)
+    image_collection = rebuild_hnsw(image_collection)
+    text_collection = rebuild_hnsw(text_collection)
+    progress.start("idle")
+    if backlog is not None:
+        from Index.deferred_ocr import run_ocr, start_background_ocr
+
+        if not watch_changes:
+            run_ocr(text_collection, backlog)
+            return
+        start_background_ocr(text_collection, backlog)
+    if watch_changes:
+        from Index.watch import watch
+
+        watch(image_collection, text_collection, journal, duty_cycle=duty_cycle)
+
+
+def start_background_indexing(image_collection, text_collection, full_scan=False):
+    """
+    Runs `run_indexing` in a background thread, throttled to the `duty_cycle` of the
+    `background_indexing` section of `config.yaml`.
+
+    The server and the indexer share the collections of this process, so every batch the
+    indexer writes is searchable right away. Errors are reported through `progress`.
+
+    Args:
+        image_collection (Collection): The image collection in the database.
+        text_collection (Collection): The text collection in the database.
+        full_scan (bool, optional): If True, list every directory again (see `scan_and_save`). Defaults to False.
+
+    Returns:
+        threading.Thread: The started (daemon) thread.
+    """
+
+    def run():
+        try:
+            run_indexing(
+                image_collection,
+                text_collection,
+                full_scan=full_scan,
+                watch_changes=background_config.get("watch", True),
+                duty_cycle=background_config.get("duty_cycle", 0.5),
+            )
+        except Exception as e:
+            print(f"Background indexing failed: {e}")
+            progress.fail(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
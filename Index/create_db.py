@@ -1,9 +1,32 @@
 import chromadb
 from tqdm import tqdm
+import contextlib
+import hashlib
 import os
-import sys
+import json
+import threading
+import time
 import yaml
-from Index.scan import read_from_csv
+from Index.scan import manifest_file
+from Index.manifest import Manifest
+from Index.shared_image import SharedImage
+from Index.pipeline import Pipeline, Stage
+from Index.journal import Journal
+from Index.autotune import (
+    AdaptiveBatch,
+    device_name,
+    load_tuned,
+    save_tuned,
+    tune_batch_size,
+)
+from Index.ocr_backlog import OCRBacklog
+from Index.prescreen import TextPrescreen
+from Index.progress import progress
+from search.flat import SyncedCollection
+from search.hnsw import collection_params, defaults, hnsw_metadata, sample_vectors, tune
+from search.ivfpq import IVFPQIndex, build_for_snapshot, index_path
+from search.snapshot import Snapshot, export_snapshot
+from settings.config_manager import save_config
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -13,27 +36,98 @@ with open("config.yaml", "r") as f:
     config = yaml.safe_load(f)
 
 deep_scan = config["deep_scan"]
+# Copy the embeddings of byte-identical files instead of recomputing them
+deduplicate = config.get("deduplicate", True)
 batch_size = config["batch_size"]
+# Number of entries fetched per request when reading a whole collection
+page_size = config.get("page_size", 10000)
+# Delete throughput of the last cleanup, used to estimate dry runs
+clean_stats_file = "Index/clean_stats.json"
+# Progress of the current indexing run, used to resume it after a crash
+journal_file = "Index/journal.db"
+# Items in flight this many times when the indexer died are quarantined (see `index_images`)
+max_attempts = config.get("max_attempts", 2)
+# Missing files stay in the index (hidden from search) this long before being purged
+tombstone_grace = config.get("tombstone_grace_days", 7) * 86400
+# Worker counts and queue size of the indexing pipeline stages
+pipeline_config = config.get("pipeline", {})
+# Measure the best CLIP and OCR batch sizes on this machine (see `autotune_batch_sizes`)
+autotune_config = config.get("autotune", {})
+autotune_file = "Index/autotune.json"
+# Decode JPEGs at reduced resolution (draft mode), down to what CLIP and OCR need
+decode_config = config.get("decode", {})
+# Run OCR in a separate, lower priority phase after CLIP (see `Index.deferred_ocr`)
+ocr_config = config.get("ocr", {})
+deferred_ocr = ocr_config.get("deferred", True)
+# Images waiting for the OCR phase
+ocr_backlog_file = "Index/ocr_backlog.db"
+# Skip OCR on images whose CLIP embedding does not look like text (see `Index.prescreen`)
+prescreen_config = ocr_config.get("prescreen", {})
+ocr_threshold = (
+    prescreen_config.get("threshold", 0.3)
+    if prescreen_config.get("enabled", True)
+    else None
+)
+prescreen_prompts_file = "Index/prescreen_prompts.json"
+# Snapshots of the collections, which the server maps into memory at startup (see `search.snapshot`)
+search_config = config.get("search", {})
+snapshot_files = {"images": "db/images.snapshot", "texts": "db/texts.snapshot"}
+# Approximate search for collections too large to scan (see `search.ivfpq`)
+ivfpq_config = search_config.get("ivfpq", {})
+# HNSW parameters of each collection, and the targets `tune_hnsw` picks them for
+hnsw_config = search_config.get("hnsw", {})
 
 if config["clip"]["provider"] == "HF_transformers":
-    from CLIP.hftransformers_clip import get_clip_image, get_clip_text
+    from CLIP.hftransformers_clip import (
+        get_clip_image,
+        get_clip_text,
+        input_size as clip_input_size,
+        preprocess_image as preprocess_clip_image,
+    )
 elif config["clip"]["provider"] == "mobileclip":
-    from CLIP.mobile_clip import get_clip_image, get_clip_text
+    from CLIP.mobile_clip import (
+        get_clip_image,
+        get_clip_text,
+        input_size as clip_input_size,
+        preprocess_image as preprocess_clip_image,
+    )
 elif config["clip"]["provider"] == "MLX":
-    from CLIP.mlx_clip import get_clip_image, get_clip_text
+    from CLIP.mlx_clip import (
+        get_clip_image,
+        get_clip_text,
+        input_size as clip_input_size,
+        preprocess_image as preprocess_clip_image,
+    )
 
 if config["text_embed"]["provider"] == "HF_transformers":
-    from text_embeddings.hftransformers_embeddings import get_text_embeddings
+    from text_embeddings.hftransformers_embeddings import get_text_embeddings_batch
 elif config["text_embed"]["provider"] == "ollama":
-    from text_embeddings.ollama_embeddings import get_text_embeddings
+    from text_embeddings.ollama_embeddings import get_text_embeddings_batch
 elif config["text_embed"]["provider"] == "llama_cpp":
-    from text_embeddings.llamacpp_embeddings import get_text_embeddings
+    from text_embeddings.llamacpp_embeddings import get_text_embeddings_batch
 elif config["text_embed"]["provider"] == "openai_api":
-    from text_embeddings.openai_api import get_text_embeddings
+    from text_embeddings.openai_api import get_text_embeddings_batch
 elif config["text_embed"]["provider"] == "MLX":
-    from text_embeddings.mlx_embeddings import get_text_embeddings
+    from text_embeddings.mlx_embeddings import get_text_embeddings_batch
+
+from ocr_model.OCR import apply_OCR, process_image as preprocess_ocr_image
 
-from ocr_model.OCR import apply_OCR
+draft = decode_config.get("draft", True)
+clip_decode_size = clip_input_size if draft else None
+ocr_decode_size = decode_config.get("ocr_size", 1024) if draft else None
+decode_size = max(clip_input_size, ocr_decode_size) if draft else None
+
+# Batch sizes of the model stages, lowered when they run out of memory
+clip_batch = AdaptiveBatch("clip", batch_size)
+ocr_batch = AdaptiveBatch("ocr", batch_size)
+
+text_prescreen = TextPrescreen(
+    get_clip_text,
+    json.dumps(config["clip"], sort_keys=True),
+    prescreen_prompts_file,
+    prescreen_config.get("text_prompts"),
+    prescreen_config.get("other_prompts"),
+)
 
 
 def create_vectordb(path):
@@ -42,7 +136,8 @@ def create_vectordb(path):
 
     This function initializes a PersistentClient with the given path, and then
     gets or creates two collections: 'images' and 'texts'. Both collections
-    use cosine similarity for nearest neighbor search.
+    use cosine similarity for nearest neighbor search, and new ones are created
+    with the HNSW parameters of `hnsw_params`.
 
     Args:
         path (str): The path to the VectorDB database.
@@ -55,106 +150,1124 @@ def create_vectordb(path):
     client = chromadb.PersistentClient(
         path,
     )
-    image_collection = client.get_or_create_collection(
-        "images", metadata={"hnsw:space": "cosine"}
+    image_collection = open_collection(client, "images")
+    text_collection = open_collection(client, "texts")
+    return image_collection, text_collection
+
+
+def open_collection(client, name):
+    """
+    Gets or creates a collection. Unlike `get_or_create_collection`, the metadata of an existing
+    collection is left alone, as it records the HNSW parameters the collection was created with.
+
+    Returns:
+        Collection: The collection.
+    """
+    try:
+        collection = client.get_collection(name)
+    except (ValueError, chromadb.errors.ChromaError):
+        try:
+            # A rebuild interrupted between deleting the old collection and renaming the new one
+            collection = client.get_collection(f"{name}_rebuild")
+            collection.modify(name=name)
+        except (ValueError, chromadb.errors.ChromaError):
+            collection = client.create_collection(
+                name, metadata=hnsw_metadata(hnsw_params(name))
+            )
+    if collection_params(collection) != hnsw_params(name):
+        print(
+            f"{name}: HNSW parameters {collection_params(collection)} differ from "
+            f"config.yaml {hnsw_params(name)}, the collection is rebuilt by the next indexing run"
+        )
+    return collection
+
+
+def hnsw_params(name):
+    """
+    Returns:
+        dict: The HNSW parameters ("M", "construction_ef", "search_ef") of the collection `name`
+        in the `hnsw` section of `search` in `config.yaml`, ChromaDB's defaults for those missing.
+    """
+    return {**defaults, **hnsw_config.get(name, {})}
+
+
+def rebuild_hnsw(collection, path="db"):
+    """
+    Rebuilds a collection whose HNSW parameters differ from `hnsw_params`, as ChromaDB only sets
+    them when a collection is created.
+
+    The entries are copied page by page to a new collection, while the old one keeps serving
+    searches. The entries written meanwhile are copied again, and those deleted meanwhile
+    removed; then the old collection is deleted and the new one takes its name. A
+    `search.flat.SyncedCollection` records the writes made through it and swaps in the new
+    collection under its write lock, so the server and indexer sharing it carry on with it. A
+    plain collection must not be written to during the rebuild, and its object is stale after.
+
+    Args:
+        collection (Collection): The collection, plain or a `SyncedCollection`.
+        path (str, optional): The path to the VectorDB database.
+
+    Returns:
+        Collection: The rebuilt collection (`collection` itself if it is a `SyncedCollection`
+        or already has the configured parameters).
+    """
+    name = collection.name
+    params = hnsw_params(name)
+    if collection_params(collection) == params:
+        return collection
+    client = chromadb.PersistentClient(path)
+    temporary = f"{name}_rebuild"
+    try:
+        client.delete_collection(temporary)
+    except (ValueError, chromadb.errors.ChromaError):
+        pass
+    rebuilt = client.create_collection(temporary, metadata=hnsw_metadata(params))
+    synced = isinstance(collection, SyncedCollection)
+    if synced:
+        collection.track_writes()
+    count = collection.count()
+    print(f"{name}: rebuilding {count} entries with HNSW parameters {params}")
+    progress.start("rebuilding", count)
+    start = time.time()
+    offset = 0
+    # ChromaDB does not order reads against writes of other threads
+    lock = collection.write_lock if synced else contextlib.nullcontext()
+    with tqdm(total=count, desc=f"Rebuilding {name}") as pbar:
+        while True:
+            with lock:
+                page = collection.get(
+                    include=["embeddings", "metadatas"], limit=page_size, offset=offset
+                )
+            if page["ids"]:
+                rebuilt.add(
+                    ids=page["ids"],
+                    embeddings=page["embeddings"],
+                    metadatas=page["metadatas"],
+                )
+            offset += len(page["ids"])
+            progress.advance(len(page["ids"]))
+            pbar.update(len(page["ids"]))
+            if len(page["ids"]) < page_size:
+                break
+
+    def catch_up(written):
+        # Deletes shift the later pages, so entries may also have been skipped
+        ids = set(fetch_index_metadata(collection))
+        copied = set(fetch_index_metadata(rebuilt))
+        if copied - ids:
+            delete_ids(rebuilt, list(copied - ids), desc=f"Catching up {name}")
+        changed = list((ids - copied) | (ids & written))
+        for i in range(0, len(changed), page_size):
+            page = collection.get(
+                ids=changed[i : i + page_size], include=["embeddings", "metadatas"]
+            )
+            rebuilt.upsert(
+                ids=page["ids"],
+                embeddings=page["embeddings"],
+                metadatas=page["metadatas"],
+            )
+
+    if synced:
+        collection.replace(rebuilt, catch_up)
+    else:
+        catch_up(set())
+    client.delete_collection(name)
+    rebuilt.modify(name=name)
+    print(f"{name}: rebuilt in {time.time() - start:.1f} seconds")
+    return collection if synced else rebuilt
+
+
+def tune_hnsw(collection):
+    """
+    Picks the cheapest HNSW parameters of a collection that reach the targets of the `tune`
+    section of `hnsw` in `config.yaml` (see `search.hnsw.tune`), and saves them to `config.yaml`.
+
+    Query vectors are held out of a sample of up to `max_vectors` entries of the collection, and
+    their exact nearest neighbors among the rest are the ground truth. The collection itself is
+    rebuilt with the new parameters by the next indexing run (see `rebuild_hnsw`).
+
+    Args:
+        collection (Collection): The collection.
+
+    Returns:
+        dict: The parameters, or None if the collection is too small to tune, no candidate
+        reaches the targets, or hnswlib is not installed.
+    """
+    tune_config = hnsw_config.get("tune", {})
+    queries = tune_config.get("queries", 200)
+    if collection.count() < 2 * queries:
+        print(f"{collection.name}: too few entries to tune HNSW parameters")
+        return None
+    print(f"{collection.name}: sampling embeddings")
+    vectors = sample_vectors(
+        collection, tune_config.get("max_vectors", 500000), page_size
     )
-    text_collection = client.get_or_create_collection(
-        "texts", metadata={"hnsw:space": "cosine"}
+    try:
+        params, _ = tune(
+            vectors,
+            tune_config.get("k", 50),
+            queries,
+            tune_config.get("recall", 0.95),
+            tune_config.get("p95_ms", 50),
+            tune_config.get("M", [8, 16, 32, 48]),
+            tune_config.get("construction_ef", [64, 128, 256]),
+            tune_config.get("search_ef", [16, 32, 64, 128, 256, 512]),
+        )
+    except ImportError:
+        print("Tuning HNSW parameters needs hnswlib (pip install chroma-hnswlib)")
+        return None
+    if params is None:
+        print(
+            f"{collection.name}: no HNSW parameters reach the targets, keeping "
+            f"{hnsw_params(collection.name)}"
+        )
+        return None
+    print(f"{collection.name}: tuned HNSW parameters {params}")
+    hnsw_config[collection.name] = params
+    config.setdefault("search", search_config)["hnsw"] = hnsw_config
+    save_config(config, "config.yaml")
+    return params
+
+
+def snapshot_tag(name):
+    """
+    Returns:
+        str: Identifies the model that embeds the collection `name`, so a snapshot is not used after switching models.
+    """
+    section = config["clip"] if name == "images" else config["text_embed"]
+    return hashlib.sha1(json.dumps(section, sort_keys=True).encode()).hexdigest()
+
+
+def export_snapshots(collections, force=False):
+    """
+    Exports collections to their snapshot files (see `search.snapshot.export_snapshot`), which the
+    server maps into memory at startup instead of loading the collections.
+
+    Collections are exported in order, and once one has changed, the ones after it are exported
+    too: the text of an image changes with the image, without any change in its own metadata.
+    With `quantization: ivfpq`, the IVF-PQ index of each snapshot is built too (see
+    `build_ivfpq`). Nothing is exported if the server does not use snapshots (`flat` or `snapshot` is off in the
+    `search` section of `config.yaml`).
+
+    Args:
+        collections (list): The collections, images before texts.
+        force (bool, optional): If True, export even the collections that look up to date. Defaults to False.
+    """
+    if not (search_config.get("flat", True) and search_config.get("snapshot", True)):
+        return
+    for collection in collections:
+        path = snapshot_files[collection.name]
+        start = time.time()
+        try:
+            count = export_snapshot(
+                collection, path, snapshot_tag(collection.name), page_size, force
+            )
+        except OSError as e:
+            print(f"Error exporting {collection.name} to {path}: {e}")
+            continue
+        if count is not None:
+            force = True
+            print(
+                f"Exported {count} {collection.name} to {path} in {time.time() - start:.1f} seconds"
+            )
+        if search_config.get("quantization") == "ivfpq":
+            build_ivfpq(path)
+
+
+def build_ivfpq(path):
+    """
+    Builds the IVF-PQ index of a snapshot file (see `search.ivfpq.build_for_snapshot`) with the
+    `ivfpq` settings of the `search` section of `config.yaml`, unless it is up to date.
+    """
+    snapshot = Snapshot(path)
+    try:
+        try:
+            if IVFPQIndex.load(index_path(path)).version == snapshot.version:
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        start = time.time()
+        index = build_for_snapshot(
+            snapshot,
+            index_path(path),
+            ivfpq_config.get("nlist"),
+            ivfpq_config.get("m", 64),
+            ivfpq_config.get("train_per_list", 40),
+            ivfpq_config.get("retrain_growth", 2.0),
+        )
+    except (OSError, ValueError) as e:
+        print(f"Error building the IVF-PQ index of {path}: {e}")
+        return
+    finally:
+        # Unmapped, so the file can be removed once a newer snapshot is written
+        snapshot.close()
+    print(
+        f"Built the IVF-PQ index of {path} ({index.nlist} lists, trained on "
+        f"{index.trained_on} vectors) in {time.time() - start:.1f} seconds"
     )
-    return image_collection, text_collection
 
 
-def index_images(image_collection, text_collection):
+def autotune_batch_sizes(paths, force=False):
+    """
+    Sets the CLIP and OCR batch sizes to the fastest ones that fit the memory budget on this machine.
+
+    With `enabled` in the `autotune` section of `config.yaml`, each stage is timed on a sample of
+    `paths` for every candidate batch size, and its peak memory compared to `memory_budget_mb`
+    (see `Index.autotune.tune_batch_size`). The sizes are stored in `autotune_file` for the
+    models, device and budget they were tuned for, and reused by later runs. Otherwise, or with
+    fewer than `min_images` paths, `batch_size` is used for every stage.
+
+    Args:
+        paths (list): Images to sample from, e.g. those about to be indexed.
+        force (bool, optional): If True, tune again even if sizes are stored. Defaults to False.
+
+    Returns:
+        dict: The batch size of each stage ("clip", "ocr").
+    """
+    if not (autotune_config.get("enabled", False) or force):
+        return {"clip": clip_batch.size, "ocr": ocr_batch.size}
+    memory_budget = autotune_config.get("memory_budget_mb", 2048) * 2**20
+    key = json.dumps(
+        {
+            "clip": config["clip"],
+            "device": device_name(),
+            "memory_budget": memory_budget,
+        },
+        sort_keys=True,
+    )
+    sizes = None if force else load_tuned(autotune_file, key)
+    sample_size = autotune_config.get("sample_size", 64)
+    if sizes is None and (
+        force or len(paths) >= autotune_config.get("min_images", 500)
+    ):
+        print(f"Tuning batch sizes on {min(sample_size, len(paths))} images")
+        images = []
+        for path in paths[:sample_size]:
+            try:
+                image = SharedImage(path, decode_size).read()
+                preprocess_clip_image(image)
+                preprocess_ocr_image(image)
+            except Exception:
+                continue
+            image.release()
+            images.append(image)
+        if not images:
+            return {"clip": clip_batch.size, "ocr": ocr_batch.size}
+        candidates = autotune_config.get("candidates", [1, 2, 4, 8, 16, 32, 64])
+        sizes = {
+            "clip": tune_batch_size(
+                "clip", get_clip_image, images, candidates, memory_budget
+            ),
+            "ocr": tune_batch_size("ocr", apply_OCR, images, candidates, memory_budget),
+        }
+        save_tuned(autotune_file, key, sizes)
+        print(f"Tuned batch sizes: {sizes}")
+    if sizes is not None:
+        clip_batch.size = sizes["clip"]
+        ocr_batch.size = sizes["ocr"]
+    return {"clip": clip_batch.size, "ocr": ocr_batch.size}
+
+
+def fetch_index_metadata(collection, page_size=page_size):
+    """
+    Fetch the IDs and metadata of every entry in a collection using paged bulk reads.
+
+    Embeddings are not requested, so each page only carries IDs and metadata. This
+    replaces one `collection.get(ids=[path])` round-trip per path with
+    `len(collection) / page_size` round-trips.
+
+    Args:
+        collection (Collection): The collection to read.
+        page_size (int, optional): The number of entries fetched per request.
+
+    Returns:
+        dict: A mapping of entry ID to its metadata dict (empty if the entry has none).
+    """
+    existing = {}
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        ids = page["ids"]
+        for id, metadata in zip(ids, page["metadatas"]):
+            existing[id] = metadata or {}
+        offset += len(ids)
+        if len(ids) < page_size:
+            break
+    return existing
+
+
+def plan_index(scanned, existing, quarantined=None):
+    """
+    Work out what has to be embedded before any model runs.
+
+    Compares the scanned paths against the entries already in the index in a single
+    streaming pass using hash lookups. With `deep_scan`, an indexed path whose stored
+    fingerprint differs from the scanned one is re-embedded; entries indexed before
+    fingerprints were stored only get their fingerprint recorded. Tombstoned entries
+    (see `clean_index`) whose file reappeared are reactivated without re-embedding.
+    Quarantined files (see `Index.journal.Journal.quarantine`) are skipped until their
+    fingerprint changes.
+
+    Args:
+        scanned (iterable): (path, fingerprint) of each scanned image (see `Index.manifest.Manifest.scanned`).
+            Paths are used as IDs in the collections.
+        existing (dict): The indexed entries as returned by `fetch_index_metadata`.
+        quarantined (dict, optional): The fingerprints of quarantined files, keyed by path.
+
+    Returns:
+        dict: Lists of IDs keyed by action: "add" (not indexed yet), "update" (indexed
+        but changed), "restore" (tombstoned but back), "refresh" (only the stored
+        fingerprint needs writing), "quarantined" (skipped) and "delete" (indexed but
+        no longer scanned), the number of "scanned" paths, and the scanned "fingerprints"
+        of the paths to add, update, restore or refresh.
+    """
+    quarantined = quarantined or {}
+    plan = {
+        "add": [],
+        "update": [],
+        "restore": [],
+        "refresh": [],
+        "quarantined": [],
+        "delete": [],
+        "scanned": 0,
+        "fingerprints": {},
+    }
+    unscanned = set(existing)
+    for path, fingerprint in scanned:
+        plan["scanned"] += 1
+        unscanned.discard(path)
+        metadata = existing.get(path)
+        if quarantined.get(path) == fingerprint:
+            plan["quarantined"].append(path)
+            continue
+        if metadata is None:
+            plan["add"].append(path)
+        elif (
+            deep_scan
+            and "fingerprint" in metadata
+            and metadata["fingerprint"] != fingerprint
+        ):
+            plan["update"].append(path)
+        elif metadata.get("deleted_at"):
+            plan["restore"].append(path)
+        elif metadata.get("fingerprint") != fingerprint:
+            plan["refresh"].append(path)
+        else:
+            continue
+        plan["fingerprints"][path] = fingerprint
+    plan["delete"] = [id for id in existing if id in unscanned]
+    return plan
+
+
+def quarantine_item(journal, item, error):
+    """
+    Quarantine a file that failed to read or decode, so the rest of its batch is indexed normally.
+    """
+    print(f"Error processing {item['path']}: {error}")
+    journal.quarantine(item["path"], item["fingerprint"], error)
+
+
+def decode_images(
+    batch, on_error, preprocessors=(preprocess_clip_image, preprocess_ocr_image)
+):
+    """
+    Pipeline stage: decodes each image of the batch once and derives the model inputs from it.
+
+    The full resolution image is released as soon as all inputs exist. Images that fail to
+    decode are passed to `on_error(item, error)` and dropped from the batch.
+    """
+    decoded = []
+    for item in batch:
+        image = item["image"]
+        try:
+            for preprocess in preprocessors:
+                preprocess(image)
+        except Exception as e:
+            on_error(item, e)
+            continue
+        finally:
+            image.release()
+        decoded.append(item)
+    return decoded
+
+
+def embed_images(batch):
+    """
+    Pipeline stage: computes the CLIP embeddings of the batch, and with the prescreen its text scores.
+    """
+    embeddings = clip_batch.map(get_clip_image, [item["image"] for item in batch])
+    for item, embedding in zip(batch, embeddings):
+        item["embedding"] = embedding
+    if ocr_threshold is not None and batch:
+        for item, score in zip(batch, text_prescreen.scores(embeddings)):
+            item["text_score"] = float(score)
+    return batch
+
+
+def needs_ocr(item):
+    """
+    Returns:
+        bool: False if the prescreen scored the item below `ocr_threshold`, i.e. it likely has no text.
+    """
+    score = item.get("text_score")
+    return ocr_threshold is None or score is None or score >= ocr_threshold
+
+
+def ocr_images(batch):
+    """
+    Pipeline stage: applies OCR to the batch, except to images the prescreen skips, and releases the images.
+    """
+    screened = [item for item in batch if needs_ocr(item)]
+    texts = ocr_batch.map(apply_OCR, [item["image"] for item in screened])
+    for item, text in zip(screened, texts):
+        item["text"] = text
+    for item in batch:
+        item.setdefault("text", None)
+        del item["image"]
+    return batch
+
+
+def embed_texts(batch):
+    """
+    Pipeline stage: computes the text embeddings of the OCR results of the batch in one call.
+    """
+    texts = [item for item in batch if item["text"] is not None]
+    if texts:
+        embeddings = get_text_embeddings_batch([item["text"] for item in texts])
+        for item, embedding in zip(texts, embeddings):
+            item["text_embedding"] = embedding
+    return batch
+
+
+def copy_embeddings(
+    image_collection,
+    text_collection,
+    duplicates,
+    journal,
+    backlog=None,
+    chunk_size=page_size,
+):
+    """
+    Index files by copying the embeddings of an identical, already indexed file.
+
+    With an OCR backlog, a copy whose source has no text embedding yet skips OCR if the OCR of
+    the source is done (and found no text). If it is pending, the copy is recorded against the
+    source and gets its text once that OCR is done (see `Index.ocr_backlog.OCRBacklog`);
+    otherwise the copy is queued for OCR itself.
+
+    Args:
+        image_collection (Collection): The image collection in the database.
+        text_collection (Collection): The text collection in the database.
+        duplicates (list): Items with the "path", "fingerprint" and "content_hash" of the file and
+            the "source" ID whose embeddings are copied.
+        journal (Journal): The journal copied items are marked done (or failed) in.
+        backlog (OCRBacklog, optional): The backlog of the OCR phase, if OCR is deferred.
+        chunk_size (int, optional): The number of items copied per request.
+
+    Returns:
+        tuple: The number of image embeddings and text embeddings copied, and the number of
+        copies that skipped OCR. Items whose source is not in the image collection are skipped
+        and get indexed on the next run.
+    """
+    copied = texts_copied = ocr_saved = 0
+    for i in range(0, len(duplicates), chunk_size):
+        chunk = duplicates[i : i + chunk_size]
+        sources = list({item["source"] for item in chunk})
+        images = image_collection.get(ids=sources, include=["embeddings"])
+        image_of = dict(zip(images["ids"], images["embeddings"]))
+        texts = text_collection.get(ids=sources, include=["embeddings"])
+        text_of = dict(zip(texts["ids"], texts["embeddings"]))
+
+        found = [item for item in chunk if item["source"] in image_of]
+        for item in chunk:
+            if item["source"] not in image_of:
+                journal.fail(item["path"], f"{item['source']} is not indexed")
+        if found:
+            image_collection.upsert(
+                ids=[item["path"] for item in found],
+                embeddings=[image_of[item["source"]] for item in found],
+                metadatas=[
+                    {
+                        "fingerprint": item["fingerprint"],
+                        "content_hash": item["content_hash"],
+                        "deleted_at": 0,
+                    }
+                    for item in found
+                ],
+            )
+        with_text = [item for item in found if item["source"] in text_of]
+        if with_text:
+            text_collection.upsert(
+                ids=[item["path"] for item in with_text],
+                embeddings=[text_of[item["source"]] for item in with_text],
+                metadatas=[{"deleted_at": 0}] * len(with_text),
+            )
+        queued = []
+        if backlog is not None:
+            without_text = [item for item in found if item["source"] not in text_of]
+            state_of = backlog.states(item["source"] for item in without_text)
+            pending = [
+                item
+                for item in without_text
+                if state_of.get(item["source"], ("",))[0] == "pending"
+            ]
+            backlog.add_copies(
+                (
+                    item["path"],
+                    item["fingerprint"],
+                    item["source"],
+                    state_of[item["source"]][1],
+                )
+                for item in pending
+            )
+            queued = [
+                item
+                for item in without_text
+                if state_of.get(item["source"], ("",))[0] not in ("done", "pending")
+            ]
+            scores = (
+                [
+                    float(score)
+                    for score in text_prescreen.scores(
+                        [image_of[item["source"]] for item in queued]
+                    )
+                ]
+                if ocr_threshold is not None and queued
+                else [None] * len(queued)
+            )
+            backlog.add(
+                (item["path"], item["fingerprint"], score)
+                for item, score in zip(queued, scores)
+            )
+        journal.complete([item["path"] for item in found])
+        copied += len(found)
+        texts_copied += len(with_text)
+        ocr_saved += len(found) - len(queued)
+    return copied, texts_copied, ocr_saved
+
+
+def refresh_entries(image_collection, text_collection, plan, fingerprint_of):
+    """
+    Record new fingerprints and clear tombstones (see `plan_index`) without re-embedding.
+
+    Args:
+        image_collection (Collection): The image collection in the database.
+        text_collection (Collection): The text collection in the database.
+        plan (dict): The index plan.
+        fingerprint_of (dict): The scanned fingerprint of each path.
+    """
+    to_refresh = plan["restore"] + plan["refresh"]
+    for i in range(0, len(to_refresh), page_size):
+        refresh_ids = to_refresh[i : i + page_size]
+        image_collection.update(
+            ids=refresh_ids,
+            metadatas=[
+                {"fingerprint": fingerprint_of[id], "deleted_at": 0}
+                for id in refresh_ids
+            ],
+        )
+    for i in range(0, len(plan["restore"]), page_size):
+        restore_ids = text_collection.get(
+            ids=plan["restore"][i : i + page_size], include=[]
+        )["ids"]
+        if restore_ids:
+            text_collection.update(
+                ids=restore_ids, metadatas=[{"deleted_at": 0}] * len(restore_ids)
+            )
+
+
+def open_ocr_backlog():
+    """
+    Returns:
+        OCRBacklog: The backlog of the OCR phase, or None if OCR runs with CLIP (`deferred` is off in the `ocr` section of `config.yaml`).
+    """
+    return OCRBacklog(ocr_backlog_file) if deferred_ocr else None
+
+
+def index_images(
+    image_collection,
+    text_collection,
+    journal=None,
+    manifest=None,
+    duty_cycle=1.0,
+    backlog=None,
+):
     """
     Index images in the database.
 
-    This function iterates over all image paths in the OS-specific format (os_paths), and for each path,
-    it checks if the image is already in the image collection using the original path. If not, it gets
-    the image embeddings and upserts them into the image collection. It also applies OCR to the image
-    and upserts the text embeddings into the text collection.
+    This function reads the scanned image paths from the manifest, plans the work against the entries already in the
+    image collection (see `plan_index`), and then embeds only the new or changed images in batches
+    (see `embed_paths`).
+
+    With `deduplicate`, the read stage hashes the content of each file. A file whose hash is already
+    indexed (or seen earlier in the run) skips decoding and all models: the embeddings of the identical
+    file are copied instead, which also makes moved and renamed files free to re-index.
+
+    Progress is recorded in a journal (see `Index.journal.Journal`): the plan when the run starts, and
+    every batch once it is written. If the previous run was interrupted, its pending items are indexed
+    instead of planning a new run. Items that were in flight when it died may have killed it (e.g. an
+    image too large to decode), so they are indexed one at a time first, and quarantined once they
+    were in flight `max_attempts` times. Once the run is done, the manifest marks the scanned files whose
+    version is in the index as indexed, and those that could not be indexed as failed.
+
+    With deferred OCR (the default), only CLIP runs here and the images are queued for the OCR phase
+    (see `Index.deferred_ocr.run_ocr`), so every image is searchable by content long before OCR is done.
 
     Args:
-        os_paths (list): The list of image paths in OS-specific format. These paths are used to read
-                         the images and apply OCR.
-        original_paths (list): The list of original image paths. These paths are used as IDs in the
-                               image and text collections.
         image_collection (Collection): The image collection in the database.
         text_collection (Collection): The text collection in the database.
+        journal (Journal, optional): The journal to record progress in. Defaults to the one at `journal_file`.
+        manifest (Manifest, optional): The scanned files. Defaults to the one at `Index.scan.manifest_file`.
+        duty_cycle (float, optional): The fraction of time pipeline workers may work (see `Index.pipeline.Pipeline`). Defaults to 1.
+        backlog (OCRBacklog, optional): The backlog of the OCR phase. Defaults to `open_ocr_backlog()`.
+
+    Returns:
+        dict: The index plan (see `plan_index`). A resumed run only has the pending paths, under "resume".
     """
-    paths, averages = read_from_csv("paths.csv")
-    with tqdm(total=len(paths), desc="Indexing images") as pbar:
-        for i in range(0, len(paths), batch_size):
-            batch_paths = paths[i : i + batch_size]
-            to_process = []
-
-            for path in batch_paths:
-                if len(image_collection.get(ids=[path])["ids"]) > 0:
-                    if deep_scan:
-                        # Check if the average pixel value has changed
-                        average = image_collection.get(ids=[path])["metadatas"][0][
-                            "average"
-                        ]
-                        if average != averages[paths.index(path)]:
-                            to_process.append(path)
-                else:
-                    to_process.append(path)
+    if journal is None:
+        journal = Journal(journal_file)
+    if manifest is None:
+        manifest = Manifest(manifest_file)
+    if backlog is None:
+        backlog = open_ocr_backlog()
+    progress.start("planning")
+    existing = fetch_index_metadata(image_collection)
+    if journal.unfinished_run() is not None:
+        to_process = journal.pending_items()
+        plan = {"resume": [path for path, _ in to_process]}
+        print(f"Resuming interrupted indexing run: {len(to_process)} images left")
+        attempts = journal.attempts()
+        for path, fingerprint in to_process:
+            if attempts.get(path, 0) >= max_attempts:
+                quarantine_item(
+                    journal,
+                    {"path": path, "fingerprint": fingerprint},
+                    f"indexing stopped while processing it {attempts[path]} times",
+                )
+        to_process = [
+            item for item in to_process if attempts.get(item[0], 0) < max_attempts
+        ]
+        isolate = set(attempts) & {path for path, _ in to_process}
+    else:
+        plan = plan_index(manifest.scanned(), existing, journal.quarantined())
+        print(
+            f"Index plan: {len(plan['add'])} to add, {len(plan['update'])} to update, "
+            f"{len(plan['restore'])} to restore, {len(plan['delete'])} to delete, "
+            f"{len(plan['quarantined'])} quarantined "
+            f"({plan['scanned']} scanned, {len(existing)} indexed)"
+        )
+        fingerprint_of = plan["fingerprints"]
+        refresh_entries(image_collection, text_collection, plan, fingerprint_of)
+        to_process = [
+            (path, fingerprint_of[path]) for path in plan["add"] + plan["update"]
+        ]
+        journal.start_run(to_process)
+        isolate = set()
+    autotune_batch_sizes([path for path, _ in to_process])
+
+    # Content hash -> ID of a file with that content. Entries being re-embedded are left
+    # out since their embeddings are about to be replaced.
+    updated = set(plan.get("update", plan.get("resume")))
+    known_hashes = {
+        metadata["content_hash"]: id
+        for id, metadata in existing.items()
+        if "content_hash" in metadata and id not in updated
+    }
+    embed_paths(
+        image_collection,
+        text_collection,
+        to_process,
+        journal,
+        known_hashes,
+        moved=set(plan.get("delete", [])),
+        duty_cycle=duty_cycle,
+        backlog=backlog,
+        isolate=isolate,
+    )
+
+    # The versions this run embedded or copied, and those it found already indexed
+    indexed = journal.completed() + [
+        (path, plan["fingerprints"][path])
+        for path in plan.get("restore", []) + plan.get("refresh", [])
+    ]
+    indexed += [
+        (path, existing[path]["fingerprint"])
+        for path in manifest.pending()
+        if "fingerprint" in existing.get(path, {})
+        and not existing[path].get("deleted_at")
+    ]
+    manifest.finish_index(indexed, set(journal.failed()) | set(journal.quarantined()))
+    journal.finish_run()
+    return plan
+
+
+def embed_paths(
+    image_collection,
+    text_collection,
+    to_process,
+    journal,
+    known_hashes,
+    moved=(),
+    duty_cycle=1.0,
+    backlog=None,
+    isolate=(),
+):
+    """
+    Embed images through the indexing pipeline and write them to both collections.
+
+    Batches go through a pipeline of stages (read, decode, CLIP, OCR, text embedding, database write)
+    that run concurrently on different batches, with worker counts set in the `pipeline` section of
+    `config.yaml`. Image embeddings are upserted into the image collection and the embeddings of the
+    OCR text into the text collection. Within a batch, texts are written before images, so an image
+    entry is only present once its text is, and the journal marks the batch done after both.
+
+    With a `backlog`, the OCR and text embedding stages are skipped: images are decoded for CLIP only
+    and queued for the OCR phase once their image embeddings are written.
+
+    With `deduplicate`, a file whose content hash is in `known_hashes` skips decoding and all models:
+    the embeddings of the identical file are copied instead (see `copy_embeddings`).
+
+    Every batch is recorded as an attempt in the journal before it enters the pipeline (see
+    `Index.journal.Journal.attempt`). The paths in `isolate` go first, one at a time and alone in
+    the pipeline, so that an item that kills the process is the only one charged for it.
+
+    Args:
+        image_collection (Collection): The image collection in the database.
+        text_collection (Collection): The text collection in the database.
+        to_process (list): (path, fingerprint) of each image to embed, as recorded in the journal.
+        journal (Journal): The journal batches are marked done (or items failed) in.
+        known_hashes (dict): The ID of an indexed file for each content hash. Files of this call are added to it.
+        moved (set, optional): IDs about to be removed; copies of them are reported as moved or renamed files.
+        duty_cycle (float, optional): The fraction of time pipeline workers may work (see `Index.pipeline.Pipeline`). Defaults to 1.
+        backlog (OCRBacklog, optional): The backlog of the OCR phase. Defaults to None (OCR runs in this pipeline).
+        isolate (set, optional): Paths that may have killed an earlier run.
+    """
+    duplicates = []
+    min_size = decode_size if backlog is None else clip_decode_size
+    # Batches are at least as large as the (tuned) batch size of each model stage
+    step = max(batch_size, clip_batch.size, ocr_batch.size if backlog is None else 1)
+    lock = threading.Lock()
+    progress.start("indexing", len(to_process))
+
+    with tqdm(total=len(to_process), desc="Indexing images") as pbar:
 
-            if to_process:
-                # Process CLIP embeddings in batch
-                image_embeddings = get_clip_image(to_process)
+        # The number of items that left the pipeline, written or not
+        finished = [0]
+        settled = threading.Condition()
 
-                # Prepare data for batch upsert
-                upsert_ids = to_process
-                upsert_embeddings = image_embeddings
-                upsert_metadatas = [
-                    {"average": averages[paths.index(path)]} for path in to_process
+        def advance(count):
+            pbar.update(count)
+            progress.advance(count)
+            with settled:
+                finished[0] += count
+                settled.notify_all()
+
+        def batches():
+            suspects = [item for item in to_process if item[0] in isolate]
+            others = [item for item in to_process if item[0] not in isolate]
+            chunks = [[item] for item in suspects] + [
+                others[i : i + step] for i in range(0, len(others), step)
+            ]
+            sent = 0
+            for i, chunk in enumerate(chunks):
+                if suspects and i <= len(suspects):
+                    # Wait for the pipeline to drain, so each suspect is alone in it
+                    with settled:
+                        while finished[0] < sent and not pipeline.stopped.is_set():
+                            settled.wait(1)
+                journal.attempt([path for path, _ in chunk])
+                sent += len(chunk)
+                yield [
+                    {"path": path, "fingerprint": fingerprint}
+                    for path, fingerprint in chunk
                 ]
 
-                # Perform batch upsert for image collection
-                image_collection.upsert(
-                    ids=upsert_ids,
-                    embeddings=upsert_embeddings,
-                    metadatas=upsert_metadatas,
+        def read_batch(batch):
+            """
+            Pipeline stage: reads the raw bytes of each image in the batch and sets aside duplicates.
+            Files that cannot be read are quarantined.
+            """
+            unique = []
+            for item in batch:
+                try:
+                    image = SharedImage(item["path"], min_size).read()
+                except OSError as e:
+                    quarantine_item(journal, item, e)
+                    continue
+                item["content_hash"] = image.digest()
+                with lock:
+                    source = known_hashes.get(item["content_hash"])
+                    if source is None or not deduplicate:
+                        known_hashes[item["content_hash"]] = item["path"]
+                if source is None or not deduplicate:
+                    item["image"] = image
+                    unique.append(item)
+                else:
+                    item["source"] = source
+                    duplicates.append(item)
+            advance(len(batch) - len(unique))
+            return unique
+
+        def decode_batch(batch):
+            decoded = decode_images(
+                batch,
+                lambda item, e: quarantine_item(journal, item, e),
+                (
+                    (preprocess_clip_image, preprocess_ocr_image)
+                    if backlog is None
+                    else (preprocess_clip_image,)
+                ),
+            )
+            advance(len(batch) - len(decoded))
+            return decoded
+
+        def write_batch(batch):
+            """
+            Pipeline stage: upserts the embeddings of the batch into both collections and
+            marks the batch done in the journal.
+            """
+            texts = [item for item in batch if "text_embedding" in item]
+            if texts:
+                text_collection.upsert(
+                    ids=[item["path"] for item in texts],
+                    embeddings=[item["text_embedding"] for item in texts],
+                    metadatas=[{"deleted_at": 0}] * len(texts),
                 )
-                ocr_texts = apply_OCR(to_process)
+            # The image upsert is the commit point of the batch
+            image_collection.upsert(
+                ids=[item["path"] for item in batch],
+                embeddings=[item["embedding"] for item in batch],
+                metadatas=[
+                    {
+                        "fingerprint": item["fingerprint"],
+                        "content_hash": item["content_hash"],
+                        "deleted_at": 0,
+                    }
+                    for item in batch
+                ],
+            )
+            if backlog is not None:
+                backlog.add(
+                    (item["path"], item["fingerprint"], item.get("text_score"))
+                    for item in batch
+                )
+            journal.complete([item["path"] for item in batch])
+            advance(len(batch))
+            return batch
+
+        stages = [
+            Stage("read", read_batch, pipeline_config.get("read_workers", 2)),
+            Stage("decode", decode_batch, pipeline_config.get("decode_workers", 2)),
+            Stage("clip", embed_images, pipeline_config.get("clip_workers", 1)),
+        ]
+        if backlog is None:
+            stages += [
+                Stage("ocr", ocr_images, pipeline_config.get("ocr_workers", 1)),
+                Stage("text", embed_texts, pipeline_config.get("text_workers", 1)),
+            ]
+        pipeline = Pipeline(
+            stages + [Stage("write", write_batch, 1)],
+            queue_size=pipeline_config.get("queue_size", 2),
+            duty_cycle=duty_cycle,
+        )
+        pipeline.run(batches())
+    if to_process:
+        pipeline.report()
+
+    if duplicates:
+        copied, texts_copied, ocr_saved = copy_embeddings(
+            image_collection, text_collection, duplicates, journal, backlog
+        )
+        print(
+            f"Deduplicated {copied} images "
+            f"({sum(item['source'] in moved for item in duplicates)} moved or renamed): "
+            f"saved {copied} CLIP, {ocr_saved} OCR and {texts_copied} text embedding invocations"
+        )
+
+
+def delete_ids(collection, ids, chunk_size=page_size, desc="Cleaning up database"):
+    """
+    Delete IDs from a collection in chunks.
+
+    Args:
+        collection (Collection): The collection to delete from.
+        ids (list): The IDs to delete. All of them must exist in the collection.
+        chunk_size (int, optional): The number of IDs deleted per request.
+        desc (str, optional): The progress bar description.
+    """
+    with tqdm(total=len(ids), desc=desc) as pbar:
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i : i + chunk_size]
+            collection.delete(ids=chunk)
+            pbar.update(len(chunk))
+
+
+def load_clean_stats():
+    """
+    Load the delete throughput measured by the last cleanup (see `clean_index`).
+
+    Returns:
+        dict: The stats, empty if no cleanup was measured yet.
+    """
+    try:
+        with open(clean_stats_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def root_available(root):
+    """
+    Check whether an include directory can be scanned right now.
+
+    A root on a drive or network share that is not mounted either does not exist or is an
+    empty mount point, so an empty directory counts as unavailable too.
+
+    Args:
+        root (str): The include directory.
+
+    Returns:
+        bool: True if the directory exists and has at least one entry.
+    """
+    try:
+        with os.scandir(root) as entries:
+            return any(True for _ in entries)
+    except OSError:
+        return False
+
+
+def unavailable_roots():
+    """
+    List the include directories from `config.yaml` that are currently unavailable (see `root_available`).
+
+    Returns:
+        list: The unavailable roots, normalized like the indexed paths and ending with "/".
+        Empty for the Everything scan method, which has no include directories.
+    """
+    if config["scan_method"] != "default":
+        return []
+    roots = [
+        root.replace("\\", "/").rstrip("/") + "/"
+        for root in config["include_directories"]
+    ]
+    return [root for root in roots if not root_available(root)]
 
-                # Process OCR and text embeddings individually
-                for i in range(len(to_process)):
-                    if ocr_texts[i] is not None:
-                        text_embeddings = get_text_embeddings(ocr_texts[i])
-                        text_collection.upsert(
-                            ids=[to_process[i]], embeddings=[text_embeddings]
-                        )
 
-            pbar.update(min(batch_size, len(paths) - i))
+def plan_cleanup(existing, scanned, skipped_roots, now):
+    """
+    Split the entries of a collection that were not scanned into tombstones to add and entries to purge.
 
+    Args:
+        existing (dict): The entries of the collection, as returned by `fetch_index_metadata`.
+        scanned (set): The scanned image paths.
+        skipped_roots (list): Roots whose entries are left untouched (see `unavailable_roots`).
+        now (float): The current time (seconds since the epoch).
 
-def clean_index(image_collection, text_collection, verbose=False):
+    Returns:
+        tuple: Three lists: IDs to tombstone, IDs to purge, and IDs skipped because their root is unavailable.
+    """
+    skipped_roots = tuple(skipped_roots)
+    to_tombstone, to_purge, skipped = [], [], []
+    for id, metadata in existing.items():
+        if id in scanned:
+            continue
+        if skipped_roots and id.startswith(skipped_roots):
+            skipped.append(id)
+            continue
+        deleted_at = metadata.get("deleted_at", 0)
+        if not deleted_at and tombstone_grace > 0:
+            to_tombstone.append(id)
+        elif now - deleted_at >= tombstone_grace:
+            to_purge.append(id)
+    return to_tombstone, to_purge, skipped
+
+
+def tombstone_ids(collection, ids, now, chunk_size=page_size):
+    """
+    Mark IDs of a collection as deleted at `now`, keeping their embeddings.
+    """
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i : i + chunk_size]
+        collection.update(ids=chunk, metadatas=[{"deleted_at": now}] * len(chunk))
+
+
+def clean_index(
+    image_collection, text_collection, verbose=False, dry_run=False, manifest=None
+):
     """
     Clean up the database.
 
-    This function iterates over all IDs in the image collection, and for each ID, it checks if the ID is in
-    the list of original image paths. If not, it deletes the ID from the image collection and the text collection.
+    This function fetches the IDs and metadata (no embeddings) of both collections in pages and looks
+    for entries that are not among the scanned image paths. Such entries are not deleted right away:
+
+    - If their include directory is unavailable (e.g. an unmounted external drive), they are left untouched.
+    - Otherwise they are tombstoned (`deleted_at` metadata), which hides them from search while keeping
+      their embeddings, and only purged once `tombstone_grace_days` from `config.yaml` have passed. Files
+      that reappear within the grace period are reactivated by `index_images` without re-embedding.
+
+    Purges are issued in chunks. With `dry_run`, nothing is changed: the function reports how many entries
+    would be tombstoned and purged, and an estimate of how long the purge would take, based on the delete
+    throughput measured by the last cleanup.
 
     Args:
-        paths (list): The list of original image paths. These paths are used as IDs in the
-                               image and text collections.
         image_collection (Collection): The image collection in the database.
         text_collection (Collection): The text collection in the database.
+        verbose (bool, optional): If True, prints every purged ID. Defaults to False.
+        dry_run (bool, optional): If True, only reports what would change. Defaults to False.
+        manifest (Manifest, optional): The scanned files. Defaults to the one at `Index.scan.manifest_file`.
+
+    Returns:
+        tuple: The image IDs and text IDs that were (or would be) purged.
     """
-    paths, averages = read_from_csv("paths.csv")
-    for i, id in tqdm(
-        enumerate(image_collection.get()["ids"]),
-        total=len(image_collection.get()["ids"]),
-        desc="Cleaning up database",
-    ):
-        if id not in paths:
-            if verbose:
-                print(f"deleting: {id} from image_collection")
-            image_collection.delete(ids=[id])
-            try:
-                if verbose:
-                    print(f"deleting: {id} from text_collection")
-                text_collection.delete(ids=[id])
-            except:
-                pass
+    if manifest is None:
+        manifest = Manifest(manifest_file)
+    progress.start("cleaning")
+    skipped_roots = unavailable_roots()
+    for root in skipped_roots:
+        print(f"Include directory {root} is unavailable, keeping its index entries")
+    now = time.time()
+    image_existing = fetch_index_metadata(image_collection)
+    image_tombstones, image_purges, skipped = plan_cleanup(
+        image_existing, manifest.present(image_existing), skipped_roots, now
+    )
+    text_existing = fetch_index_metadata(text_collection)
+    text_tombstones, text_purges, _ = plan_cleanup(
+        text_existing, manifest.present(text_existing), skipped_roots, now
+    )
+    total = len(image_purges) + len(text_purges)
+
+    if dry_run:
+        rate = load_clean_stats().get("deletes_per_second")
+        estimate = (
+            f"~{total / rate:.1f} seconds"
+            if rate
+            else "unknown (no cleanup measured yet)"
+        )
+        print(
+            f"Dry run: would tombstone {len(image_tombstones)} images, purge "
+            f"{len(image_purges)} images and {len(text_purges)} texts "
+            f"({len(skipped)} skipped on unavailable roots), estimated time: {estimate}"
+        )
+        if verbose:
+            for id in image_purges:
+                print(f"would delete: {id}")
+        return image_purges, text_purges
+
+    tombstone_ids(image_collection, image_tombstones, now)
+    tombstone_ids(text_collection, text_tombstones, now)
+    if image_tombstones:
+        print(
+            f"Tombstoned {len(image_tombstones)} missing images, they will be purged "
+            f"after {tombstone_grace / 86400:g} days"
+        )
+    if verbose:
+        for id in image_purges:
+            print(f"deleting: {id}")
+    start = time.time()
+    delete_ids(image_collection, image_purges)
+    delete_ids(text_collection, text_purges, desc="Cleaning up texts")
+    elapsed = time.time() - start
+    if total and elapsed > 0:
+        with open(clean_stats_file, "w") as f:
+            json.dump({"deletes_per_second": total / elapsed}, f)
+    return image_purges, text_purges
@@ -0,0 +1,271 @@
+import threading
+import time
+from datetime import datetime
+
+from tqdm import tqdm
+
+from Index.create_db import (
+    autotune_batch_sizes,
+    batch_size,
+    decode_images,
+    embed_texts,
+    export_snapshots,
+    fetch_index_metadata,
+    ocr_backlog_file,
+    ocr_config,
+    ocr_decode_size,
+    ocr_batch,
+    ocr_images,
+    ocr_threshold,
+    page_size,
+    pipeline_config,
+    preprocess_ocr_image,
+)
+from Index.ocr_backlog import OCRBacklog
+from Index.pipeline import Pipeline, Stage
+from Index.progress import ocr_progress
+from Index.shared_image import SharedImage
+
+
+def in_idle_hours(idle_hours, now=None):
+    """
+    Args:
+        idle_hours (list): [start, end] hours (0-23, local time) of the window OCR may run in; the
+            window wraps around midnight if start > end, e.g. [22, 7]. Empty or None means any time.
+        now (datetime, optional): The time to check. Defaults to now.
+
+    Returns:
+        bool: Whether `now` is inside the window.
+    """
+    if not idle_hours:
+        return True
+    start, end = idle_hours
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def wait_for_turn(backlog, idle_hours, check_interval=30):
+    """
+    Blocks while the OCR phase is paused or outside its idle hours.
+
+    Returns:
+        bool: Whether it had to wait.
+    """
+    waited = False
+    while True:
+        if backlog.paused():
+            phase = "paused"
+        elif not in_idle_hours(idle_hours):
+            phase = "waiting for idle hours"
+        else:
+            return waited
+        if ocr_progress.snapshot()["phase"] != phase:
+            print(f"OCR {phase}")
+            ocr_progress.start(phase)
+        waited = True
+        time.sleep(check_interval)
+
+
+def requeue_indexed(image_collection, backlog):
+    """
+    Queues every live entry of the image collection for OCR again, e.g. after changing OCR
+    settings. Image embeddings are left untouched.
+
+    Args:
+        image_collection (Collection): The image collection in the database.
+        backlog (OCRBacklog): The backlog of the OCR phase.
+
+    Returns:
+        int: The number of queued images.
+    """
+    items = [
+        (id, metadata.get("fingerprint", ""))
+        for id, metadata in fetch_index_metadata(image_collection).items()
+        if not metadata.get("deleted_at")
+    ]
+    for i in range(0, len(items), page_size):
+        backlog.add(items[i : i + page_size])
+    return len(items)
+
+
+def ocr_batches(text_collection, backlog, to_process, idle_hours, duty_cycle):
+    """
+    Runs OCR and text embedding on backlog items and writes their text embeddings.
+
+    Texts replace the previous text embedding of their image; an image in which OCR no longer
+    finds text loses its text entry. Duplicates recorded against an image get the same text
+    entry. Items whose file is gone are dropped from the backlog, other read or decode errors
+    mark them as failed.
+    """
+    check_interval = ocr_config.get("check_interval", 30)
+
+    with tqdm(total=len(to_process), desc="OCR") as pbar:
+
+        def advance(count):
+            pbar.update(count)
+            ocr_progress.advance(count)
+
+        def fail(item, error):
+            print(f"Error processing {item['path']}: {error}")
+            backlog.fail(item["path"], item["fingerprint"], error)
+
+        def read_batch(batch):
+            """
+            Pipeline stage: reads the raw bytes of each image in the batch.
+            """
+            read = []
+            for item in batch:
+                try:
+                    item["image"] = SharedImage(item["path"], ocr_decode_size).read()
+                except FileNotFoundError:
+                    backlog.remove([item["path"]])
+                    continue
+                except OSError as e:
+                    fail(item, e)
+                    continue
+                read.append(item)
+            advance(len(batch) - len(read))
+            return read
+
+        def decode_batch(batch):
+            decoded = decode_images(batch, fail, (preprocess_ocr_image,))
+            advance(len(batch) - len(decoded))
+            return decoded
+
+        def write_texts(entries):
+            """
+            Upserts the text embeddings of (ID, item) pairs and deletes the stale text entries
+            of those whose item has no text.
+            """
+            texts = [(id, item) for id, item in entries if "text_embedding" in item]
+            if texts:
+                text_collection.upsert(
+                    ids=[id for id, _ in texts],
+                    embeddings=[item["text_embedding"] for _, item in texts],
+                    metadatas=[{"deleted_at": 0}] * len(texts),
+                )
+            without_text = [id for id, item in entries if "text_embedding" not in item]
+            if without_text:
+                stale = text_collection.get(ids=without_text, include=[])["ids"]
+                if stale:
+                    text_collection.delete(ids=stale)
+
+        def write_batch(batch):
+            """
+            Pipeline stage: upserts the text embeddings of the batch, marks it done in the backlog
+            and gives the duplicates recorded against it the same text embeddings.
+            """
+            write_texts([(item["path"], item) for item in batch])
+            processed = [(item["path"], item["fingerprint"]) for item in batch]
+            backlog.complete(processed)
+            # Copies recorded from now on find the source done and its text written
+            item_of = {item["path"]: item for item in batch}
+            write_texts(
+                [
+                    (path, item_of[source])
+                    for path, source in backlog.take_copies(processed)
+                ]
+            )
+            advance(len(batch))
+            return batch
+
+        step = max(batch_size, ocr_batch.size)
+
+        def batches():
+            for i in range(0, len(to_process), step):
+                # Pausing takes effect between batches
+                if wait_for_turn(backlog, idle_hours, check_interval):
+                    ocr_progress.start("ocr", len(to_process) - i)
+                yield [
+                    {"path": path, "fingerprint": fingerprint}
+                    for path, fingerprint in to_process[i : i + step]
+                ]
+
+        ocr_progress.start("ocr", len(to_process))
+        pipeline = Pipeline(
+            [
+                Stage("read", read_batch, pipeline_config.get("read_workers", 2)),
+                Stage("decode", decode_batch, pipeline_config.get("decode_workers", 2)),
+                Stage("ocr", ocr_images, pipeline_config.get("ocr_workers", 1)),
+                Stage("text", embed_texts, pipeline_config.get("text_workers", 1)),
+                Stage("write", write_batch, 1),
+            ],
+            queue_size=pipeline_config.get("queue_size", 2),
+            duty_cycle=duty_cycle,
+        )
+        pipeline.run(batches())
+    pipeline.report()
+
+
+def run_ocr(text_collection, backlog=None, duty_cycle=None, follow=False):
+    """
+    The OCR phase: applies OCR to the images in the backlog (see `Index.ocr_backlog.OCRBacklog`)
+    and writes the embeddings of their text, oldest first.
+
+    Images the prescreen scored below `threshold` (see `Index.prescreen.TextPrescreen`) are left
+    in the backlog and skipped, so lowering the threshold later brings them back.
+
+    The phase only works during the `idle_hours` of the `ocr` section of `config.yaml` and while
+    the backlog is not paused; otherwise it waits, and picks up where it stopped. It is throttled
+    to `duty_cycle`, so it yields to the CLIP phase and to the rest of the machine. Once the
+    backlog is worked through, the text collection is exported to its snapshot.
+
+    Args:
+        text_collection (Collection): The text collection in the database.
+        backlog (OCRBacklog, optional): The backlog to work through. Defaults to the one at `ocr_backlog_file`.
+        duty_cycle (float, optional): The fraction of time pipeline workers may work (see `Index.pipeline.Pipeline`).
+            Defaults to `duty_cycle` of the `ocr` section of `config.yaml`.
+        follow (bool, optional): If True, keep waiting for new items once the backlog is empty, until
+            the process exits. Defaults to False (return once the backlog is empty).
+    """
+    if backlog is None:
+        backlog = OCRBacklog(ocr_backlog_file)
+    if duty_cycle is None:
+        duty_cycle = ocr_config.get("duty_cycle", 0.5)
+    idle_hours = ocr_config.get("idle_hours")
+    check_interval = ocr_config.get("check_interval", 30)
+    processed = False
+    while True:
+        wait_for_turn(backlog, idle_hours, check_interval)
+        to_process = backlog.pending(ocr_threshold)
+        if to_process:
+            processed = True
+            skipped = backlog.counts(ocr_threshold).get("skipped", 0)
+            print(
+                f"OCR backlog: {len(to_process)} images "
+                f"({skipped} skipped by the prescreen)"
+            )
+            autotune_batch_sizes([path for path, _ in to_process])
+            ocr_batches(text_collection, backlog, to_process, idle_hours, duty_cycle)
+            continue
+        if processed:
+            # New texts keep the metadata of the ones they replace, so the snapshot is forced
+            ocr_progress.start("exporting")
+            export_snapshots([text_collection], force=True)
+            processed = False
+        ocr_progress.start("idle")
+        if not follow:
+            return
+        time.sleep(check_interval)
+
+
+def start_background_ocr(text_collection, backlog=None, duty_cycle=None):
+    """
+    Runs `run_ocr` in a background thread that keeps following the backlog.
+
+    Returns:
+        threading.Thread: The started (daemon) thread.
+    """
+
+    def run():
+        try:
+            run_ocr(text_collection, backlog, duty_cycle, follow=True)
+        except Exception as e:
+            print(f"OCR failed: {e}")
+            ocr_progress.fail(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,214 @@
+import sqlite3
+import threading
+import time
+
+
+class Journal:
+    """
+    A durable record of the progress of an indexing run, so that an interrupted run can resume.
+
+    When a run starts, its whole plan (the paths to embed and their fingerprints) is written to a
+    SQLite database. Every batch written to the collections is then marked as done in one
+    transaction, and items that could not be indexed are marked as failed. If the process dies,
+    the next run finds the unfinished run and continues with its pending items instead of
+    rescanning and replanning.
+
+    Files that cannot be read or decoded are also kept in a quarantine table with their
+    fingerprint, so that later runs skip them until the file changes. Each item also counts the
+    times it was sent into the pipeline, so that a resumed run can tell which items were in
+    flight when the process died (see `attempt`).
+
+    Args:
+        path (str): The path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY,
+                    started REAL NOT NULL,
+                    finished REAL,
+                    plan_size INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS items (
+                    path TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT
+                );
+                CREATE INDEX IF NOT EXISTS items_status ON items (status);
+                CREATE TABLE IF NOT EXISTS quarantine (
+                    path TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    error TEXT NOT NULL,
+                    quarantined_at REAL NOT NULL
+                );
+                """)
+            columns = [
+                row[1] for row in self.connection.execute("PRAGMA table_info(items)")
+            ]
+            if "attempts" not in columns:
+                self.connection.execute(
+                    "ALTER TABLE items ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+                )
+
+    def unfinished_run(self):
+        """
+        Returns:
+            int: The ID of the last run if it did not finish, otherwise None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, finished FROM runs ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+        if row is None or row[1] is not None:
+            return None
+        return row[0]
+
+    def start_run(self, items):
+        """
+        Records the plan of a new run, replacing the items of any previous run.
+
+        Args:
+            items (list): (path, fingerprint) tuples of the images to embed.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM items")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO items (path, fingerprint) VALUES (?, ?)", items
+            )
+            self.connection.execute(
+                "INSERT INTO runs (started, plan_size) VALUES (?, ?)",
+                (time.time(), len(items)),
+            )
+
+    def pending_items(self):
+        """
+        Returns:
+            list: (path, fingerprint) tuples of the items of the current run that are not done yet.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, fingerprint FROM items WHERE status = 'pending'"
+            ).fetchall()
+
+    def attempt(self, paths):
+        """
+        Records that items are about to be processed, in a single transaction.
+
+        Args:
+            paths (list): The paths of the items.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE items SET attempts = attempts + 1 WHERE path = ?",
+                [(path,) for path in paths],
+            )
+
+    def attempts(self):
+        """
+        Returns:
+            dict: The number of times each pending item of the current run was processed
+            without finishing, i.e. was in flight when the process died, keyed by path.
+        """
+        with self.lock:
+            return dict(
+                self.connection.execute(
+                    "SELECT path, attempts FROM items "
+                    "WHERE status = 'pending' AND attempts > 0"
+                )
+            )
+
+    def completed(self):
+        """
+        Returns:
+            list: (path, fingerprint) tuples of the items of the current run that are done.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, fingerprint FROM items WHERE status = 'done'"
+            ).fetchall()
+
+    def complete(self, paths):
+        """
+        Marks items as done, in a single transaction.
+
+        Args:
+            paths (list): The paths of the items.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE items SET status = 'done' WHERE path = ?",
+                [(path,) for path in paths],
+            )
+            self.connection.executemany(
+                "DELETE FROM quarantine WHERE path = ?", [(path,) for path in paths]
+            )
+
+    def fail(self, path, error):
+        """
+        Marks an item as failed, so a resumed run does not retry it.
+
+        Args:
+            path (str): The path of the item.
+            error (str): What went wrong.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE items SET status = 'failed', error = ? WHERE path = ?",
+                (str(error), path),
+            )
+
+    def failed(self):
+        """
+        Returns:
+            list: The paths of the items of the current run that failed.
+        """
+        with self.lock:
+            return [
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT path FROM items WHERE status = 'failed'"
+                )
+            ]
+
+    def quarantine(self, path, fingerprint, error):
+        """
+        Marks an item as failed and quarantines its file until its fingerprint changes.
+
+        Args:
+            path (str): The path of the file.
+            fingerprint (str): The fingerprint of the file when it failed.
+            error (str): What went wrong.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE items SET status = 'failed', error = ? WHERE path = ?",
+                (str(error), path),
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?)",
+                (path, fingerprint, str(error), time.time()),
+            )
+
+    def quarantined(self):
+        """
+        Returns:
+            dict: The fingerprint each quarantined file had when it failed, keyed by path.
+        """
+        with self.lock:
+            return dict(
+                self.connection.execute("SELECT path, fingerprint FROM quarantine")
+            )
+
+    def finish_run(self):
+        """
+        Marks the current run as finished; the next run starts from a fresh scan.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE runs SET finished = ? WHERE finished IS NULL", (time.time(),)
+            )
@@ -0,0 +1,235 @@
+import sqlite3
+import threading
+import time
+
+
+class Manifest:
+    """
+    The scanned image files, kept on disk so that neither the scanner nor the indexer holds the whole file list in memory.
+
+    The scanner writes one row per file (path, size, modification time, fingerprint) in chunks as
+    files are found, and the indexer reads them back with paged queries. Each row also holds the
+    index state of its file:
+
+    - "pending": new, changed or back since it was last indexed.
+    - "indexed": the index has the embeddings of the scanned version.
+    - "failed": the file could not be indexed (see `Index.journal.Journal.quarantine`).
+    - "missing": the file was not found by the last complete scan.
+
+    Args:
+        path (str): The path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS scans (
+                    id INTEGER PRIMARY KEY,
+                    started REAL NOT NULL,
+                    finished REAL
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    scan_id INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_state ON files (state);
+                """)
+        # Files recorded outside of a scan (e.g. from file system events) count as seen by the last one
+        with self.lock:
+            self.scan_id = self.connection.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM scans"
+            ).fetchone()[0]
+
+    def begin_scan(self):
+        """
+        Starts a scan; files recorded from now on are marked as seen by it.
+        """
+        with self.lock, self.connection:
+            self.scan_id = self.connection.execute(
+                "INSERT INTO scans (started) VALUES (?)", (time.time(),)
+            ).lastrowid
+
+    def record(self, rows):
+        """
+        Records scanned files, in a single transaction.
+
+        A file whose fingerprint changed, or that was missing, becomes pending again; other
+        known files keep their state.
+
+        Args:
+            rows (list): (path, size, mtime_ns, fingerprint) tuples.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """
+                INSERT INTO files (path, size, mtime_ns, fingerprint, state, scan_id)
+                VALUES (?, ?, ?, ?, 'pending', ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    size = excluded.size,
+                    mtime_ns = excluded.mtime_ns,
+                    fingerprint = excluded.fingerprint,
+                    scan_id = excluded.scan_id,
+                    state = CASE
+                        WHEN files.fingerprint != excluded.fingerprint
+                            OR files.state = 'missing' THEN 'pending'
+                        ELSE files.state
+                    END
+                """,
+                [(*row, self.scan_id) for row in rows],
+            )
+
+    def finish_scan(self):
+        """
+        Ends a complete scan: files it did not record are marked as missing.
+
+        Returns:
+            list: The paths of the files that went missing with this scan.
+        """
+        with self.lock, self.connection:
+            missing = [
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT path FROM files WHERE scan_id != ? AND state != 'missing'",
+                    (self.scan_id,),
+                )
+            ]
+            self.connection.execute(
+                "UPDATE files SET state = 'missing' WHERE scan_id != ? AND state != 'missing'",
+                (self.scan_id,),
+            )
+            self.connection.execute(
+                "UPDATE scans SET finished = ? WHERE id = ?",
+                (time.time(), self.scan_id),
+            )
+        return missing
+
+    def mark_missing(self, paths):
+        """
+        Marks files as missing without a scan, e.g. when they are reported deleted.
+
+        Args:
+            paths (iterable): The paths of the files.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE files SET state = 'missing' WHERE path = ?",
+                [(path,) for path in paths],
+            )
+
+    def scanned(self, page_size=10000):
+        """
+        Yields the files found by the last scan, one page of rows in memory at a time.
+
+        Args:
+            page_size (int, optional): The number of rows read per query.
+
+        Yields:
+            tuple: (path, fingerprint) of each file.
+        """
+        last = ""
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT path, fingerprint FROM files "
+                    "WHERE path > ? AND state != 'missing' ORDER BY path LIMIT ?",
+                    (last, page_size),
+                ).fetchall()
+            yield from rows
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    def present(self, paths, chunk_size=500):
+        """
+        Args:
+            paths (iterable): Paths to look up, e.g. the IDs of a collection.
+            chunk_size (int, optional): The number of paths looked up per query.
+
+        Returns:
+            set: The paths among `paths` that were found by the last scan.
+        """
+        paths = list(paths)
+        found = set()
+        with self.lock:
+            for i in range(0, len(paths), chunk_size):
+                chunk = paths[i : i + chunk_size]
+                found.update(
+                    row[0]
+                    for row in self.connection.execute(
+                        "SELECT path FROM files WHERE state != 'missing' AND path IN "
+                        f"({', '.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+        return found
+
+    def pending(self):
+        """
+        Returns:
+            list: The paths of the files that are new, changed or back since they were last indexed.
+        """
+        with self.lock:
+            return [
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT path FROM files WHERE state = 'pending'"
+                )
+            ]
+
+    def under(self, directory):
+        """
+        Args:
+            directory (str): A directory, with "/" as separator.
+
+        Returns:
+            list: The paths of the files below `directory` that are not missing.
+        """
+        prefix = directory.rstrip("/")
+        # "0" is the character after "/", so this is a range scan of the primary key
+        with self.lock:
+            return [
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT path FROM files WHERE path > ? AND path < ? AND state != 'missing'",
+                    (prefix + "/", prefix + "0"),
+                )
+            ]
+
+    def finish_index(self, indexed, failed):
+        """
+        Ends an indexing run: pending files whose scanned version is now in the index are marked
+        as indexed, and those that failed as failed. Other pending files, e.g. scanned after the
+        run was planned, stay pending.
+
+        Args:
+            indexed (iterable): (path, fingerprint) of the versions in the index.
+            failed (iterable): The paths of the files that could not be indexed.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE files SET state = 'indexed' "
+                "WHERE path = ? AND fingerprint = ? AND state = 'pending'",
+                indexed,
+            )
+            self.connection.executemany(
+                "UPDATE files SET state = 'failed' WHERE path = ? AND state != 'missing'",
+                [(path,) for path in failed],
+            )
+
+    def counts(self):
+        """
+        Returns:
+            dict: The number of files in each state.
+        """
+        with self.lock:
+            return dict(
+                self.connection.execute(
+                    "SELECT state, COUNT(*) FROM files GROUP BY state"
+                )
+            )
@@ -0,0 +1,295 @@
+import sqlite3
+import threading
+import time
+
+
+class OCRBacklog:
+    """
+    The images waiting for OCR, kept on disk so that the OCR phase can run long after (and
+    separately from) the CLIP phase that made them searchable.
+
+    The CLIP phase adds every image it embeds as pending, with the text score of its prescreen
+    (see `Index.prescreen.TextPrescreen`); the OCR phase (see `Index.deferred_ocr.run_ocr`)
+    works through the pending items in the order they were added and marks each one as done
+    or failed. Pending items scored below the prescreen threshold are skipped; since the score
+    is kept, changing the threshold takes effect on items that are already queued. Rows of done
+    items are kept, so that a rerun can queue every image again and duplicates of an image whose
+    OCR is done are not queued.
+
+    A duplicate of an image that is still pending is recorded as a copy of it instead of being
+    queued (see `add_copies`): once the OCR of the source is done, its text is copied (see
+    `take_copies`). If the source changes, fails or is removed first, its copies are queued
+    themselves.
+
+    The backlog can be paused; the flag is stored in the database, so it survives restarts and
+    can be set from another process (e.g. `python create_index.py --pause-ocr` while the server
+    is indexing).
+
+    Args:
+        path (str): The path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS items (
+                    path TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT,
+                    queued REAL NOT NULL,
+                    score REAL
+                );
+                CREATE INDEX IF NOT EXISTS items_state ON items (state, queued);
+                CREATE TABLE IF NOT EXISTS copies (
+                    path TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    source_fingerprint TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS copies_source ON copies (source);
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                """)
+            columns = [
+                row[1] for row in self.connection.execute("PRAGMA table_info(items)")
+            ]
+            if "score" not in columns:
+                self.connection.execute("ALTER TABLE items ADD COLUMN score REAL")
+
+    def add(self, items):
+        """
+        Queues images for OCR, in a single transaction. Images already in the backlog become pending again.
+
+        Args:
+            items (iterable): (path, fingerprint) or (path, fingerprint, score) tuples. Without a
+                score, a queued image keeps the score it had; unscored images are never skipped.
+        """
+        items = list(items)
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """
+                INSERT INTO items (path, fingerprint, queued, score) VALUES (?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    fingerprint = excluded.fingerprint,
+                    state = 'pending',
+                    error = NULL,
+                    queued = excluded.queued,
+                    score = COALESCE(excluded.score, items.score)
+                """,
+                [
+                    (item[0], item[1], now, item[2] if len(item) > 2 else None)
+                    for item in items
+                ],
+            )
+            self.connection.executemany(
+                "DELETE FROM copies WHERE path = ?", [(item[0],) for item in items]
+            )
+            # Copies of the previous version of a source are not copies of this one
+            self._queue_copies(
+                "source = ? AND source_fingerprint != ?",
+                [(item[0], item[1]) for item in items],
+            )
+
+    def _queue_copies(self, where, params):
+        # Queues the copies matching `where` for OCR themselves; the caller holds the lock
+        rows = []
+        for values in params:
+            rows += self.connection.execute(
+                f"SELECT path, fingerprint FROM copies WHERE {where}", values
+            ).fetchall()
+            self.connection.execute(f"DELETE FROM copies WHERE {where}", values)
+        now = time.time()
+        self.connection.executemany(
+            """
+            INSERT INTO items (path, fingerprint, queued) VALUES (?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                fingerprint = excluded.fingerprint,
+                state = 'pending',
+                error = NULL,
+                queued = excluded.queued
+            """,
+            [(path, fingerprint, now) for path, fingerprint in rows],
+        )
+
+    def add_copies(self, items):
+        """
+        Records duplicates of pending items, which get the text of their source instead of OCR.
+
+        Args:
+            items (iterable): (path, fingerprint, source, source fingerprint) tuples, where the
+                source fingerprint is the one the source is queued with.
+        """
+        items = list(items)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO copies VALUES (?, ?, ?, ?)", items
+            )
+            self.connection.executemany(
+                "DELETE FROM items WHERE path = ?", [(item[0],) for item in items]
+            )
+
+    def take_copies(self, items):
+        """
+        Forgets the copies of processed items, for their text to be copied.
+
+        Args:
+            items (list): (path, fingerprint) of the processed items.
+
+        Returns:
+            list: (path, source) of their copies.
+        """
+        copies = []
+        with self.lock, self.connection:
+            for item in items:
+                copies += self.connection.execute(
+                    "SELECT path, source FROM copies "
+                    "WHERE source = ? AND source_fingerprint = ?",
+                    item,
+                ).fetchall()
+                self.connection.execute(
+                    "DELETE FROM copies WHERE source = ? AND source_fingerprint = ?",
+                    item,
+                )
+        return copies
+
+    def pending(self, min_score=None, limit=-1):
+        """
+        Args:
+            min_score (float, optional): Skip items scored below this. Defaults to None (no item is skipped).
+            limit (int, optional): The maximum number of items returned. Defaults to all of them.
+
+        Returns:
+            list: (path, fingerprint) of the pending items, oldest first.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, fingerprint FROM items WHERE state = 'pending' "
+                "AND (score IS NULL OR ? IS NULL OR score >= ?) "
+                "ORDER BY queued, rowid LIMIT ?",
+                (min_score, min_score, limit),
+            ).fetchall()
+
+    def states(self, paths, chunk_size=500):
+        """
+        Args:
+            paths (iterable): The paths to look up.
+            chunk_size (int, optional): The number of paths looked up per query.
+
+        Returns:
+            dict: The state and fingerprint of each path among `paths` that is in the backlog.
+        """
+        paths = list(paths)
+        found = {}
+        with self.lock:
+            for i in range(0, len(paths), chunk_size):
+                chunk = paths[i : i + chunk_size]
+                found.update(
+                    (row[0], (row[1], row[2]))
+                    for row in self.connection.execute(
+                        "SELECT path, state, fingerprint FROM items WHERE path IN "
+                        f"({', '.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+        return found
+
+    def complete(self, items):
+        """
+        Marks items as done, in a single transaction.
+
+        An item queued again with another fingerprint since it was read (its file changed while
+        the old version was processed) stays pending, so the new version is processed too.
+
+        Args:
+            items (list): (path, fingerprint) of the processed items.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE items SET state = 'done', error = NULL "
+                "WHERE path = ? AND fingerprint = ?",
+                items,
+            )
+
+    def fail(self, path, fingerprint, error):
+        """
+        Marks an item as failed, so it is not retried until it is queued again. Like in
+        `complete`, a newer version of the item stays pending.
+
+        Args:
+            path (str): The path of the item.
+            fingerprint (str): The fingerprint of the processed version.
+            error (str): What went wrong.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE items SET state = 'failed', error = ? "
+                "WHERE path = ? AND fingerprint = ?",
+                (str(error), path, fingerprint),
+            )
+            self._queue_copies(
+                "source = ? AND source_fingerprint = ?", [(path, fingerprint)]
+            )
+
+    def remove(self, paths):
+        """
+        Forgets items, e.g. because their file was deleted. Their copies are queued themselves.
+
+        Args:
+            paths (list): The paths of the items.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM items WHERE path = ?", [(path,) for path in paths]
+            )
+            self.connection.executemany(
+                "DELETE FROM copies WHERE path = ?", [(path,) for path in paths]
+            )
+            self._queue_copies("source = ?", [(path,) for path in paths])
+
+    def counts(self, min_score=None):
+        """
+        Args:
+            min_score (float, optional): Count pending items scored below this as "skipped". Defaults to None.
+
+        Returns:
+            dict: The number of items in each state.
+        """
+        with self.lock:
+            return dict(
+                self.connection.execute(
+                    "SELECT CASE WHEN state = 'pending' AND score < ? THEN 'skipped' "
+                    "ELSE state END AS shown, COUNT(*) FROM items GROUP BY shown",
+                    (min_score,),
+                )
+            )
+
+    def paused(self):
+        """
+        Returns:
+            bool: Whether the OCR phase is paused.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM settings WHERE key = 'paused'"
+            ).fetchone()
+        return row is not None and row[0] == "1"
+
+    def set_paused(self, paused):
+        """
+        Pauses or resumes the OCR phase. A running OCR phase stops after its current batch.
+
+        Args:
+            paused (bool): True to pause, False to resume.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('paused', ?)",
+                ("1" if paused else "0",),
+            )
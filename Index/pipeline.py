@@ -0,0 +1,170 @@
+import queue
+import threading
+import time
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of an indexing pipeline, run by a pool of worker threads.
+
+    Each worker takes a batch from the stage's input queue, applies `fn` to it and puts the
+    result on the next stage's input queue. Queues are bounded, so a slow stage blocks the
+    ones before it instead of letting batches pile up in memory.
+
+    Attributes:
+        name (str): The name shown in the throughput report.
+        fn (callable): Takes a batch (list of items) and returns the batch to pass on. Empty
+            batches are not passed on.
+        workers (int): The number of worker threads.
+        items (int): The number of items processed so far.
+        busy (float): The total time (seconds) workers spent inside `fn`.
+    """
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, int(workers))
+        self.items = 0
+        self.busy = 0.0
+        self.inbox = None
+        self.outbox = None
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self, pipeline):
+        self.threads = [
+            threading.Thread(target=self.run, args=(pipeline,), daemon=True)
+            for _ in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self, pipeline):
+        while True:
+            batch = pipeline.get(self.inbox)
+            if batch is _DONE or batch is None:
+                return
+            try:
+                start = time.perf_counter()
+                batch = self.fn(batch)
+                elapsed = time.perf_counter() - start
+            except BaseException as e:
+                pipeline.fail(self, e)
+                return
+            with self.lock:
+                self.items += len(batch)
+                self.busy += elapsed
+            if pipeline.duty_cycle < 1:
+                # Rest so that this worker only works `duty_cycle` of the time
+                pipeline.stopped.wait(elapsed * (1 / pipeline.duty_cycle - 1))
+            if not batch or self.outbox is None:
+                continue
+            if not pipeline.put(self.outbox, batch):
+                return
+
+
+class Pipeline:
+    """
+    Runs batches through a chain of stages connected by bounded queues.
+
+    Every stage works on a different batch at the same time, e.g. images of batch N+1 are
+    decoded while CLIP runs on batch N and batch N-1 is written to the database. At most
+    `queue_size` batches wait between two stages, which caps memory regardless of the
+    number of batches fed in.
+
+    With a `duty_cycle` below 1, each worker rests after every batch so that it works at most
+    that fraction of the time, e.g. to leave the machine responsive while indexing in the
+    background.
+
+    Args:
+        stages (list): The stages in processing order.
+        queue_size (int, optional): The maximum number of batches waiting between two stages. Defaults to 2.
+        duty_cycle (float, optional): The fraction of time each worker may work, in (0, 1]. Defaults to 1.
+    """
+
+    def __init__(self, stages, queue_size=2, duty_cycle=1.0):
+        self.stages = stages
+        self.duty_cycle = min(1.0, max(0.01, duty_cycle))
+        self.queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+        for i, stage in enumerate(stages):
+            stage.inbox = self.queues[i]
+            stage.outbox = self.queues[i + 1] if i + 1 < len(stages) else None
+        self.stopped = threading.Event()
+        self.error = None
+
+    def fail(self, stage, error):
+        if self.error is None:
+            self.error = (stage.name, error)
+        self.stopped.set()
+
+    def put(self, q, item):
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        while not self.stopped.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def run(self, batches):
+        """
+        Feeds `batches` through all stages and waits until the last one is done.
+
+        Args:
+            batches (iterable): The input batches (lists of items) for the first stage.
+
+        Raises:
+            RuntimeError: If a stage raised, with the original error as its cause.
+        """
+        start = time.perf_counter()
+        for stage in self.stages:
+            stage.start(self)
+
+        def feed():
+            try:
+                for batch in batches:
+                    if not self.put(self.queues[0], batch):
+                        return
+            except BaseException as e:
+                self.fail(Stage("feed", None), e)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        feeder.join()
+        # Once a stage has drained its input, tell each worker of the next one to stop
+        for stage in self.stages:
+            for _ in range(stage.workers):
+                self.put(stage.inbox, _DONE)
+            for thread in stage.threads:
+                thread.join()
+        self.elapsed = time.perf_counter() - start
+
+        if self.error is not None:
+            name, error = self.error
+            raise RuntimeError(f"Indexing stage '{name}' failed: {error}") from error
+
+    def report(self):
+        """
+        Prints the throughput of each stage, so the bottleneck can be spotted.
+
+        `busy` is the fraction of the run the stage's workers spent working; the stage
+        closest to 100% is the one limiting the pipeline.
+        """
+        print(f"{'stage':<8} {'workers':>7} {'items':>8} {'items/s':>9} {'busy':>6}")
+        for stage in self.stages:
+            rate = stage.items / stage.busy * stage.workers if stage.busy else 0
+            busy = stage.busy / (self.elapsed * stage.workers) if self.elapsed else 0
+            print(
+                f"{stage.name:<8} {stage.workers:>7} {stage.items:>8} {rate:>9.1f} {busy:>6.0%}"
+            )
@@ -0,0 +1,111 @@
+import json
+
+import numpy as np
+
+# Prompts describing images that are worth running OCR on
+default_text_prompts = [
+    "a document",
+    "a scanned page of text",
+    "a screenshot",
+    "a screenshot of a website",
+    "a photo of a sign with text",
+    "a receipt",
+    "a slide with text",
+    "a handwritten note",
+]
+# Prompts describing images that usually have no readable text
+default_other_prompts = [
+    "a photo",
+    "a photo of a person",
+    "a photo of a landscape",
+    "a photo of an animal",
+    "a photo of food",
+    "a photo of a building",
+    "a painting",
+    "an abstract pattern",
+]
+
+
+class TextPrescreen:
+    """
+    Estimates whether an image contains text from its CLIP embedding, so OCR can be skipped on photos.
+
+    The score of an image is a zero-shot classification: the softmax of its cosine similarity to
+    the text prompts ("a document", "a screenshot", ...) and the other prompts ("a photo", ...),
+    summed over the text prompts. It costs one matrix product on the embeddings CLIP already
+    computed. The prompt embeddings are computed once per CLIP model and cached in `cache_file`.
+
+    Args:
+        encode_text (callable): Returns the CLIP embedding of a text (e.g. `get_clip_text`).
+        model (str): Identifies the CLIP model, so cached prompt embeddings are not reused across models.
+        cache_file (str): The path to the JSON file prompt embeddings are cached in.
+        text_prompts (list, optional): Prompts for images with text. Defaults to `default_text_prompts`.
+        other_prompts (list, optional): Prompts for images without text. Defaults to `default_other_prompts`.
+        temperature (float, optional): Scales the similarities before the softmax, as CLIP's logit scale. Defaults to 100.
+    """
+
+    def __init__(
+        self,
+        encode_text,
+        model,
+        cache_file,
+        text_prompts=None,
+        other_prompts=None,
+        temperature=100.0,
+    ):
+        self.encode_text = encode_text
+        self.model = model
+        self.cache_file = cache_file
+        self.text_prompts = text_prompts or default_text_prompts
+        self.other_prompts = other_prompts or default_other_prompts
+        self.temperature = temperature
+        self._prompts = None
+
+    def prompt_embeddings(self):
+        """
+        Returns:
+            np.ndarray: The normalized embeddings of the text prompts followed by the other prompts.
+        """
+        if self._prompts is not None:
+            return self._prompts
+        prompts = self.text_prompts + self.other_prompts
+        try:
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        if cache.get("model") != self.model:
+            cache = {"model": self.model, "embeddings": {}}
+        missing = [prompt for prompt in prompts if prompt not in cache["embeddings"]]
+        for prompt in missing:
+            cache["embeddings"][prompt] = list(
+                np.asarray(self.encode_text(prompt), dtype=float).ravel()
+            )
+        if missing:
+            with open(self.cache_file, "w") as f:
+                json.dump(cache, f)
+        embeddings = np.array(
+            [cache["embeddings"][prompt] for prompt in prompts], dtype=np.float32
+        )
+        self._prompts = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return self._prompts
+
+    def scores(self, embeddings):
+        """
+        Args:
+            embeddings (list): CLIP image embeddings.
+
+        Returns:
+            np.ndarray: The probability that each image contains text, in [0, 1].
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(
+            len(embeddings), -1
+        )
+        embeddings = embeddings / np.maximum(
+            np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+        )
+        logits = self.temperature * embeddings @ self.prompt_embeddings().T
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        return probabilities[:, : len(self.text_prompts)].sum(axis=1)
@@ -0,0 +1,70 @@
+import threading
+import time
+
+
+class Progress:
+    """
+    The progress of indexing in this process, shared between the indexer and the server.
+
+    The indexer announces each phase (scanning, indexing, cleaning, watching) with `start` and
+    counts processed items with `advance`; the server reports `snapshot` over HTTP. All methods
+    are thread-safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase = "idle"
+        self.done = 0
+        self.total = None
+        self.started = None
+        self.error = None
+
+    def start(self, phase, total=None):
+        """
+        Args:
+            phase (str): The name of the phase.
+            total (int, optional): The number of items the phase will process, if known. Defaults to None.
+        """
+        with self.lock:
+            self.phase = phase
+            self.done = 0
+            self.total = total
+            self.started = time.time()
+            self.error = None
+
+    def advance(self, count=1):
+        with self.lock:
+            self.done += count
+
+    def fail(self, error):
+        with self.lock:
+            self.phase = "failed"
+            self.error = str(error)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The phase, items done and total, elapsed seconds, items per second, estimated
+            seconds left (None if unknown) and the error of a failed run.
+        """
+        with self.lock:
+            elapsed = time.time() - self.started if self.started else 0
+            rate = self.done / elapsed if elapsed else 0
+            eta = None
+            if self.total is not None and rate:
+                eta = max(0, self.total - self.done) / rate
+            return {
+                "phase": self.phase,
+                "done": self.done,
+                "total": self.total,
+                "elapsed": elapsed,
+                "rate": rate,
+                "eta": eta,
+                "error": self.error,
+            }
+
+
+# The progress of this process
+progress = Progress()
+# The progress of the OCR phase, which runs alongside the rest (see `Index.deferred_ocr`)
+ocr_progress = Progress()
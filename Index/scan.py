@@ -1,85 +1,145 @@
-from Index.scan_default import fast_scan_for_images
+from Index.scan_default import iter_images
+from Index.scan_cache import ScanCache
+from Index.manifest import Manifest
+from Index.progress import progress
 from concurrent.futures import ThreadPoolExecutor
-import yaml, csv
+import yaml
+import hashlib
+import os
 from tqdm import tqdm
-from PIL import Image
 
-
-def process_image(path):
-    try:
-        with Image.open(path) as img:
-            try:
-                first_channel = img.split()[0]
-                pixel_data = list(first_channel.getdata())
-            except AttributeError:
-                pixel_data = list(img.getdata())
-            total = sum(pixel_data)
-            num_pixels = len(pixel_data)
-            average = int(total / num_pixels)
-        return (path, average)
-    except Exception as e:
-        print(f"Error processing {path}: {e}")
-        return (path, 0)
+scan_cache_file = "Index/scan_cache.db"
+# The scanned files, handed from the scanner to the indexer
+manifest_file = "Index/manifest.db"
 
 
-def save_to_csv(image_paths, filename="paths.csv", save_average=False):
+def hash_file_ends(path, size, hash_bytes=64 * 1024):
     """
-    Saves the paths and, optionally, average pixel values of images to a CSV file.
+    Computes a quick content hash of a file from its size and its first and last bytes.
+
+    Only up to `2 * hash_bytes` are read, so this stays cheap for large images while still
+    catching edits that keep the size and modification time unchanged.
 
     Args:
-        image_paths (list): A list of image file paths to process.
-        filename (str, optional): The name of the CSV file to save. Defaults to "image_paths.csv".
-        save_average (bool, optional): If True, saves the average pixel value of images. If False, does not save the average. Defaults to False.
+        path (str): The path to the file.
+        size (int): The size of the file in bytes.
+        hash_bytes (int, optional): The number of bytes read from each end of the file. Defaults to 64 KB.
+
+    Returns:
+        str: A 16 character hex digest.
     """
-    with open(filename, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["path", "average"])
-        # Handle backslashes in Windows paths
-        image_paths = [path.replace("\\", "/") for path in image_paths]
-        image_paths = list(set(image_paths))
-
-        if save_average:
-            with ThreadPoolExecutor() as executor:
-                results = list(
-                    tqdm(
-                        executor.map(process_image, image_paths), total=len(image_paths)
-                    )
-                )
-            for result in results:
-                writer.writerow(result)
-        else:
-            for path in tqdm(image_paths):
-                writer.writerow([path, 0])
+    digest = hashlib.blake2b(str(size).encode(), digest_size=8)
+    with open(path, "rb") as f:
+        digest.update(f.read(hash_bytes))
+        if size > hash_bytes:
+            f.seek(max(hash_bytes, size - hash_bytes))
+            digest.update(f.read(hash_bytes))
+    return digest.hexdigest()
 
-    print(f"Image paths{' and averages' if save_average else ''} saved to {filename}")
+
+def get_fingerprint(path, content_hash=False, stat=None):
+    """
+    Computes a change-detection fingerprint for a file without decoding it.
+
+    By default the fingerprint is built from a single `stat` call: size, modification time (ns),
+    device and inode. With `content_hash`, the fingerprint is the size plus a hash of the first
+    and last bytes of the file instead, for filesystems where modification times are unreliable.
+
+    Args:
+        path (str): The path to the file.
+        content_hash (bool, optional): If True, fingerprint the file content instead of its stat. Defaults to False.
+        stat (os.stat_result, optional): The stat of the file, if already known. Defaults to None.
+
+    Returns:
+        str: The fingerprint, or an empty string if the file could not be read.
+    """
+    try:
+        if stat is None:
+            stat = os.stat(path)
+        if content_hash:
+            return f"{stat.st_size}:{hash_file_ends(path, stat.st_size)}"
+        return f"{stat.st_size}:{stat.st_mtime_ns}:{stat.st_dev}:{stat.st_ino}"
+    except OSError as e:
+        print(f"Error processing {path}: {e}")
+        return ""
 
 
-def read_from_csv(filename="paths.csv"):
+def file_record(path, content_hash=False):
     """
-    Reads image paths and, optionally, their average pixel values from a CSV file.
+    Stats a file once and builds its manifest row.
 
     Args:
-        filename (str, optional): The name of the CSV file to read from. Defaults to "image_paths.csv".
+        path (str): The path to the file.
+        content_hash (bool, optional): If True, the fingerprint is a content hash (see `get_fingerprint`). Defaults to False.
 
     Returns:
-        tuple: Depending on read_average, returns a tuple containing one or two lists: one of the image paths and, if read_average is True, one of their average pixel values.
+        tuple: (path, size, mtime_ns, fingerprint), or None if the file could not be read.
     """
-    paths = []
-    averages = []
-    with open("Index/paths.csv", "r", newline="", encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in tqdm(reader):
-            paths.append(row["path"])
-            averages.append(int(row["average"]))
-    return (paths, averages)
+    try:
+        stat = os.stat(path)
+        return (
+            path,
+            stat.st_size,
+            stat.st_mtime_ns,
+            get_fingerprint(path, content_hash, stat),
+        )
+    except OSError as e:
+        print(f"Error processing {path}: {e}")
+        return None
 
 
-def scan_and_save():
+def save_to_manifest(image_paths, manifest, content_hash=False, chunk_size=10000):
     """
-    Scans for images based on the configuration specified in 'config.yaml' and saves the paths to a CSV file.
+    Fingerprints image paths as they are found and writes them to the manifest in chunks.
+
+    Paths are consumed lazily, so fingerprinting overlaps with a streaming scan and only one chunk
+    of paths is held in memory.
+
+    Args:
+        image_paths (iterable): The image file paths to record.
+        manifest (Manifest): The manifest to write to, with a scan begun.
+        content_hash (bool, optional): If True, fingerprints are content hashes instead of stat fingerprints (see `get_fingerprint`). Defaults to False.
+        chunk_size (int, optional): The number of paths fingerprinted and written at a time. Defaults to 10000.
+
+    Returns:
+        int: The number of files recorded.
+    """
+    recorded = 0
+
+    def write(chunk, executor):
+        rows = executor.map(lambda path: file_record(path, content_hash), chunk)
+        rows = [row for row in rows if row is not None]
+        manifest.record(rows)
+        return len(rows)
+
+    with ThreadPoolExecutor() as executor, tqdm(
+        desc="Scanning and fingerprinting images", unit=" images"
+    ) as pbar:
+        chunk = []
+        for path in image_paths:
+            # Handle backslashes in Windows paths
+            chunk.append(path.replace("\\", "/"))
+            if len(chunk) >= chunk_size:
+                recorded += write(chunk, executor)
+                pbar.update(len(chunk))
+                progress.advance(len(chunk))
+                chunk = []
+        recorded += write(chunk, executor)
+        pbar.update(len(chunk))
+        progress.advance(len(chunk))
+    return recorded
+
+
+def scan_and_save(full_scan=False):
+    """
+    Scans for images based on the configuration specified in 'config.yaml' and records them in the manifest (see `Manifest`).
 
     The function supports two scanning methods: 'default' and 'Everything'. The 'default' method uses specified
     include and exclude directories to find images, while the 'Everything' method utilizes the Everything SDK for scanning.
+    The 'default' method only lists directories that changed since the last scan, unless `full_scan` is set.
+
+    Args:
+        full_scan (bool, optional): If True, list every directory again instead of reusing unchanged listings. Defaults to False.
 
     Returns:
         bool: True if the scan and save operation was successful, False otherwise.
@@ -88,6 +148,7 @@ def scan_and_save():
         with open("config.yaml", "r") as f:
             config = yaml.safe_load(f)
 
+        progress.start("scanning")
         if config["scan_method"] == "default":
             include_dirs = config["include_directories"]
             exclude_dirs = config["exclude_directories"]
@@ -95,7 +156,12 @@ def scan_and_save():
                 include_dirs = None
                 print("No directories to include")
                 return False
-            paths, _ = fast_scan_for_images(include_dirs, exclude_dirs)
+            cache = ScanCache(scan_cache_file)
+            if full_scan:
+                cache.clear()
+            paths = iter_images(
+                include_dirs, exclude_dirs, config.get("scan_workers"), cache
+            )
         elif config["scan_method"] == "Everything":
             from Index.scan_EverythingSDK import search_EverythingSDK
 
@@ -104,7 +170,16 @@ def scan_and_save():
             print("Error in config.yaml: scan_method must be 'default' or 'Everything'")
             return False
 
-        save_to_csv(paths, "Index/paths.csv", config["deep_scan"])
+        manifest = Manifest(manifest_file)
+        manifest.begin_scan()
+        recorded = save_to_manifest(paths, manifest, config.get("content_hash", False))
+        manifest.finish_scan()
+        print(f"{recorded} image paths and fingerprints saved to {manifest_file}")
+        if config["scan_method"] == "default":
+            print(
+                f"Listed {cache.listed} directories, reused {cache.reused} unchanged ones "
+                f"({cache.reused_entries} entries not listed again)"
+            )
         return True
     except Exception as e:
         print(f"An error occurred: {e}")
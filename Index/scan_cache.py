@@ -0,0 +1,132 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class ScanCache:
+    """
+    Remembers the listing of every scanned directory, so that a rescan only re-lists directories that changed.
+
+    Adding, removing or renaming an entry updates the modification time of its directory, so a
+    directory whose mtime is the same as when it was listed still has the same entries. Its
+    cached listing (entry count, subdirectories and image files) is reused, and a warm rescan
+    costs one `stat` per directory instead of a `scandir` of every entry. Directories modified
+    less than `racy_window` before they were listed are always re-listed, since on filesystems
+    with coarse timestamps (FAT: 2 s) a later change could keep the same mtime.
+
+    Changes to the content of a file do not touch its directory; they are caught by the file
+    fingerprints, not by the scan.
+
+    Args:
+        path (str): The path to the SQLite database file.
+    """
+
+    racy_window = 2 * 10**9
+    flush_size = 5000
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    listed_ns INTEGER NOT NULL,
+                    entries INTEGER NOT NULL,
+                    listing TEXT NOT NULL
+                )
+                """)
+        self.updates = []
+        self.visited = []
+        self.listed = 0
+        self.reused = 0
+        self.reused_entries = 0
+
+    def lookup(self, path, mtime_ns):
+        """
+        Returns the cached listing of a directory if it has not changed since it was listed.
+
+        Args:
+            path (str): The path of the directory.
+            mtime_ns (int): The current modification time of the directory (ns).
+
+        Returns:
+            tuple: (entries, subdirectories, files, linked) as stored by `store`, or None if the directory must be listed.
+        """
+        self.visited.append(path)
+        # Each walker thread reads through its own connection
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path)
+        row = connection.execute(
+            "SELECT mtime_ns, listed_ns, entries, listing FROM directories WHERE path = ?",
+            (path,),
+        ).fetchone()
+        if row is None or row[0] != mtime_ns or row[1] - mtime_ns < self.racy_window:
+            return None
+        with self.lock:
+            self.reused += 1
+            self.reused_entries += row[2]
+        return (row[2], *json.loads(row[3]))
+
+    def store(self, path, mtime_ns, listing):
+        """
+        Records the listing of a directory that was just listed.
+
+        Args:
+            path (str): The path of the directory.
+            mtime_ns (int): The modification time of the directory (ns) before it was listed.
+            listing (tuple): (entries, subdirectories, files, linked): the number of entries, the
+                names of the subdirectories, (name, inode) of the image files and
+                (name, device, inode) of the symlinked image files.
+        """
+        row = (path, mtime_ns, time.time_ns(), listing[0], json.dumps(listing[1:]))
+        with self.lock:
+            self.listed += 1
+            self.updates.append(row)
+            if len(self.updates) < self.flush_size:
+                return
+            updates, self.updates = self.updates, []
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)", updates
+                )
+
+    def save(self, prune=True):
+        """
+        Writes the pending listings, and forgets directories that were not visited by this scan.
+
+        Args:
+            prune (bool, optional): Whether to forget unvisited directories; only correct after a complete scan. Defaults to True.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)",
+                self.updates,
+            )
+            self.updates = []
+            if prune:
+                self.connection.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS visited (path TEXT PRIMARY KEY)"
+                )
+                self.connection.execute("DELETE FROM visited")
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO visited VALUES (?)",
+                    [(path,) for path in self.visited],
+                )
+                self.connection.execute(
+                    "DELETE FROM directories WHERE path NOT IN (SELECT path FROM visited)"
+                )
+            self.visited = []
+
+    def clear(self):
+        """
+        Forgets every listing, so that the next scan lists every directory.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM directories")
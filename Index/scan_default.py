@@ -1,10 +1,335 @@
 import os
 import time
-import csv
-from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import threading
+from fnmatch import fnmatch
 from tqdm import tqdm
 
+image_extensions = (".jpg", ".jpeg", ".png", ".gif", ".bmp")
+
+# Marks the end of the walk in the output queue
+_DONE = object()
+
+
+class ExcludeMatcher:
+    """
+    Decides which directories and files to skip, compiled once from the exclude list.
+
+    Each entry of `exclude_directories` is either:
+
+    - A directory path: the directory and everything below it is skipped. Since the walk goes top
+      down and never enters a skipped directory, a set lookup per directory is enough.
+    - A `.gitignore`-style pattern (contains `*`, `?` or `[`, or is a bare name like `node_modules`):
+      patterns without a slash match entry names at any depth, patterns with a slash match the full
+      path, and a trailing slash restricts the pattern to directories.
+
+    Args:
+        exclude_directories (list): Directory paths and patterns to exclude.
+    """
+
+    def __init__(self, exclude_directories):
+        self.directories = set()
+        self.name_patterns = []
+        self.path_patterns = []
+        for exclude in exclude_directories:
+            dir_only = exclude.endswith(("/", "\\")) and len(exclude) > 1
+            pattern = exclude.rstrip("/\\") if dir_only else exclude
+            is_pattern = any(char in pattern for char in "*?[")
+            if not is_pattern and os.sep not in pattern and "/" not in pattern:
+                # A bare name, e.g. "node_modules"
+                is_pattern = True
+            if not is_pattern:
+                self.directories.add(self.normalize(pattern))
+            elif "/" in pattern or os.sep in pattern:
+                self.path_patterns.append((pattern.replace("\\", "/"), dir_only))
+            else:
+                self.name_patterns.append((pattern, dir_only))
+
+    @staticmethod
+    def normalize(path):
+        return os.path.normcase(os.path.normpath(path))
+
+    def excluded(self, path, name, is_dir):
+        """
+        Args:
+            path (str): The path of the entry.
+            name (str): The name of the entry.
+            is_dir (bool): Whether the entry is a directory.
+
+        Returns:
+            bool: True if the entry should be skipped.
+        """
+        if is_dir and self.normalize(path) in self.directories:
+            return True
+        for pattern, dir_only in self.name_patterns:
+            if (is_dir or not dir_only) and fnmatch(name, pattern):
+                return True
+        if self.path_patterns:
+            path = path.replace("\\", "/")
+            for pattern, dir_only in self.path_patterns:
+                if (is_dir or not dir_only) and fnmatch(path, pattern):
+                    return True
+        return False
+
+    def path_excluded(self, path):
+        """
+        Checks a path and every directory above it, for paths that were not found by a walk
+        (e.g. paths from file system events).
+
+        Args:
+            path (str): The path of a file.
+
+        Returns:
+            bool: True if the file or one of its directories is excluded.
+        """
+        current, is_dir = os.path.normpath(path), False
+        while True:
+            parent, name = os.path.split(current)
+            if not name:
+                return False
+            if self.excluded(current, name, is_dir):
+                return True
+            current, is_dir = parent, True
+
+    def root_excluded(self, root):
+        """
+        Returns:
+            bool: True if `root` is inside (or is) an excluded directory.
+        """
+        root = self.normalize(root)
+        return any(
+            os.path.commonpath([root, excluded]) == excluded
+            for excluded in self.directories
+        )
+
+
+def list_directory(directory):
+    """
+    Lists the subdirectories and image files of one directory.
+
+    Args:
+        directory (str): The directory to list.
+
+    Returns:
+        tuple: (entries, subdirectories, files, linked): the number of entries, the names of the
+            subdirectories, (name, inode) of the image files and (name, device, inode) of the
+            image files that are symlinks, identified by their target.
+    """
+    entries = 0
+    subdirectories = []
+    files = []
+    linked = []
+    with os.scandir(directory) as iterator:
+        for entry in iterator:
+            entries += 1
+            name = entry.name
+            try:
+                if entry.is_dir():
+                    subdirectories.append(name)
+                elif (
+                    name.lower().endswith(image_extensions)
+                    and not name.startswith("._")
+                    and entry.is_file()
+                ):
+                    if entry.is_symlink():
+                        stat = entry.stat()
+                        linked.append((name, stat.st_dev, stat.st_ino))
+                    else:
+                        files.append((name, entry.inode()))
+            except OSError:
+                pass
+    return entries, subdirectories, files, linked
+
+
+def iter_images(directories, exclude_directories=None, workers=None, cache=None):
+    """
+    Walks directories in parallel and yields image paths as they are found.
+
+    Each worker thread walks depth first from its own stack of directories. When a worker runs
+    out of directories it waits on a shared list, and busy workers move the oldest half of their
+    stack there (the shallowest, hence usually largest, subtrees). Work is therefore only handed
+    over when someone is idle, so a single deep root keeps every worker busy without a queue
+    round trip per directory.
+
+    Directories are de-duplicated by (device, inode), which avoids symlink loops, and files too,
+    so hard links and symlinks to the same image are only yielded once. On file systems that
+    report inode 0 for everything (some FUSE, SMB and FAT mounts), paths are used instead.
+
+    With a `cache`, directories whose modification time has not changed since the last scan are
+    not listed again (see `ScanCache`).
+
+    Args:
+        directories (list): The directories to scan.
+        exclude_directories (list, optional): Directories and patterns to exclude (see `ExcludeMatcher`). Defaults to None.
+        workers (int, optional): The number of worker threads. Defaults to the number of CPUs.
+        cache (ScanCache, optional): Listings of previous scans, updated by this one. Defaults to None.
+
+    Yields:
+        str: The paths of the image files found.
+    """
+    matcher = ExcludeMatcher(exclude_directories or [])
+    check_excludes = bool(exclude_directories)
+    workers = workers or os.cpu_count() or 4
+    results = queue.Queue(maxsize=64)
+    stopped = threading.Event()
+    # Guards everything below; idle workers wait on it for shared directories
+    lock = threading.Condition()
+    shared = []
+    seen_directories = set()
+    # Inodes of the files yielded so far, by device
+    seen_files = {}
+    # Directories found but not scanned yet, and workers waiting for work
+    state = {"pending": 0, "idle": 0}
+
+    def first_visits(candidates):
+        # Called with the lock held
+        new = []
+        for key, value in candidates:
+            if key not in seen_directories:
+                seen_directories.add(key)
+                new.append(value)
+        return new
+
+    def first_file_visits(device, files, linked):
+        # Called with the lock held. Set operations on whole directories keep this cheap
+        # for millions of files.
+        inodes = seen_files.setdefault(device, set())
+        new = files.keys() - inodes
+        inodes.update(new)
+        if len(new) == len(files):
+            paths = list(files.values())
+        else:
+            paths = [files[inode] for inode in new]
+        for device, inode, path in linked:
+            inodes = seen_files.setdefault(device, set())
+            if inode not in inodes:
+                inodes.add(inode)
+                paths.append(path)
+        return paths
+
+    def scan(directory, device, mtime_ns):
+        listing = cache.lookup(directory, mtime_ns) if cache is not None else None
+        if listing is None:
+            try:
+                listing = list_directory(directory)
+            except OSError:
+                # Permission denied, vanished directory, ...
+                return [], {}, []
+            if cache is not None:
+                cache.store(directory, mtime_ns, listing)
+        _, names, image_files, linked_files = listing
+        prefix = directory if directory.endswith(os.sep) else directory + os.sep
+
+        subdirectories = []
+        for name in names:
+            path = prefix + name
+            if check_excludes and matcher.excluded(path, name, True):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            subdirectories.append(
+                (
+                    (stat.st_dev, stat.st_ino or path),
+                    (path, stat.st_dev, stat.st_mtime_ns),
+                )
+            )
+        # Files of this directory by inode, and symlinked files as (device, inode, path). An
+        # inode of 0 means the file system has none, the path is the key then.
+        files = {}
+        for name, inode in image_files:
+            path = prefix + name
+            if not (check_excludes and matcher.excluded(path, name, False)):
+                files[inode or path] = path
+        linked = []
+        for name, link_device, inode in linked_files:
+            path = prefix + name
+            if not (check_excludes and matcher.excluded(path, name, False)):
+                linked.append((link_device, inode or path, path))
+        return subdirectories, files, linked
+
+    def emit(found):
+        while not stopped.is_set():
+            try:
+                results.put(found, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        stack = []
+        found = []
+        while True:
+            if not stack:
+                if found and not emit(found):
+                    return
+                found = []
+                with lock:
+                    while not shared and state["pending"] and not stopped.is_set():
+                        state["idle"] += 1
+                        lock.wait(0.1)
+                        state["idle"] -= 1
+                    if not shared or stopped.is_set():
+                        return
+                    stack.append(shared.pop())
+            directory, device, mtime_ns = stack.pop()
+            subdirectories, files, linked = scan(directory, device, mtime_ns)
+            with lock:
+                subdirectories = first_visits(subdirectories)
+                found.extend(first_file_visits(device, files, linked))
+                stack.extend(subdirectories)
+                state["pending"] += len(subdirectories) - 1
+                if state["idle"] and len(stack) > 1:
+                    half = len(stack) // 2
+                    shared.extend(stack[:half])
+                    del stack[:half]
+                    lock.notify(state["idle"])
+                elif not state["pending"]:
+                    lock.notify_all()
+            if len(found) >= 1000:
+                if not emit(found):
+                    return
+                found = []
+
+    with lock:
+        for directory in directories:
+            directory = os.path.normpath(directory)
+            if matcher.root_excluded(directory):
+                continue
+            try:
+                stat = os.stat(directory)
+            except OSError:
+                continue
+            key = (stat.st_dev, stat.st_ino or directory)
+            shared.extend(
+                first_visits([(key, (directory, stat.st_dev, stat.st_mtime_ns))])
+            )
+        state["pending"] = len(shared)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    def finish():
+        for thread in threads:
+            thread.join()
+        if cache is not None:
+            cache.save(prune=not stopped.is_set())
+        emit(_DONE)
+
+    threading.Thread(target=finish, daemon=True).start()
+    try:
+        while True:
+            found = results.get()
+            if found is _DONE:
+                return
+            yield from found
+    finally:
+        # Also stops the workers when the caller stops iterating early
+        stopped.set()
+
 
 def scan_directory(directory, exclude_directories):
     """
@@ -12,69 +337,39 @@ def scan_directory(directory, exclude_directories):
 
     Args:
         directory (str): The directory to scan for image files.
-        exclude_directories (list): A list of directories to exclude from the scan.
+        exclude_directories (list): A list of directories (or patterns) to exclude from the scan.
 
     Returns:
         list: A list of paths to image files found within the directory, excluding those in excluded directories.
     """
-    image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp"}
-    images = []
-    try:
-        with os.scandir(directory) as entries:
-            for entry in entries:
-                if (
-                    entry.is_file()
-                    and not entry.name.startswith("._")
-                    and entry.name.lower().endswith(tuple(image_extensions))
-                ):
-                    images.append(entry.path)
-                elif entry.is_dir():
-                    # Check if this directory is in the exclude list
-                    if not any(
-                        os.path.commonpath([entry.path, excl]) == excl
-                        for excl in exclude_directories
-                    ):
-                        images.extend(scan_directory(entry.path, exclude_directories))
-    except PermissionError:
-        # print(f"Permission denied: {directory}")
-        pass
-    except Exception as e:
-        # print(f"Error scanning {directory}: {e}")
-        pass
-    return images
-
-
-def fast_scan_for_images(directories, exclude_directories=None):
+    return list(iter_images([directory], exclude_directories))
+
+
+def fast_scan_for_images(
+    directories, exclude_directories=None, workers=None, cache=None
+):
     """
     Scans multiple directories for image files in parallel, excluding specified directories.
 
     Args:
         directories (list): A list of directories to scan for image files.
-        exclude_directories (list, optional): Directories to exclude from the scan. Defaults to None.
+        exclude_directories (list, optional): Directories (or patterns) to exclude from the scan. Defaults to None.
+        workers (int, optional): The number of worker threads. Defaults to the number of CPUs.
+        cache (ScanCache, optional): Listings of previous scans; unchanged directories are not listed again. Defaults to None.
 
     Returns:
         tuple: A tuple containing a list of image paths found and the total time taken to scan.
     """
-    if exclude_directories is None:
-        exclude_directories = []
-
     start_time = time.time()
     all_images = []
-
-    with tqdm(total=len(directories), desc="Scanning directories") as pbar:
-        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-            future_to_dir = {
-                executor.submit(scan_directory, dir, exclude_directories): dir
-                for dir in directories
-            }
-            for future in as_completed(future_to_dir):
-                dir = future_to_dir[future]
-                try:
-                    images = future.result()
-                    all_images.extend(images)
-                    pbar.update()
-                except Exception as e:
-                    print(f"Error processing {dir}: {e}")
-
+    with tqdm(desc="Scanning directories", unit=" images") as pbar:
+        for path in iter_images(directories, exclude_directories, workers, cache):
+            all_images.append(path)
+            pbar.update()
     end_time = time.time()
+    if cache is not None:
+        print(
+            f"Listed {cache.listed} directories, reused {cache.reused} unchanged ones "
+            f"({cache.reused_entries} entries not listed again)"
+        )
     return all_images, end_time - start_time
@@ -0,0 +1,142 @@
+import hashlib
+from io import BytesIO
+from PIL import Image
+
+
+def reduce_on_load(image, min_size):
+    """
+    Asks the decoder of a not yet loaded image for a reduced resolution.
+
+    JPEGs are decoded with DCT scaling (draft mode) and JPEG 2000 images at a lower
+    resolution level, both picking the smallest size whose short side is still at least
+    `min_size`. Other formats have no reduced decode and are left unchanged.
+
+    Args:
+        image (PIL.Image.Image): An image returned by `Image.open`, before `load`.
+        min_size (int): The smallest short side (px) the consumer needs.
+
+    Returns:
+        PIL.Image.Image: The same image, for chaining.
+    """
+    if image.format == "JPEG":
+        image.draft(None, (min_size, min_size))
+    elif image.format == "JPEG2000":
+        short = min(image.size)
+        factor = 0
+        while short >> (factor + 1) >= min_size:
+            factor += 1
+        image.reduce = factor
+    return image
+
+
+def open_image(source, min_size=None):
+    """
+    Opens an image, decoding it at reduced resolution when `min_size` is given (see `reduce_on_load`).
+
+    Args:
+        source (str or file object): The path to the image file or a file object.
+        min_size (int, optional): The smallest short side (px) the consumer needs. Defaults to None (full resolution).
+
+    Returns:
+        PIL.Image.Image: The opened image.
+    """
+    image = Image.open(source)
+    if min_size:
+        reduce_on_load(image, min_size)
+    return image
+
+
+class SharedImage:
+    """
+    An image file that is read and decoded once, then shared by every consumer in an indexing pass.
+
+    The raw bytes are read once and decoded once. Each consumer (CLIP, OCR, ...) derives its own
+    input from the decoded image through `view`, which caches the result under a name. Once all
+    views exist, `release` drops the raw bytes and the full resolution image so that only the
+    (much smaller) derived views stay in memory.
+
+    CLIP and OCR providers accept a SharedImage anywhere they accept an image path.
+
+    Attributes:
+        path (str): The path to the image file.
+        min_size (int): The smallest short side (px) any view needs; formats that support it are
+            decoded at a reduced resolution (see `reduce_on_load`). None decodes at full resolution.
+        data (bytes): The raw file content, None before `read` and after decoding.
+        views (dict): The derived views, keyed by name.
+    """
+
+    def __init__(self, path, min_size=None):
+        self.path = path
+        self.min_size = min_size
+        self.data = None
+        self.views = {}
+        self._image = None
+
+    def read(self):
+        """
+        Reads the raw bytes of the file.
+
+        Returns:
+            SharedImage: self, for chaining.
+        """
+        with open(self.path, "rb") as f:
+            self.data = f.read()
+        return self
+
+    def digest(self):
+        """
+        Hashes the full raw content of the file, e.g. to find byte-identical copies.
+
+        Must be called before the image is decoded, since decoding drops the raw bytes.
+
+        Returns:
+            str: A 32 character hex digest.
+        """
+        if self.data is None:
+            self.read()
+        return hashlib.blake2b(self.data, digest_size=16).hexdigest()
+
+    @property
+    def image(self):
+        """
+        The decoded image, decoded on first access (at reduced resolution if `min_size` is set).
+        """
+        if self._image is None:
+            if self.data is None:
+                self.read()
+            image = open_image(BytesIO(self.data), self.min_size)
+            image.load()
+            self._image = image
+            self.data = None
+        return self._image
+
+    def view(self, name, fn):
+        """
+        Returns a derived view of the image, computing it with `fn(image)` on first access.
+
+        Args:
+            name (str): The name the view is cached under.
+            fn (callable): Takes the decoded PIL image and returns the view.
+
+        Returns:
+            The cached view.
+        """
+        if name not in self.views:
+            self.views[name] = fn(self.image)
+        return self.views[name]
+
+    def release(self, name=None):
+        """
+        Frees memory held by the image.
+
+        Without a name, drops the raw bytes and the full resolution image; views that were
+        already derived are kept. With a name, drops that view instead.
+
+        Args:
+            name (str, optional): The view to drop. Defaults to None.
+        """
+        if name is None:
+            self.data = None
+            self._image = None
+        else:
+            self.views.pop(name, None)
@@ -0,0 +1,519 @@
+import os
+import threading
+import time
+
+from Index.create_db import (
+    config,
+    copy_embeddings,
+    delete_ids,
+    embed_paths,
+    journal_file,
+    open_ocr_backlog,
+    page_size,
+    refresh_entries,
+    tombstone_grace,
+    tombstone_ids,
+    unavailable_roots,
+)
+from Index.journal import Journal
+from Index.manifest import Manifest
+from Index.progress import progress
+from Index.scan import file_record, manifest_file, save_to_manifest, scan_cache_file
+from Index.scan_cache import ScanCache
+from Index.scan_default import ExcludeMatcher, image_extensions, iter_images
+
+# Settle time, maximum delay and polling settings of the watch mode
+watch_config = config.get("watch", {})
+content_hash = config.get("content_hash", False)
+
+
+def is_image(path):
+    name = os.path.basename(path)
+    return name.lower().endswith(image_extensions) and not name.startswith("._")
+
+
+def normalize(path):
+    # Handle backslashes in Windows paths, like the scanner
+    return path.replace("\\", "/")
+
+
+class ChangeBatcher:
+    """
+    Coalesces file system events into batches of changes.
+
+    Events usually come in bursts: a file being written is modified many times, and an import
+    from a camera creates thousands of files. Events are collected until none arrived for
+    `settle` seconds, or at most for `max_delay` seconds, so a long import is still indexed in
+    regular batches. Within a batch only the last state of each path counts: a file created and
+    then deleted is not indexed, and a file created and then moved is indexed at its destination.
+
+    Args:
+        settle (float): Seconds without events after which a batch is ready.
+        max_delay (float): Seconds after the first event of a batch after which it is ready anyway.
+    """
+
+    def __init__(self, settle=2, max_delay=10):
+        self.settle = settle
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        # Files to index, files to remove and destination -> source of moved files
+        self.index = set()
+        self.delete = set()
+        self.moves = {}
+        # Directories created (to walk) and deleted (to remove every file below)
+        self.index_directories = set()
+        self.delete_directories = set()
+        self.first = None
+        self.last = None
+
+    def touch(self):
+        # Called with the condition held
+        self.last = time.monotonic()
+        if self.first is None:
+            self.first = self.last
+        self.condition.notify()
+
+    def add_index(self, path):
+        with self.condition:
+            self.delete.discard(path)
+            self.index.add(path)
+            self.touch()
+
+    def add_delete(self, path):
+        with self.condition:
+            self.index.discard(path)
+            source = self.moves.pop(path, None)
+            if source is not None:
+                self.delete.add(source)
+            self.delete.add(path)
+            self.touch()
+
+    def add_move(self, source, destination):
+        with self.condition:
+            self.delete.discard(destination)
+            if source in self.index:
+                # Not indexed yet, index it at its destination
+                self.index.discard(source)
+                self.index.add(destination)
+            else:
+                self.moves[destination] = self.moves.pop(source, source)
+            self.touch()
+
+    def add_directory(self, path, deleted=False):
+        with self.condition:
+            if deleted:
+                self.delete_directories.add(path)
+            else:
+                self.index_directories.add(path)
+            self.touch()
+
+    def wait(self):
+        """
+        Blocks until a batch is ready.
+
+        Returns:
+            dict: The changes of the batch: "index", "delete", "moves", "index_directories" and "delete_directories".
+        """
+        with self.condition:
+            while True:
+                if self.first is not None:
+                    now = time.monotonic()
+                    ready = min(
+                        self.last + self.settle - now,
+                        self.first + self.max_delay - now,
+                    )
+                    if ready <= 0:
+                        break
+                    self.condition.wait(ready)
+                else:
+                    self.condition.wait()
+            changes = {
+                "index": self.index,
+                "delete": self.delete,
+                "moves": self.moves,
+                "index_directories": self.index_directories,
+                "delete_directories": self.delete_directories,
+            }
+            self.reset()
+            return changes
+
+
+class EventHandler:
+    """
+    Turns watchdog events on image files into changes for a `ChangeBatcher`.
+
+    Only the `dispatch` method is needed by watchdog observers, so this does not subclass
+    `watchdog.events.FileSystemEventHandler` and the module imports without watchdog.
+
+    Args:
+        batcher (ChangeBatcher): Where changes are collected.
+        matcher (ExcludeMatcher): The excluded directories and patterns.
+    """
+
+    def __init__(self, batcher, matcher):
+        self.batcher = batcher
+        self.matcher = matcher
+
+    def wanted(self, path):
+        return is_image(path) and not self.matcher.path_excluded(path)
+
+    def dispatch(self, event):
+        src = event.src_path
+        if isinstance(src, bytes):
+            src = os.fsdecode(src)
+        if event.event_type == "moved":
+            dest = event.dest_path
+            if isinstance(dest, bytes):
+                dest = os.fsdecode(dest)
+            if event.is_directory:
+                # Files below are indexed again, mostly by copying the embeddings of identical
+                # files (see `apply_changes`)
+                self.batcher.add_directory(normalize(src), deleted=True)
+                if not self.matcher.path_excluded(dest):
+                    self.batcher.add_directory(normalize(dest))
+            elif getattr(event, "is_synthetic", False):
+                # Generated for the files of a moved directory, handled above
+                return
+            elif self.wanted(src) and self.wanted(dest):
+                self.batcher.add_move(normalize(src), normalize(dest))
+            elif self.wanted(dest):
+                self.batcher.add_index(normalize(dest))
+            elif self.wanted(src):
+                self.batcher.add_delete(normalize(src))
+        elif event.event_type == "deleted":
+            if event.is_directory:
+                self.batcher.add_directory(normalize(src), deleted=True)
+            elif is_image(src):
+                self.batcher.add_delete(normalize(src))
+        elif event.event_type in ("created", "modified", "closed"):
+            if event.is_directory:
+                if event.event_type == "created" and not self.matcher.path_excluded(
+                    src
+                ):
+                    self.batcher.add_directory(normalize(src))
+            elif self.wanted(src):
+                self.batcher.add_index(normalize(src))
+
+
+def start_observer(directories, handler, polling=False):
+    """
+    Starts a watchdog observer on the include directories.
+
+    Watchdog uses the native event API of the platform (inotify on Linux, FSEvents on macOS,
+    ReadDirectoryChangesW on Windows), or stats the directories periodically with `polling`,
+    which also works on network mounts where native events are not delivered.
+
+    Args:
+        directories (list): The directories to watch, recursively.
+        handler (EventHandler): Receives the events.
+        polling (bool, optional): Whether to use watchdog's polling observer. Defaults to False.
+
+    Returns:
+        The started observer, or None if watchdog is not installed.
+    """
+    try:
+        if polling:
+            from watchdog.observers.polling import PollingObserver as Observer
+        else:
+            from watchdog.observers import Observer
+    except ImportError:
+        return None
+    observer = Observer()
+    for directory in directories:
+        if os.path.isdir(directory):
+            observer.schedule(handler, directory, recursive=True)
+    observer.start()
+    return observer
+
+
+def fetch_metadata(collection, ids):
+    """
+    Returns:
+        dict: The metadata of the entries of `collection` among `ids`, keyed by ID.
+    """
+    ids = list(ids)
+    metadata_of = {}
+    for i in range(0, len(ids), page_size):
+        entries = collection.get(ids=ids[i : i + page_size], include=["metadatas"])
+        for id, metadata in zip(entries["ids"], entries["metadatas"]):
+            metadata_of[id] = metadata or {}
+    return metadata_of
+
+
+def poll_changes(directories, exclude_directories, manifest, cache):
+    """
+    Finds the changes since the last scan with an incremental rescan.
+
+    Used when watchdog is not installed. Only directories whose modification time changed are
+    listed again (see `ScanCache`), so a poll costs one `stat` per directory plus one per file
+    for the fingerprints.
+
+    Returns:
+        dict: The changes, like `ChangeBatcher.wait`.
+    """
+    manifest.begin_scan()
+    save_to_manifest(
+        iter_images(
+            directories, exclude_directories, config.get("scan_workers"), cache
+        ),
+        manifest,
+        content_hash,
+    )
+    deleted = manifest.finish_scan()
+    return {
+        "index": set(manifest.pending()),
+        "delete": set(deleted),
+        "moves": {},
+        "index_directories": set(),
+        "delete_directories": set(),
+    }
+
+
+def apply_changes(
+    image_collection,
+    text_collection,
+    changes,
+    journal,
+    manifest,
+    exclude_directories,
+    duty_cycle=1.0,
+    backlog=None,
+):
+    """
+    Applies one batch of file changes to both collections and the manifest.
+
+    - Moved files whose source is indexed get the embeddings of their source, without running any model.
+    - New and modified files go through the indexing pipeline (see `embed_paths`). A file with the
+      content of a deleted or moved file in the same batch copies its embeddings, so moves that
+      arrive as a delete and a create (e.g. across watched directories) are cheap too.
+    - Files that reappear with the fingerprint of their tombstoned entry are restored without re-embedding.
+    - Deleted files, and sources of moves, are tombstoned in both collections (see
+      `Index.create_db.clean_index`), so they are hidden from search right away and purged by
+      a later cleanup once `tombstone_grace_days` have passed. Deleted directories tombstone
+      every file the manifest has below them. Files under include directories that are
+      unavailable (e.g. an unmounted drive, see `Index.create_db.unavailable_roots`) are kept.
+    - The files left pending by a batch that failed part-way are indexed with this one.
+
+    Only files whose version is in the index once the batch is written are marked as indexed
+    in the manifest.
+
+    Args:
+        image_collection (Collection): The image collection in the database.
+        text_collection (Collection): The text collection in the database.
+        changes (dict): The changes, as returned by `ChangeBatcher.wait`.
+        journal (Journal): The journal to record progress in.
+        manifest (Manifest): The scanned files.
+        exclude_directories (list): Directories and patterns to exclude (see `ExcludeMatcher`).
+        duty_cycle (float, optional): The fraction of time pipeline workers may work (see `Index.pipeline.Pipeline`). Defaults to 1.
+        backlog (OCRBacklog, optional): The backlog of the OCR phase, if OCR is deferred (see `embed_paths`).
+    """
+    to_index = set(changes["index"])
+    if journal.unfinished_run() is not None:
+        # A batch that failed part-way: keep what it indexed and retry the rest with this one
+        manifest.finish_index(
+            journal.completed(), set(journal.failed()) | set(journal.quarantined())
+        )
+        to_index.update(path for path, _ in journal.pending_items())
+    for directory in changes["index_directories"]:
+        to_index.update(
+            normalize(path) for path in iter_images([directory], exclude_directories)
+        )
+    deleted = set(changes["delete"])
+    for directory in changes["delete_directories"]:
+        deleted.update(manifest.under(directory))
+    moves = changes["moves"]
+    skipped_roots = tuple(unavailable_roots())
+    if skipped_roots:
+        for root in skipped_roots:
+            print(f"Include directory {root} is unavailable, keeping its index entries")
+        deleted = {path for path in deleted if not path.startswith(skipped_roots)}
+
+    # The entries that may be copied from before they are removed
+    metadata_of = fetch_metadata(image_collection, deleted | set(moves.values()))
+
+    records = {}
+    for path in to_index | set(moves):
+        record = file_record(path, content_hash)
+        if record is not None:
+            records[path] = record
+    renamed = []
+    for destination, source in moves.items():
+        content = metadata_of.get(source, {}).get("content_hash")
+        if destination not in records:
+            continue
+        if content and destination not in to_index:
+            renamed.append(
+                {
+                    "path": destination,
+                    "fingerprint": records[destination][3],
+                    "content_hash": content,
+                    "source": source,
+                }
+            )
+        else:
+            to_index.add(destination)
+    # Modified events without an actual change (e.g. metadata only) are skipped
+    indexed = fetch_metadata(image_collection, to_index)
+    to_process = [
+        (path, records[path][3])
+        for path in sorted(to_index & set(records))
+        if path not in indexed or indexed[path].get("fingerprint") != records[path][3]
+    ]
+    restored = [
+        path
+        for path in sorted(to_index & set(records))
+        if path in indexed
+        and indexed[path].get("fingerprint") == records[path][3]
+        and indexed[path].get("deleted_at")
+    ]
+
+    manifest.record(list(records.values()))
+    journal.start_run(
+        to_process + [(item["path"], item["fingerprint"]) for item in renamed]
+    )
+    if restored:
+        refresh_entries(
+            image_collection,
+            text_collection,
+            {"restore": restored, "refresh": []},
+            {path: records[path][3] for path in restored},
+        )
+    if renamed:
+        copy_embeddings(image_collection, text_collection, renamed, journal, backlog)
+    known_hashes = {
+        metadata["content_hash"]: id
+        for id, metadata in metadata_of.items()
+        if "content_hash" in metadata
+    }
+    embed_paths(
+        image_collection,
+        text_collection,
+        to_process,
+        journal,
+        known_hashes,
+        moved=set(metadata_of),
+        duty_cycle=duty_cycle,
+        backlog=backlog,
+    )
+
+    # Removed last, since the copies above read their embeddings
+    removed = [
+        id
+        for id, metadata in metadata_of.items()
+        if not os.path.exists(id) and not metadata.get("deleted_at")
+    ]
+    removed_texts = []
+    for i in range(0, len(removed), page_size):
+        removed_texts += text_collection.get(
+            ids=removed[i : i + page_size], include=[]
+        )["ids"]
+    if tombstone_grace > 0:
+        now = time.time()
+        tombstone_ids(image_collection, removed, now)
+        tombstone_ids(text_collection, removed_texts, now)
+    else:
+        delete_ids(image_collection, removed, desc="Removing deleted images")
+        delete_ids(text_collection, removed_texts, desc="Removing deleted texts")
+        if backlog is not None:
+            backlog.remove(removed)
+    manifest.mark_missing([path for path in deleted if not os.path.exists(path)])
+    manifest.mark_missing(
+        [source for source in moves.values() if not os.path.exists(source)]
+    )
+    manifest.finish_index(
+        journal.completed()
+        + [
+            (path, records[path][3])
+            for path in to_index & set(records)
+            if indexed.get(path, {}).get("fingerprint") == records[path][3]
+        ],
+        set(journal.failed()) | set(journal.quarantined()),
+    )
+    journal.finish_run()
+    print(
+        f"Applied changes: {len(to_process)} indexed, {len(renamed)} moved, "
+        f"{len(restored)} restored, {len(removed)} removed"
+    )
+
+
+def watch(
+    image_collection, text_collection, journal=None, manifest=None, duty_cycle=1.0
+):
+    """
+    Keeps the index up to date with changes in the include directories, until interrupted.
+
+    File system events are collected by watchdog (if installed) and applied in batches (see
+    `ChangeBatcher` and `apply_changes`), so new files are searchable within seconds. Set
+    `polling: true` in the `watch` section of `config.yaml` for network mounts, where native
+    events are not delivered. Without watchdog, the include directories are rescanned
+    incrementally every `poll_interval` seconds instead.
+
+    Args:
+        image_collection (Collection): The image collection in the database.
+        text_collection (Collection): The text collection in the database.
+        journal (Journal, optional): The journal to record progress in. Defaults to the one at `journal_file`.
+        manifest (Manifest, optional): The scanned files. Defaults to the one at `Index.scan.manifest_file`.
+        duty_cycle (float, optional): The fraction of time pipeline workers may work (see `Index.pipeline.Pipeline`). Defaults to 1.
+    """
+    if config["scan_method"] != "default":
+        print("Watch mode needs the default scan method (include directories)")
+        return
+    if journal is None:
+        journal = Journal(journal_file)
+    if manifest is None:
+        manifest = Manifest(manifest_file)
+    backlog = open_ocr_backlog()
+    directories = config["include_directories"]
+    exclude_directories = config["exclude_directories"]
+    batcher = ChangeBatcher(
+        watch_config.get("settle_seconds", 2), watch_config.get("max_delay_seconds", 10)
+    )
+    observer = start_observer(
+        directories,
+        EventHandler(batcher, ExcludeMatcher(exclude_directories)),
+        watch_config.get("polling", False),
+    )
+    poll_interval = watch_config.get("poll_interval", 30)
+    if observer is None:
+        print(
+            f"watchdog is not installed (pip install watchdog), "
+            f"rescanning every {poll_interval} seconds instead"
+        )
+        cache = ScanCache(scan_cache_file)
+    else:
+        print(f"Watching {len(directories)} directories for changes")
+    try:
+        while True:
+            progress.start("watching")
+            if observer is not None:
+                changes = batcher.wait()
+            else:
+                time.sleep(poll_interval)
+                changes = poll_changes(
+                    directories, exclude_directories, manifest, cache
+                )
+            if not any(changes.values()):
+                continue
+            try:
+                apply_changes(
+                    image_collection,
+                    text_collection,
+                    changes,
+                    journal,
+                    manifest,
+                    exclude_directories,
+                    duty_cycle,
+                    backlog,
+                )
+            except Exception as e:
+                # The journal keeps the unfinished batch, the next one retries it
+                print(f"Error applying changes: {e}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
@@ -0,0 +1,95 @@
+"""
+Benchmarks reduced-resolution (draft) decoding against full decoding for CLIP preprocessing.
+
+For each image the script times open + decode + CLIP preprocessing both ways, records the size
+of the largest decoded buffer (which bounds the per-worker memory spent on decoding), and
+compares the CLIP embeddings of both decodes by cosine similarity.
+
+Usage (from the repository root, the CLIP provider is read from config.yaml):
+    python benchmarks/draft_decode.py <image_directory> [--limit 200]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Index.scan_default import scan_directory
+from Index.shared_image import open_image
+
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+if config["clip"]["provider"] == "HF_transformers":
+    from CLIP.hftransformers_clip import get_clip_image, input_size, preprocess_image
+elif config["clip"]["provider"] == "mobileclip":
+    from CLIP.mobile_clip import get_clip_image, input_size, preprocess_image
+elif config["clip"]["provider"] == "MLX":
+    from CLIP.mlx_clip import get_clip_image, input_size, preprocess_image
+
+
+def decode(path, min_size):
+    """
+    Opens, decodes and preprocesses one image; returns the decoded image, its buffer size and the time taken.
+    """
+    start = time.perf_counter()
+    image = open_image(path, min_size)
+    image.load()
+    preprocess_image(image)
+    elapsed = time.perf_counter() - start
+    return image, image.width * image.height * len(image.getbands()), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Directory with sample images")
+    parser.add_argument("--limit", type=int, default=200, help="Number of images")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    paths = scan_directory(args.directory, [])[: args.limit]
+    if not paths:
+        print("No images found")
+        return
+
+    results = {}
+    for mode, min_size in (("full", None), ("draft", input_size)):
+        embeddings, sizes, times = [], [], []
+        # Only one batch of decoded images is held at a time
+        for i in range(0, len(paths), args.batch_size):
+            images = []
+            for path in paths[i : i + args.batch_size]:
+                image, size, elapsed = decode(path, min_size)
+                images.append(image)
+                sizes.append(size)
+                times.append(elapsed)
+            embeddings.extend(get_clip_image(images))
+        results[mode] = (np.array(embeddings, dtype=np.float32), sizes, times)
+
+    print(f"{len(paths)} images, CLIP input size {input_size}px")
+    print(f"{'mode':<6} {'ms/image':>9} {'images/s':>9} {'peak MB':>8} {'mean MB':>8}")
+    for mode, (_, sizes, times) in results.items():
+        print(
+            f"{mode:<6} {1000 * np.mean(times):>9.1f} {len(times) / sum(times):>9.1f} "
+            f"{max(sizes) / 2**20:>8.1f} {np.mean(sizes) / 2**20:>8.1f}"
+        )
+
+    full, draft = results["full"][0], results["draft"][0]
+    full /= np.linalg.norm(full, axis=1, keepdims=True)
+    draft /= np.linalg.norm(draft, axis=1, keepdims=True)
+    similarity = (full * draft).sum(axis=1)
+    print(
+        f"embedding cosine similarity (full vs draft): mean {similarity.mean():.4f}, "
+        f"min {similarity.min():.4f}"
+    )
+    speedup = sum(results["full"][2]) / sum(results["draft"][2])
+    print(f"decode + preprocess speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Compares exact in-memory search (`search.flat.FlatIndex`) with the HNSW index of ChromaDB.
+
+Synthetic embeddings are drawn around random cluster centers (as CLIP embeddings of a photo
+library cluster by subject), normalized, and loaded into both. For each collection size the
+script reports the load time and memory of the flat index, the p50/p95 query latency of both,
+and the recall@k of HNSW against the exact results. Use the numbers to pick
+`search.flat_max_vectors` in config.yaml for the hardware search runs on.
+
+The flat index needs 4 * dim bytes per vector (2 GB for 1M 512-dimensional vectors, 10 GB for
+5M); ChromaDB takes several times that and is slow to fill, so it is skipped above
+`--chroma-max` vectors.
+
+Usage (from the repository root):
+    python benchmarks/flat_search.py [--sizes 100000 1000000 5000000] [--dim 512] [--k 10]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search.flat import FlatIndex, normalize
+
+
+def clustered(rng, count, centers, spread=0.6):
+    """
+    Returns:
+        np.ndarray: `count` normalized vectors around random rows of `centers` (unit vectors),
+        with noise of norm about `spread`.
+    """
+    vectors = centers[rng.integers(0, len(centers), count)]
+    noise = rng.normal(scale=spread / np.sqrt(centers.shape[1]), size=vectors.shape)
+    vectors = vectors + noise.astype(np.float32)
+    return normalize(vectors)
+
+
+def percentiles(latencies):
+    return np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100000, 1000000, 5000000]
+    )
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument(
+        "--chroma-max",
+        type=int,
+        default=1000000,
+        help="Largest size also loaded into ChromaDB",
+    )
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers = rng.normal(size=(args.clusters, args.dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    queries = clustered(rng, args.queries, centers)
+
+    print(
+        f"{'vectors':>9} {'load s':>7} {'memory':>8} {'flat p50':>9} {'flat p95':>9} "
+        f"{'hnsw p50':>9} {'hnsw p95':>9} {'recall@' + str(args.k):>9}"
+    )
+    for size in args.sizes:
+        data_rng = np.random.default_rng(args.seed + size)
+        index = FlatIndex(size)
+        start = time.perf_counter()
+        for i in range(0, size, 100000):
+            count = min(100000, size - i)
+            index.upsert(
+                [str(j) for j in range(i, i + count)],
+                clustered(data_rng, count, centers),
+            )
+        load_time = time.perf_counter() - start
+
+        exact, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            ids, _ = index.search(query, args.k)
+            latencies.append(time.perf_counter() - start)
+            exact.append(ids)
+        flat_p50, flat_p95 = percentiles(latencies)
+
+        hnsw = "skipped"
+        if size <= args.chroma_max:
+            import chromadb
+
+            path = tempfile.mkdtemp()
+            try:
+                collection = chromadb.PersistentClient(path=path).create_collection(
+                    "benchmark", metadata={"hnsw:space": "cosine"}
+                )
+                for i in range(0, size, args.chunk_size):
+                    count = min(args.chunk_size, size - i)
+                    collection.add(
+                        ids=index.ids[i : i + count],
+                        embeddings=index.vectors[i : i + count].tolist(),
+                    )
+                    print(f"ChromaDB {i + count}/{size}", end="\r", file=sys.stderr)
+                latencies, hits = [], 0
+                for query, truth in zip(queries, exact):
+                    start = time.perf_counter()
+                    results = collection.query(
+                        query.tolist(), n_results=args.k, include=["distances"]
+                    )
+                    latencies.append(time.perf_counter() - start)
+                    hits += len(set(results["ids"][0]) & set(truth))
+                hnsw_p50, hnsw_p95 = percentiles(latencies)
+                recall = hits / (len(queries) * args.k)
+                hnsw = f"{hnsw_p50:>7.2f}ms {hnsw_p95:>7.2f}ms {recall:>9.1%}"
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+        print(
+            f"{size:>9} {load_time:>7.1f} {index.memory() / 2**20:>6.0f}MB "
+            f"{flat_p50:>7.2f}ms {flat_p95:>7.2f}ms {hnsw}"
+        )
+        del index
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Compares IVF-PQ search (see `search.ivfpq.IVFPQIndex`) with exact search over a snapshot.
+
+Synthetic clustered embeddings (see `benchmarks/flat_search.py`) are written to a snapshot and
+an IVF-PQ index is built for it, as `Index.create_db.export_snapshots` does. For each `nprobe`
+and rerank factor the script reports the p50/p95 latency and recall@k of the search the server
+runs with `quantization: ivfpq`, where the best `k * rerank_factor` candidates are reranked
+with their float32 vectors from the snapshot, and of the IVF-PQ scores alone (rerank "none").
+Neighbours that are nearly as similar as each other (as in large clusters of near duplicates)
+are hard to tell apart with PQ codes, and need a larger rerank factor. Memory is that of the
+codes, which every search reads, against that of the float32 vectors exact search reads.
+
+Usage (from the repository root):
+    python benchmarks/ivfpq_search.py [--size 1000000] [--nprobe 1 4 16 64] [--rerank-factors 8 32]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.flat_search import clustered, percentiles
+from search.ivfpq import build_for_snapshot
+from search.snapshot import Snapshot, SnapshotIndex, write_snapshot
+
+
+def measure(search, queries, exact, k):
+    """
+    Returns:
+        tuple: The p50 and p95 latency (ms) of `search` and its recall@k against `exact`.
+    """
+    search(queries[0])
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start)
+    recall = sum(
+        len(set(found) & set(truth)) for found, truth in zip(results, exact)
+    ) / (len(queries) * k)
+    return percentiles(latencies) + (recall,)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument(
+        "--nlist", type=int, help="Defaults to the square root of --size"
+    )
+    parser.add_argument("--m", type=int, default=64)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--rerank-factors", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers = rng.normal(size=(args.clusters, args.dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    queries = clustered(rng, args.queries, centers)
+
+    def pages():
+        for i in range(0, args.size, 100000):
+            count = min(100000, args.size - i)
+            yield [str(j) for j in range(i, i + count)], clustered(
+                rng, count, centers
+            ), [{}] * count
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "benchmark.snapshot")
+    try:
+        write_snapshot(path, pages())
+        snapshot = Snapshot(path)
+        start = time.perf_counter()
+        ivfpq = build_for_snapshot(snapshot, path + ".ivfpq", args.nlist, args.m)
+        print(
+            f"Built IVF-PQ over {args.size} x {args.dim} ({ivfpq.nlist} lists, m={args.m}) "
+            f"in {time.perf_counter() - start:.1f} s\n"
+            f"float32 {snapshot.vectors.nbytes / 2**20:.0f} MB, "
+            f"IVF-PQ codes {ivfpq.memory() / 2**20:.0f} MB\n"
+        )
+        exact_index = SnapshotIndex(snapshot)
+        exact = [exact_index.search(query, args.k)[0] for query in queries]
+        p50, p95, _ = measure(
+            lambda query: exact_index.search(query, args.k)[0], queries, exact, args.k
+        )
+        print(f"exact: p50 {p50:.2f} ms, p95 {p95:.2f} ms\n")
+
+        print(
+            f"{'nprobe':>6} {'rerank':>6} {'p50':>9} {'p95':>9} {'recall@' + str(args.k):>9}"
+        )
+        for nprobe in args.nprobe:
+            modes = [("none", None)] + [
+                (
+                    f"x{factor}",
+                    SnapshotIndex(snapshot, "ivfpq", factor, ivfpq),
+                )
+                for factor in args.rerank_factors
+            ]
+            for name, index in modes:
+                if index is None:
+                    search = lambda query: [
+                        snapshot.id(row)
+                        for row in ivfpq.search(query, args.k, nprobe)[0]
+                    ]
+                else:
+                    search = lambda query: index.search(query, args.k, nprobe)[0]
+                p50, p95, recall = measure(search, queries, exact, args.k)
+                print(
+                    f"{nprobe:>6} {name:>6} {p50:>7.2f}ms {p95:>7.2f}ms {recall:>9.1%}"
+                )
+        # The mapped files can only be removed once released (on Windows)
+        modes = index = exact_index = ivfpq = None
+        snapshot.close()
+    finally:
+        for root, directories, files in os.walk(directory, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in directories:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Reports the precision and recall of the OCR prescreen against full OCR on a sample of the index.
+
+A random sample of indexed images is run through full OCR (`apply_OCR`), which decides whether
+each image has text. The prescreen score of each image (see `Index.prescreen.TextPrescreen`) is
+computed from its stored CLIP embedding, and for each threshold the script reports:
+
+- precision: of the images the prescreen sends to OCR, the fraction that has text
+- recall: of the images that have text, the fraction the prescreen sends to OCR
+- skipped: the fraction of images the prescreen skips, and the OCR time that saves
+
+Usage (from the repository root, after indexing; models are read from config.yaml):
+    python benchmarks/ocr_prescreen.py [--sample 300] [--thresholds 0.1 0.2 0.3 0.5]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Index.create_db import (
+    apply_OCR,
+    create_vectordb,
+    fetch_index_metadata,
+    ocr_threshold,
+    text_prescreen,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", type=int, default=300, help="Number of images")
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.7],
+    )
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    image_collection, _ = create_vectordb("db")
+    ids = [
+        id
+        for id, metadata in fetch_index_metadata(image_collection).items()
+        if not metadata.get("deleted_at") and os.path.exists(id)
+    ]
+    if not ids:
+        print("No indexed images found, run the indexer first")
+        return
+    random.seed(args.seed)
+    ids = random.sample(ids, min(args.sample, len(ids)))
+    entries = image_collection.get(ids=ids, include=["embeddings"])
+    ids, embeddings = entries["ids"], entries["embeddings"]
+
+    has_text = []
+    start = time.perf_counter()
+    for i in range(0, len(ids), args.batch_size):
+        texts = apply_OCR(ids[i : i + args.batch_size])
+        has_text += [text is not None for text in texts]
+        print(f"OCR {min(i + args.batch_size, len(ids))}/{len(ids)}", end="\r")
+    ocr_time = (time.perf_counter() - start) / len(ids)
+    has_text = np.array(has_text)
+    scores = text_prescreen.scores(embeddings)
+
+    print(
+        f"\n{len(ids)} images, {has_text.mean():.0%} with text, "
+        f"full OCR {ocr_time * 1000:.0f} ms/image"
+    )
+    print(
+        f"{'threshold':>9} {'precision':>9} {'recall':>7} {'skipped':>8} {'saved':>10}"
+    )
+    for threshold in sorted(args.thresholds):
+        screened = scores >= threshold
+        true_positives = (screened & has_text).sum()
+        precision = true_positives / screened.sum() if screened.any() else 1.0
+        recall = true_positives / has_text.sum() if has_text.any() else 1.0
+        skipped = 1 - screened.mean()
+        marker = " <- config" if threshold == ocr_threshold else ""
+        print(
+            f"{threshold:>9.2f} {precision:>9.1%} {recall:>7.1%} {skipped:>8.1%} "
+            f"{skipped * ocr_time * 1000:>7.0f} ms/image{marker}"
+        )
+    missed = [(score, id) for score, id, text in zip(scores, ids, has_text) if text]
+    if missed:
+        print("\nLowest scored images with text (missed first as the threshold rises):")
+        for score, id in sorted(missed)[:10]:
+            print(f"{score:.3f} {id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Compares float32, int8 and binary snapshot search (see `search.snapshot.SnapshotIndex`).
+
+Synthetic clustered embeddings (see `benchmarks/flat_search.py`) are written to a snapshot, which
+is searched exactly with float32 vectors and then with each quantization and rerank factor. For
+each mode the script reports:
+
+- memory: the bytes every search reads, which must stay in memory (vectors or codes)
+- reranked: the float32 bytes read from disk per search, for the candidates
+- p50/p95: the query latency
+- recall@k: the fraction of the exact top k found
+
+The snapshot was just written, so the float32 vectors are in the page cache and rerank
+latencies are those of a warm cache; on a cold cache each candidate costs a random read.
+
+Usage (from the repository root):
+    python benchmarks/quantized_search.py [--size 1000000] [--dim 512] [--rerank-factors 2 8 32]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.flat_search import clustered, percentiles
+from search.snapshot import Snapshot, SnapshotIndex, write_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--rerank-factors", type=int, nargs="+", default=[2, 8, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers = rng.normal(size=(args.clusters, args.dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    queries = clustered(rng, args.queries, centers)
+
+    def pages():
+        for i in range(0, args.size, 100000):
+            count = min(100000, args.size - i)
+            yield [str(j) for j in range(i, i + count)], clustered(
+                rng, count, centers
+            ), [{}] * count
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "benchmark.snapshot")
+    try:
+        start = time.perf_counter()
+        write_snapshot(path, pages())
+        print(
+            f"Wrote {args.size} x {args.dim} snapshot in {time.perf_counter() - start:.1f} s "
+            f"({os.path.getsize(path) / 2**20:.0f} MB)\n"
+        )
+        snapshot = Snapshot(path)
+        print(
+            f"{'mode':>12} {'memory':>9} {'reranked':>9} {'p50':>9} {'p95':>9} "
+            f"{'recall@' + str(args.k):>9}"
+        )
+        exact = None
+        modes = [(None, 1)] + [
+            (quantization, factor)
+            for quantization in ("int8", "binary")
+            for factor in args.rerank_factors
+        ]
+        for quantization, factor in modes:
+            index = SnapshotIndex(snapshot, quantization, factor)
+            index.search(queries[0], args.k)
+            results, latencies = [], []
+            for query in queries:
+                start = time.perf_counter()
+                ids, _ = index.search(query, args.k)
+                latencies.append(time.perf_counter() - start)
+                results.append(ids)
+            if quantization is None:
+                exact = results
+                memory, reranked = snapshot.vectors.nbytes, 0
+                name = "float32"
+            else:
+                memory = (
+                    snapshot.int8.nbytes + snapshot.int8_scales.nbytes
+                    if quantization == "int8"
+                    else snapshot.binary.nbytes
+                )
+                reranked = args.k * factor * args.dim * 4
+                name = f"{quantization} x{factor}"
+            recall = sum(
+                len(set(found) & set(truth)) for found, truth in zip(results, exact)
+            ) / (len(queries) * args.k)
+            p50, p95 = percentiles(latencies)
+            print(
+                f"{name:>12} {memory / 2**20:>7.0f}MB {reranked / 2**10:>7.0f}KB "
+                f"{p50:>7.2f}ms {p95:>7.2f}ms {recall:>9.1%}"
+            )
+        del index, snapshot
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmarks the parallel directory walker against the previous recursive scanner on a synthetic tree.
+
+The tree is generated once (empty files, a mix of image and other extensions, spread over nested
+directories) and reused on later runs. Both scanners are timed on it and must find the same images.
+Run it twice, or drop the page cache in between, to compare warm and cold caches.
+
+Usage (from the repository root):
+    python benchmarks/scan_tree.py [--root /tmp/scan_tree] [--files 1000000] [--workers 4 8 16]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Index.scan_default import iter_images
+
+extensions = [".jpg", ".png", ".txt", ".jpeg", ".json", ".gif"]
+
+
+def build_tree(root, files, files_per_dir, fanout):
+    """
+    Creates `files` empty files under `root`, `files_per_dir` per directory, in a tree with `fanout` subdirectories per level.
+    """
+    marker = os.path.join(root, f".tree_{files}_{files_per_dir}_{fanout}")
+    if os.path.exists(marker):
+        return
+    print(f"Building a tree of {files} files under {root}...")
+    directories = (files + files_per_dir - 1) // files_per_dir
+    created = 0
+    for d in range(directories):
+        # Spell the directory number in base `fanout` to nest it
+        parts = []
+        n = d
+        while True:
+            parts.append(f"d{n % fanout}")
+            n //= fanout
+            if n == 0:
+                break
+        directory = os.path.join(root, *reversed(parts))
+        os.makedirs(directory, exist_ok=True)
+        for f in range(min(files_per_dir, files - created)):
+            open(
+                os.path.join(directory, f"f{f}{extensions[f % len(extensions)]}"), "w"
+            ).close()
+        created += files_per_dir
+    open(marker, "w").close()
+
+
+def recursive_scan(directory):
+    """
+    The previous scanner: one recursive `os.scandir` walk per root.
+    """
+    images = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                images.extend(recursive_scan(entry.path))
+            elif (
+                entry.is_file()
+                and entry.name.lower().endswith(
+                    (".jpg", ".jpeg", ".png", ".gif", ".bmp")
+                )
+                and not entry.name.startswith("._")
+            ):
+                images.append(entry.path)
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default="/tmp/scan_tree")
+    parser.add_argument("--files", type=int, default=1_000_000)
+    parser.add_argument("--files-per-dir", type=int, default=100)
+    parser.add_argument("--fanout", type=int, default=10)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    build_tree(args.root, args.files, args.files_per_dir, args.fanout)
+
+    start = time.perf_counter()
+    expected = recursive_scan(args.root)
+    baseline = time.perf_counter() - start
+    print(f"{'scanner':<20} {'images':>9} {'seconds':>8} {'speedup':>8}")
+    print(f"{'recursive':<20} {len(expected):>9} {baseline:>8.2f} {1:>8.2f}")
+
+    expected = set(expected)
+    for workers in args.workers:
+        start = time.perf_counter()
+        found = list(iter_images([args.root], [], workers))
+        elapsed = time.perf_counter() - start
+        assert set(found) == expected and len(found) == len(expected)
+        print(
+            f"{f'parallel ({workers})':<20} {len(found):>9} {elapsed:>8.2f} {baseline / elapsed:>8.2f}"
+        )
+
+        start = time.perf_counter()
+        next(iter_images([args.root], [], workers))
+        print(f"{'':<20} first result after {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
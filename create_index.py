@@ -1,14 +1,99 @@
 from Index.create_db import *
+from Index.autotune import sample_paths
+from Index.journal import Journal
+from Index.ocr_backlog import OCRBacklog
 from Index.scan import scan_and_save
+from Index.background import run_indexing
+from Index.deferred_ocr import requeue_indexed, run_ocr
 
-import time
+import argparse
 
-scanned = scan_and_save()
-if not scanned:
-    raise Exception("Error scanning images")
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--clean-dry-run",
+    action="store_true",
+    help="scan and report what cleanup would delete, without indexing or deleting",
+)
+parser.add_argument(
+    "--restart",
+    action="store_true",
+    help="discard an interrupted indexing run instead of resuming it",
+)
+parser.add_argument(
+    "--full-scan",
+    action="store_true",
+    help="list every directory again instead of only the ones that changed",
+)
+parser.add_argument(
+    "--watch",
+    action="store_true",
+    help="after indexing, keep the index up to date with file changes until interrupted",
+)
+parser.add_argument(
+    "--ocr",
+    action="store_true",
+    help="only run the OCR phase on the images waiting for it",
+)
+parser.add_argument(
+    "--rerun-ocr",
+    action="store_true",
+    help="queue every indexed image for OCR again (e.g. after changing OCR settings) and run the OCR phase",
+)
+parser.add_argument(
+    "--pause-ocr",
+    action="store_true",
+    help="pause the OCR phase, also of a running server",
+)
+parser.add_argument(
+    "--resume-ocr",
+    action="store_true",
+    help="resume a paused OCR phase",
+)
+parser.add_argument(
+    "--autotune",
+    action="store_true",
+    help="measure the best CLIP and OCR batch sizes on a sample of the scanned images before indexing",
+)
+parser.add_argument(
+    "--tune-hnsw",
+    action="store_true",
+    help="pick HNSW parameters that reach the recall and latency targets in config.yaml, save them there and rebuild the collections with them after indexing",
+)
+args = parser.parse_args()
+
+if args.pause_ocr or args.resume_ocr:
+    OCRBacklog(ocr_backlog_file).set_paused(args.pause_ocr)
+    print(f"OCR {'paused' if args.pause_ocr else 'resumed'}")
+    exit()
+
+journal = Journal(journal_file)
+if args.restart:
+    journal.finish_run()
 image_collection, text_collection = create_vectordb("db")
-start = time.time()
-index_images(image_collection, text_collection)
-clean_index(image_collection, text_collection)
-end = time.time()
-print(f"Indexing took {end - start} seconds")
+if args.clean_dry_run:
+    if not scan_and_save(args.full_scan):
+        raise Exception("Error scanning images")
+    clean_index(image_collection, text_collection, dry_run=True)
+    exit()
+if args.autotune:
+    if not Manifest(manifest_file).counts() and not scan_and_save(args.full_scan):
+        raise Exception("Error scanning images")
+    autotune_batch_sizes(
+        sample_paths(
+            (path for path, _ in Manifest(manifest_file).scanned()),
+            autotune_config.get("sample_size", 64),
+        ),
+        force=True,
+    )
+if args.tune_hnsw:
+    for collection in (image_collection, text_collection):
+        tune_hnsw(collection)
+if args.ocr or args.rerun_ocr:
+    backlog = OCRBacklog(ocr_backlog_file)
+    if args.rerun_ocr:
+        print(f"Queued {requeue_indexed(image_collection, backlog)} images for OCR")
+    run_ocr(text_collection, backlog)
+    exit()
+run_indexing(
+    image_collection, text_collection, journal, args.full_scan, watch_changes=args.watch
+)
@@ -9,8 +9,8 @@ import platform
 python_executable = sys.executable
 
 
-def run_script(script_name):
-    result = subprocess.run([python_executable, script_name])
+def run_script(script_name, *script_args):
+    result = subprocess.run([python_executable, script_name, *script_args])
 
     if result.returncode != 0:
         print(f"Error running {script_name}: {result.stderr}")
@@ -28,6 +28,16 @@ parser.add_argument(
 )
 parser.add_argument("--get-index", action="store_true", help="get the index path")
 parser.add_argument("--open-config-file", action="store_true", help="open config.yaml")
+parser.add_argument(
+    "--clean-dry-run",
+    action="store_true",
+    help="report how many index entries cleanup would delete, without deleting",
+)
+parser.add_argument(
+    "--full-scan",
+    action="store_true",
+    help="rescan every directory instead of only the ones that changed",
+)
 args = parser.parse_args()
 
 if args.settings:
@@ -49,6 +59,10 @@ if args.get_index:
         print("Index does not exist")
     exit()
 
+if args.clean_dry_run:
+    run_script("create_index.py", "--clean-dry-run")
+    exit()
+
 if args.open_config_file:
     if platform.system() == "Windows":
         os.system("start config.yaml")
@@ -58,6 +72,5 @@ if args.open_config_file:
         os.system("xdg-open config.yaml")
     exit()
 
-# Run create_index.py and check if it succeeds before running server.py
-run_script(script_name="create_index.py")
-run_script("server.py")
+# The server starts on the existing index and indexes in the background
+run_script("server.py", *(["--full-scan"] if args.full_scan else []))
@@ -1,8 +1,25 @@
+import math
 import torch
 from doctr.models import ocr_predictor
 from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
+import yaml
+from Index.shared_image import SharedImage
+
+# Load the configuration file
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+ocr_config = config.get("ocr", {})
+# Longest side (px) of an OCR input, larger images are downscaled
+max_side = ocr_config.get("max_side", 2048)
+# Images more elongated than this are split into tiles of this aspect ratio
+tile_aspect = ocr_config.get("tile_aspect", 2.0)
+# Fraction of a tile shared with the next one, so words on a seam are read whole
+tile_overlap = ocr_config.get("tile_overlap", 0.1)
+max_tiles = ocr_config.get("max_tiles", 12)
+# Pixels passed to the model per call, which bounds the peak memory of OCR
+batch_pixels = ocr_config.get("batch_pixels", 24_000_000)
 
 device = (
     "mps"
@@ -15,46 +32,148 @@ model = ocr_predictor(
 model.to(device)
 
 
+def tile_image(image):
+    """
+    Bounds the resolution of an image for OCR, splitting very tall or wide images into tiles.
+
+    An image whose aspect ratio is at most `tile_aspect` is downscaled so that its long side is at
+    most `max_side`. A more elongated image (a long screenshot, a panorama) would be squeezed until
+    its text is unreadable, so it is cut along its long side into tiles of aspect `tile_aspect`
+    that overlap by `tile_overlap`, each at most `max_side` long. Images that would need more than
+    `max_tiles` tiles get longer tiles instead, and are downscaled accordingly.
+
+    Args:
+        image (PIL.Image.Image): The decoded image.
+
+    Returns:
+        list: One dict per tile with the tile "image" (RGB), the "axis" it was cut along
+        (1 for x, 0 for y, None if not tiled) and the "keep" range: the part of the tile, as
+        fractions of its length, whose words belong to it rather than to a neighbour.
+    """
+    image = image.convert("RGB")
+    width, height = image.size
+    long_side, short_side = max(width, height), min(width, height)
+    if long_side <= short_side * tile_aspect:
+        scale = min(1.0, max_side / long_side)
+        if scale < 1:
+            image = image.resize(
+                (round(width * scale), round(height * scale)),
+                Image.BILINEAR,
+                reducing_gap=2.0,
+            )
+        return [{"image": image, "axis": None, "keep": (0.0, 1.0)}]
+
+    # The tile count only depends on the aspect ratio of the image
+    aspect = max(
+        tile_aspect,
+        long_side / short_side / (max_tiles * (1 - tile_overlap) + tile_overlap),
+    )
+    scale = min(1.0, max_side / (short_side * aspect))
+    if scale < 1:
+        image = image.resize(
+            (round(width * scale), round(height * scale)),
+            Image.BILINEAR,
+            reducing_gap=2.0,
+        )
+        width, height = image.size
+        long_side, short_side = max(width, height), min(width, height)
+    length = min(long_side, math.ceil(short_side * aspect))
+    overlap = round(length * tile_overlap)
+    # Rounding can ask for one tile more than `max_tiles`, the overlaps then shrink a little
+    count = min(
+        max_tiles, max(1, math.ceil((long_side - overlap) / (length - overlap)))
+    )
+    # Spread evenly, the last tile ends at the end of the image
+    starts = [
+        round(i * (long_side - length) / (count - 1)) if count > 1 else 0
+        for i in range(count)
+    ]
+    tiles = []
+    for i, start in enumerate(starts):
+        if width >= height:
+            tile = image.crop((start, 0, start + length, height))
+        else:
+            tile = image.crop((0, start, width, start + length))
+        # A word in an overlap belongs to the tile on its side of the middle of the overlap
+        low = (starts[i - 1] + length - start) / 2 / length if i > 0 else 0.0
+        high = (
+            (starts[i + 1] + length - start) / 2 / length
+            if i + 1 < len(starts)
+            else 1.0
+        )
+        tiles.append(
+            {"image": tile, "axis": 1 if width >= height else 0, "keep": (low, high)}
+        )
+    return tiles
+
+
 def process_image(image_path):
     """
-    Opens and preprocesses a single image.
+    Opens and preprocesses a single image into one or more OCR inputs (see `tile_image`).
+
+    For a SharedImage, the result is cached as its "ocr" view.
 
     Args:
-            image_path (str): The path to the image file.
+            image_path (str, PIL.Image.Image or SharedImage): The path to the image file, or an already decoded image.
     Returns:
-            np.array: The preprocessed image tensor.
+            list: The tiles of the image, each with its preprocessed image tensor as "array".
     """
-    image = Image.open(image_path)
-    image = np.array(image)
-    if image.shape[-1] == 4:
-        image = image[:, :, :3]
-    if len(image.shape) == 2:
-        image = np.stack([image] * 3, axis=-1)
-    return image
+    if isinstance(image_path, SharedImage):
+        return image_path.view("ocr", process_image)
+    if isinstance(image_path, Image.Image):
+        image = image_path
+    else:
+        image = Image.open(image_path)
+    tiles = tile_image(image)
+    for tile in tiles:
+        tile["array"] = np.array(tile.pop("image"))
+    return tiles
 
 
-def process_page(page, OCR_threshold):
+def page_words(page, OCR_threshold, tile=None):
     """
-    Processes a single OCR page and extracts text based on a confidence threshold.
+    Extracts the words of an OCR page above a confidence threshold, in reading order.
 
     Args:
         page: An OCR page object containing blocks, lines, and words.
         OCR_threshold (float): The confidence threshold for including words in the extracted text.
+        tile (dict, optional): The tile the page was read from (see `tile_image`); only words
+            centred in its "keep" range are returned, so words on a seam are not read twice.
 
     Returns:
-        str: The extracted text if it meets the criteria, otherwise None.
+        list: The words (str).
+    """
+    axis = None if tile is None else tile["axis"]
+    # doctr geometries are ((xmin, ymin), (xmax, ymax)) relative to the page
+    coordinate = 0 if axis == 1 else 1
+    words = []
+    for block in page.blocks:
+        for line in block.lines:
+            for word in line.words:
+                if word.confidence <= OCR_threshold:
+                    continue
+                if axis is not None:
+                    start, end = (
+                        word.geometry[0][coordinate],
+                        word.geometry[1][coordinate],
+                    )
+                    low, high = tile["keep"]
+                    if not low <= (start + end) / 2 < high:
+                        continue
+                words.append(word.value)
+    return words
+
+
+def filter_text(text):
+    """
+    Discards OCR text that is too short or has no real words, which is usually noise.
+
+    Args:
+        text (str): The extracted text.
+
+    Returns:
+        str: The text if it meets the criteria, otherwise None.
     """
-    blocks = page.blocks
-    try:
-        text = " ".join(
-            word.value
-            for block in blocks
-            for line in block.lines
-            for word in line.words
-            if word.confidence > OCR_threshold
-        )
-    except:
-        text = None
     if text == "" or (
         text is not None
         and (not any(char.isalpha() for char in text) or len(text) < 3)
@@ -64,12 +183,54 @@ def process_page(page, OCR_threshold):
     return text
 
 
+def process_page(page, OCR_threshold):
+    """
+    Processes a single OCR page and extracts text based on a confidence threshold.
+
+    Args:
+        page: An OCR page object containing blocks, lines, and words.
+        OCR_threshold (float): The confidence threshold for including words in the extracted text.
+
+    Returns:
+        str: The extracted text if it meets the criteria, otherwise None.
+    """
+    try:
+        text = " ".join(page_words(page, OCR_threshold))
+    except:
+        text = None
+    return filter_text(text)
+
+
+def pixel_batches(tiles, budget):
+    """
+    Splits tiles into consecutive batches of at most `budget` pixels each (a larger tile gets a batch of its own).
+
+    Returns:
+        list: Lists of tile indices.
+    """
+    batches, batch, pixels = [], [], 0
+    for i, tile in enumerate(tiles):
+        size = tile["array"].shape[0] * tile["array"].shape[1]
+        if batch and pixels + size > budget:
+            batches.append(batch)
+            batch, pixels = [], 0
+        batch.append(i)
+        pixels += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 def apply_OCR(image_paths, OCR_threshold=0.5):
     """
     Applies Optical Character Recognition (OCR) on images and returns the recognized text.
 
+    Images are bounded and tiled (see `tile_image`), and the tiles are passed to the model in
+    batches of at most `batch_pixels` pixels, so a few huge images cannot exhaust memory and many
+    small ones share a call. The text of the tiles of an image is merged in order.
+
     Args:
-        image_paths (list of str): The paths to the image files.
+        image_paths (list of str, PIL.Image.Image or SharedImage): The paths to the image files, or already decoded images.
         OCR_threshold (float, optional): The confidence threshold for the OCR detection. Defaults to 0.5.
 
     Returns:
@@ -77,13 +238,12 @@ def apply_OCR(image_paths, OCR_threshold=0.5):
     """
     with ThreadPoolExecutor() as executor:
         images = list(executor.map(process_image, image_paths))
-    results = model(images)
-
-    def process_page_wrapper(page):
-        return process_page(page, OCR_threshold)
-
-    with ThreadPoolExecutor() as executor:
-        texts = list(executor.map(process_page_wrapper, results.pages))
+    tiles = [(index, tile) for index, image in enumerate(images) for tile in image]
+    words = [[] for _ in images]
+    for batch in pixel_batches([tile for _, tile in tiles], batch_pixels):
+        results = model([tiles[i][1]["array"] for i in batch])
+        for i, page in zip(batch, results.pages):
+            index, tile = tiles[i]
+            words[index] += page_words(page, OCR_threshold, tile)
 
-    # delete model and free up memory
-    return texts
+    return [filter_text(" ".join(image_words)) for image_words in words]
@@ -0,0 +1,385 @@
+import threading
+
+import numpy as np
+
+
+def normalize(vectors):
+    """
+    Returns:
+        np.ndarray: `vectors` as a float32 matrix (one row per vector) with unit-length rows.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors.reshape(-1, vectors.shape[-1])
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k):
+    """
+    Returns:
+        np.ndarray: The indices of the `k` highest finite scores, highest first.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return top[np.isfinite(scores[top])]
+
+
+class FlatIndex:
+    """
+    Exact cosine search over an in-memory matrix of normalized float32 embeddings.
+
+    A query is a single matrix-vector product (BLAS) followed by `argpartition` for the top k, so
+    results are exact and latency grows linearly and predictably with the number of vectors. Rows
+    live in a preallocated matrix that doubles when full; removing a row moves the last row into
+    its place, so the matrix stays dense. Tombstoned entries (see `Index.create_db.clean_index`)
+    keep their row but are masked out of results. All methods are thread-safe.
+
+    Args:
+        capacity (int, optional): The number of rows to allocate up front, when the final size is
+            known.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.live = np.zeros(0, dtype=bool)
+        self.ids = []
+        self.row_of = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.row_of
+
+    def memory(self):
+        """
+        Returns:
+            int: The bytes held by the embedding matrix.
+        """
+        return 0 if self.vectors is None else self.vectors.nbytes
+
+    def _reserve(self, count, dim):
+        if self.vectors is None:
+            self.vectors = np.empty((max(self.capacity, count), dim), dtype=np.float32)
+            self.live = np.zeros(len(self.vectors), dtype=bool)
+        elif count > len(self.vectors):
+            capacity = max(count, 2 * len(self.vectors))
+            vectors = np.empty((capacity, self.vectors.shape[1]), dtype=np.float32)
+            vectors[: len(self.ids)] = self.vectors[: len(self.ids)]
+            live = np.zeros(capacity, dtype=bool)
+            live[: len(self.ids)] = self.live[: len(self.ids)]
+            self.vectors, self.live = vectors, live
+
+    def upsert(self, ids, embeddings, live=None):
+        """
+        Adds or replaces entries.
+
+        Args:
+            ids (list): The IDs of the entries.
+            embeddings (list): Their embeddings (normalized here).
+            live (list, optional): Whether each entry is searchable. Defaults to True for new
+                entries and unchanged for existing ones.
+        """
+        if not len(ids):
+            return
+        embeddings = normalize(embeddings)
+        with self.lock:
+            new = [id for id in dict.fromkeys(ids) if id not in self.row_of]
+            self._reserve(len(self.ids) + len(new), embeddings.shape[1])
+            for id in new:
+                self.row_of[id] = len(self.ids)
+                self.ids.append(id)
+                self.live[self.row_of[id]] = True
+            rows = np.fromiter((self.row_of[id] for id in ids), np.int64, len(ids))
+            self.vectors[rows] = embeddings
+            if live is not None:
+                self.live[rows] = live
+
+    def update(self, ids, embeddings):
+        """
+        Replaces the embeddings of existing entries; unknown IDs are ignored.
+        """
+        if not len(ids):
+            return
+        embeddings = normalize(embeddings)
+        with self.lock:
+            known = [i for i, id in enumerate(ids) if id in self.row_of]
+            rows = [self.row_of[ids[i]] for i in known]
+            self.vectors[rows] = embeddings[known]
+
+    def set_live(self, ids, live):
+        """
+        Shows or hides existing entries; unknown IDs are ignored.
+
+        Args:
+            ids (list): The IDs of the entries.
+            live (list): Whether each entry is searchable.
+        """
+        with self.lock:
+            for id, is_live in zip(ids, live):
+                row = self.row_of.get(id)
+                if row is not None:
+                    self.live[row] = is_live
+
+    def remove(self, ids):
+        """
+        Removes entries; unknown IDs are ignored.
+        """
+        with self.lock:
+            for id in ids:
+                row = self.row_of.pop(id, None)
+                if row is None:
+                    continue
+                last = len(self.ids) - 1
+                if row != last:
+                    moved = self.ids[last]
+                    self.ids[row] = moved
+                    self.row_of[moved] = row
+                    self.vectors[row] = self.vectors[last]
+                    self.live[row] = self.live[last]
+                self.ids.pop()
+                self.live[last] = False
+
+    def outdated(self, id, metadata):
+        """
+        Returns:
+            bool: Whether an entry needs its embedding loaded again; never, since entries are
+            loaded from the collection itself.
+        """
+        return False
+
+    def search(self, query, k, nprobe=None):
+        """
+        Args:
+            query (list): The query embedding.
+            k (int): The number of results.
+            nprobe (int, optional): Ignored, every entry is searched.
+
+        Returns:
+            tuple: Two lists: the IDs of the `k` live entries most similar to `query`, most
+            similar first, and their cosine similarities.
+        """
+        query = normalize(query)[0]
+        with self.lock:
+            count = len(self.ids)
+            if not count:
+                return [], []
+            scores = self.vectors[:count] @ query
+            scores[~self.live[:count]] = -np.inf
+            top = top_k(scores, k)
+            return [self.ids[i] for i in top], scores[top].tolist()
+
+
+class SyncedCollection:
+    """
+    A ChromaDB collection whose contents are mirrored in a `FlatIndex`, for exact in-memory search.
+
+    `load` copies the collection into the index in a background thread; until it is done, and
+    whenever the collection holds more than `max_vectors` entries, `flat` is None and searches
+    fall back to the HNSW index of the collection. Writes made through this object (`add`,
+    `upsert`, `update`, `delete`) are applied to both, so the index stays in sync with an
+    indexer running in the same process. Every other attribute is the collection's own, and the
+    collection can be swapped for a copy of it with `replace`, unnoticed by the server and the
+    indexer that share this object.
+
+    Args:
+        collection (Collection): The collection to mirror.
+        max_vectors (int): The largest number of entries searched in memory.
+        page_size (int, optional): The number of entries read per request while loading.
+    """
+
+    def __init__(self, collection, max_vectors, page_size=10000):
+        self.collection = collection
+        self.max_vectors = max_vectors
+        self.page_size = page_size
+        self.flat = None
+        # The index being loaded, which already receives writes
+        self.loading = None
+        # Orders writes against the pages read while loading
+        self.write_lock = threading.Lock()
+        # IDs written while the collection is copied to a new one (see `track_writes`)
+        self.written = None
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def index(self):
+        return self.flat if self.flat is not None else self.loading
+
+    def track_writes(self):
+        """
+        Starts recording the IDs written through this object, until `replace`.
+        """
+        with self.write_lock:
+            self.written = set()
+
+    def replace(self, collection, catch_up):
+        """
+        Swaps in a copy of the collection, e.g. one rebuilt with other HNSW parameters.
+
+        Under the write lock, `catch_up` is first called with the IDs written since
+        `track_writes`, to copy them to the new collection, so no write made through this
+        object is lost. The in-memory index is kept.
+
+        Args:
+            collection (Collection): The copy.
+            catch_up (callable): Takes the set of written IDs.
+        """
+        with self.write_lock:
+            catch_up(self.written or set())
+            self.collection = collection
+            self.written = None
+
+    def load(self, index=None):
+        """
+        Starts loading the collection into memory in a background thread.
+
+        Args:
+            index (optional): An index to start from instead of an empty `FlatIndex`, e.g. a
+                `search.snapshot.SnapshotIndex`. It is searched right away and only brought up to
+                date with the collection in the background.
+
+        Returns:
+            threading.Thread: The loading thread, or None if the collection is too large.
+        """
+        count = self.collection.count()
+        if count > self.max_vectors:
+            print(
+                f"{self.collection.name}: {count} entries, searching with HNSW "
+                f"(flat search is used up to {self.max_vectors})"
+            )
+            return None
+        if index is not None:
+            with self.write_lock:
+                self.flat = index
+        thread = threading.Thread(target=self._load, args=(index,), daemon=True)
+        thread.start()
+        return thread
+
+    def _load(self, index=None):
+        if index is None:
+            index = FlatIndex(self.collection.count())
+            with self.write_lock:
+                self.loading = index
+            offset = 0
+            while True:
+                with self.write_lock:
+                    page = self.collection.get(
+                        include=["embeddings", "metadatas"],
+                        limit=self.page_size,
+                        offset=offset,
+                    )
+                    self._apply(index, page)
+                offset += len(page["ids"])
+                if len(page["ids"]) < self.page_size:
+                    break
+        with self.write_lock:
+            # Entries deleted while loading shift the later pages, so some may have been
+            # skipped; a given index may be older than the collection
+            ids = set()
+            outdated = []
+            offset = 0
+            while True:
+                page = self.collection.get(
+                    include=["metadatas"], limit=self.page_size, offset=offset
+                )
+                metadatas = [metadata or {} for metadata in page["metadatas"]]
+                for id, metadata in zip(page["ids"], metadatas):
+                    ids.add(id)
+                    if id not in index or index.outdated(id, metadata):
+                        outdated.append(id)
+                index.set_live(
+                    page["ids"],
+                    [not metadata.get("deleted_at") for metadata in metadatas],
+                )
+                offset += len(page["ids"])
+                if len(page["ids"]) < self.page_size:
+                    break
+            index.remove([id for id in index.ids if id not in ids])
+            for i in range(0, len(outdated), self.page_size):
+                self._apply(
+                    index,
+                    self.collection.get(
+                        ids=outdated[i : i + self.page_size],
+                        include=["embeddings", "metadatas"],
+                    ),
+                )
+            self.loading = None
+            self.flat = index
+            self._check_size()
+        if self.flat is not None:
+            print(
+                f"{self.collection.name}: {len(index)} entries searched in memory "
+                f"({index.memory() / 2**20:.0f} MB, {len(outdated)} updated)"
+            )
+
+    @staticmethod
+    def _apply(index, page):
+        index.upsert(
+            page["ids"],
+            page["embeddings"],
+            [not (metadata or {}).get("deleted_at") for metadata in page["metadatas"]],
+        )
+
+    def _check_size(self):
+        if self.flat is not None and len(self.flat) > self.max_vectors:
+            print(
+                f"{self.collection.name}: more than {self.max_vectors} entries, "
+                "searching with HNSW from now on"
+            )
+            self.flat = None
+
+    def upsert(self, ids, embeddings=None, metadatas=None, **kwargs):
+        with self.write_lock:
+            self.collection.upsert(
+                ids=ids, embeddings=embeddings, metadatas=metadatas, **kwargs
+            )
+            if self.written is not None:
+                self.written.update(ids)
+            index = self.index()
+            if index is not None and embeddings is not None:
+                live = None
+                if metadatas is not None:
+                    live = [not metadata.get("deleted_at") for metadata in metadatas]
+                index.upsert(ids, embeddings, live)
+                self._check_size()
+
+    def add(self, ids, embeddings=None, metadatas=None, **kwargs):
+        self.upsert(ids, embeddings, metadatas, **kwargs)
+
+    def update(self, ids, embeddings=None, metadatas=None, **kwargs):
+        with self.write_lock:
+            self.collection.update(
+                ids=ids, embeddings=embeddings, metadatas=metadatas, **kwargs
+            )
+            if self.written is not None:
+                self.written.update(ids)
+            index = self.index()
+            if index is None:
+                return
+            if embeddings is not None:
+                index.update(ids, embeddings)
+            if metadatas is not None:
+                changed = [
+                    (id, not metadata["deleted_at"])
+                    for id, metadata in zip(ids, metadatas)
+                    if "deleted_at" in metadata
+                ]
+                index.set_live([id for id, _ in changed], [live for _, live in changed])
+
+    def delete(self, ids=None, **kwargs):
+        with self.write_lock:
+            self.collection.delete(ids=ids, **kwargs)
+            index = self.index()
+            if index is not None and ids is not None and not kwargs:
+                index.remove(ids)
+            elif index is not None:
+                # Deletes by filter cannot be mirrored, search with HNSW until reloaded
+                self.flat = self.loading = None
+                print(f"{self.collection.name}: reloading the in-memory index")
+                threading.Thread(target=self.load, daemon=True).start()
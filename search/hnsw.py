@@ -0,0 +1,171 @@
+import os
+import time
+
+import numpy as np
+
+from search.flat import normalize, top_k
+
+# The HNSW parameters of collections created without them (those of ChromaDB)
+defaults = {"M": 16, "construction_ef": 100, "search_ef": 10}
+
+# Queries scored per step of the exact search, which bounds its score matrix
+block_size = 16
+
+
+def collection_params(collection):
+    """
+    Returns:
+        dict: The HNSW parameters ("M", "construction_ef", "search_ef") a collection was created with.
+    """
+    metadata = collection.metadata or {}
+    return {
+        name: int(metadata.get(f"hnsw:{name}", value))
+        for name, value in defaults.items()
+    }
+
+
+def hnsw_metadata(params):
+    """
+    Returns:
+        dict: The metadata that creates a cosine collection with the HNSW parameters `params`.
+    """
+    metadata = {"hnsw:space": "cosine"}
+    for name, value in {**defaults, **params}.items():
+        metadata[f"hnsw:{name}"] = int(value)
+    return metadata
+
+
+def sample_vectors(collection, count, page_size=10000, seed=0):
+    """
+    Reads the embeddings of `count` entries of a collection chosen at random (all of them if it
+    has fewer), in one pass over its pages.
+
+    Returns:
+        np.ndarray: The normalized embeddings, in collection order.
+    """
+    total = collection.count()
+    rng = np.random.default_rng(seed)
+    wanted = np.sort(rng.choice(total, min(count, total), replace=False))
+    vectors = []
+    offset = 0
+    while offset < total:
+        page = collection.get(include=["embeddings"], limit=page_size, offset=offset)
+        if not len(page["ids"]):
+            break
+        end = offset + len(page["ids"])
+        rows = wanted[(wanted >= offset) & (wanted < end)] - offset
+        if len(rows):
+            vectors.append(np.asarray(page["embeddings"], dtype=np.float32)[rows])
+        offset = end
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    return normalize(np.concatenate(vectors))
+
+
+def exact_neighbors(vectors, queries, k):
+    """
+    Returns:
+        np.ndarray: The rows of the `k` vectors most similar to each query, most similar first.
+    """
+    neighbors = np.empty((len(queries), min(k, len(vectors))), dtype=np.int64)
+    for i in range(0, len(queries), block_size):
+        scores = queries[i : i + block_size] @ vectors.T
+        for j, row in enumerate(scores):
+            neighbors[i + j] = top_k(row, k)
+    return neighbors
+
+
+def tune(
+    vectors,
+    k=50,
+    queries=200,
+    recall=0.95,
+    p95_ms=50,
+    M=(8, 16, 32, 48),
+    construction_ef=(64, 128, 256),
+    search_ef=(16, 32, 64, 128, 256, 512),
+    seed=0,
+):
+    """
+    Finds the cheapest HNSW parameters that reach a target recall@k and p95 latency.
+
+    `queries` vectors are held out of the others, which are indexed with hnswlib (the library
+    behind ChromaDB's index) for each `M` and `construction_ef`, and searched with increasing
+    `search_ef` until the recall@k against an exact search reaches `recall`. Settings are tried
+    from the cheapest: the smallest `M` (memory, build and search time), then the smallest
+    `construction_ef` (build time), then the smallest `search_ef` (search time), and tuning
+    stops at the first one whose p95 latency is also within `p95_ms`. Latencies are those of
+    the index alone, one query at a time, without ChromaDB's own overhead. hnswlib searches with
+    at least `k` candidates, so `search_ef` values below `k` are raised to it.
+
+    Args:
+        vectors (np.ndarray): Normalized embeddings of the collection (or a sample of them).
+        k (int, optional): The number of results recall is measured at.
+        queries (int, optional): The number of held-out query vectors.
+        recall (float, optional): The target recall@k, from 0 to 1.
+        p95_ms (float, optional): The target 95th percentile latency, in milliseconds.
+        M, construction_ef, search_ef (list, optional): The candidate values.
+
+    Returns:
+        tuple: The chosen parameters (a dict, or None if no candidate meets both targets) and
+        the measurements of every setting tried (a list of dicts).
+
+    Raises:
+        ImportError: If hnswlib is not installed.
+    """
+    import hnswlib
+
+    rng = np.random.default_rng(seed)
+    held_out = np.zeros(len(vectors), dtype=bool)
+    held_out[
+        rng.choice(len(vectors), min(queries, len(vectors) // 2), replace=False)
+    ] = True
+    base, query_vectors = vectors[~held_out], vectors[held_out]
+    truth = exact_neighbors(base, query_vectors, k)
+    # Values below k behave like k, they would be measured as duplicates of it
+    search_ef = sorted({max(ef, truth.shape[1]) for ef in search_ef})
+    trials = []
+    for m in sorted(M):
+        for ef_construction in sorted(construction_ef):
+            index = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+            index.init_index(
+                max_elements=len(base), ef_construction=ef_construction, M=m
+            )
+            start = time.perf_counter()
+            index.add_items(base, np.arange(len(base)), num_threads=os.cpu_count())
+            build_time = time.perf_counter() - start
+            index.set_num_threads(1)
+            for ef in search_ef:
+                index.set_ef(ef)
+                index.knn_query(query_vectors[:1], k=truth.shape[1])
+                latencies, hits = [], 0
+                for query, expected in zip(query_vectors, truth):
+                    start = time.perf_counter()
+                    labels, _ = index.knn_query(query[None], k=truth.shape[1])
+                    latencies.append(time.perf_counter() - start)
+                    hits += len(set(labels[0]) & set(expected))
+                trial = {
+                    "M": m,
+                    "construction_ef": ef_construction,
+                    "search_ef": ef,
+                    "recall": hits / truth.size,
+                    "p95_ms": float(np.percentile(latencies, 95) * 1000),
+                    "build_s": build_time,
+                }
+                trials.append(trial)
+                print(
+                    f"M={m} construction_ef={ef_construction} search_ef={ef}: "
+                    f"recall@{k} {trial['recall']:.1%}, p95 {trial['p95_ms']:.2f} ms, "
+                    f"built in {build_time:.1f} s"
+                )
+                if trial["recall"] >= recall:
+                    # A larger search_ef only adds latency
+                    if trial["p95_ms"] <= p95_ms:
+                        return {
+                            "M": m,
+                            "construction_ef": ef_construction,
+                            "search_ef": ef,
+                        }, trials
+                    break
+            del index
+    return None, trials
@@ -0,0 +1,378 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from search.flat import normalize, top_k
+from search.versions import current_version, new_version, publish
+
+# Rows assigned to centroids per step, which bounds the score matrix of a step
+block_size = 4096
+
+
+def nearest(vectors, centroids):
+    """
+    Returns:
+        np.ndarray: The index of the nearest centroid (L2) of each vector.
+    """
+    half_norms = (centroids**2).sum(axis=1) / 2
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for i in range(0, len(vectors), block_size):
+        scores = vectors[i : i + block_size] @ centroids.T - half_norms
+        assignment[i : i + block_size] = scores.argmax(axis=1)
+    return assignment
+
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """
+    Clusters vectors with Lloyd's algorithm. Empty clusters are restarted on random vectors.
+
+    Returns:
+        np.ndarray: The `k` centroids (fewer if there are fewer vectors).
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=k)
+        filled = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = (
+            np.add.reduceat(vectors[order], starts, axis=0) / counts[filled, None]
+        )
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = vectors[rng.choice(len(vectors), len(empty))]
+    return centroids
+
+
+class IVFPQIndex:
+    """
+    An inverted file index with product quantization (IVF-PQ) over rows of normalized vectors.
+
+    Vectors are assigned to the nearest of `nlist` coarse centroids (their list), and the
+    residual to that centroid is split into `m` subvectors, each stored as the byte index of its
+    nearest of 256 trained subcentroids. A row takes `m` bytes instead of 4 bytes per dimension.
+    A search scores the `nprobe` lists whose centroids are most similar to the query: the
+    similarity of a row is that of its centroid plus, per subvector, a lookup in a table of the
+    query's similarity with each subcentroid.
+
+    Rows are numbered in the order they are added. Once trained, rows can be appended without
+    training again; the quantizers only need retraining when the data drifts away from them.
+    Saved indexes store the codes ordered by list, and are loaded memory-mapped.
+
+    Args:
+        dim (int): The dimension of the vectors.
+        nlist (int): The number of lists (coarse centroids).
+        m (int): The number of subvectors; must divide `dim`.
+        nprobe (int, optional): The number of lists searched by default.
+    """
+
+    def __init__(self, dim, nlist, m, nprobe=16):
+        if dim % m:
+            raise ValueError(f"{m} subvectors do not divide {dim} dimensions")
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.nprobe = nprobe
+        self.centroids = None
+        self.codebooks = None
+        # The number of vectors the quantizers were trained on
+        self.trained_on = 0
+        # Identifies the data the rows come from (see `search.snapshot.Snapshot.version`)
+        self.version = None
+        # A hash of the vectors of the rows (see `build_for_snapshot`)
+        self.digest = None
+        self.count = 0
+        # Rows in the order added, while appending (preallocated, `count` are used)
+        self.codes = None
+        self.assignment = None
+        # Rows ordered by list, for search (rebuilt after appends)
+        self.list_offsets = None
+        self.list_rows = None
+        self.list_codes = None
+
+    def __len__(self):
+        return self.count
+
+    def train(self, sample, iterations=10, seed=0):
+        """
+        Trains the coarse centroids and the subcentroids on a sample of the vectors.
+
+        Args:
+            sample (np.ndarray): The sample, at least 256 vectors and ideally 40 per list.
+        """
+        sample = normalize(sample)
+        self.centroids = kmeans(sample, self.nlist, iterations, seed)
+        self.nlist = len(self.centroids)
+        residuals = sample - self.centroids[nearest(sample, self.centroids)]
+        width = self.dim // self.m
+        self.codebooks = np.zeros((self.m, 256, width), dtype=np.float32)
+        for j in range(self.m):
+            codebook = kmeans(
+                residuals[:, j * width : (j + 1) * width], 256, iterations, seed + j
+            )
+            self.codebooks[j, : len(codebook)] = codebook
+        self.trained_on = len(sample)
+
+    def empty_copy(self):
+        """
+        Returns:
+            IVFPQIndex: An empty index with the quantizers of this one, to append to.
+        """
+        index = IVFPQIndex(self.dim, self.nlist, self.m, self.nprobe)
+        index.centroids, index.codebooks = self.centroids, self.codebooks
+        index.trained_on = self.trained_on
+        return index
+
+    def encode(self, vectors):
+        """
+        Returns:
+            tuple: The list and the codes of each (normalized) vector.
+        """
+        assignment = nearest(vectors, self.centroids)
+        residuals = vectors - self.centroids[assignment]
+        width = self.dim // self.m
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = nearest(
+                residuals[:, j * width : (j + 1) * width], self.codebooks[j]
+            )
+        return assignment, codes
+
+    def _reserve(self, count):
+        if self.codes is None:
+            self.codes = np.empty((max(1024, count), self.m), dtype=np.uint8)
+            self.assignment = np.empty(len(self.codes), dtype=np.int32)
+            if self.count:
+                # Loaded ordered by list; back to the order rows were added, to append
+                self.codes[self.list_rows] = self.list_codes
+                self.assignment[self.list_rows] = np.repeat(
+                    np.arange(self.nlist, dtype=np.int32), np.diff(self.list_offsets)
+                )
+        elif count > len(self.codes):
+            capacity = max(count, 2 * len(self.codes))
+            codes = np.empty((capacity, self.m), dtype=np.uint8)
+            codes[: self.count] = self.codes[: self.count]
+            assignment = np.empty(capacity, dtype=np.int32)
+            assignment[: self.count] = self.assignment[: self.count]
+            self.codes, self.assignment = codes, assignment
+
+    def add(self, vectors):
+        """
+        Appends vectors; the index must be trained.
+
+        Returns:
+            np.ndarray: The rows of the vectors.
+        """
+        vectors = normalize(vectors)
+        self._reserve(self.count + len(vectors))
+        rows = np.arange(self.count, self.count + len(vectors))
+        self.assignment[rows], self.codes[rows] = self.encode(vectors)
+        self.count += len(vectors)
+        self.list_offsets = None
+        return rows
+
+    def _order(self):
+        if self.list_offsets is None:
+            self._reserve(self.count)
+            assignment = self.assignment[: self.count]
+            self.list_rows = np.argsort(assignment, kind="stable").astype(np.int32)
+            self.list_codes = self.codes[self.list_rows]
+            counts = np.bincount(assignment, minlength=self.nlist)
+            self.list_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def search(self, query, k, nprobe=None, hidden=None):
+        """
+        Args:
+            query (list): The query embedding.
+            k (int): The number of results.
+            nprobe (int, optional): The number of lists to search. Defaults to `nprobe` of the index.
+            hidden (np.ndarray, optional): A flag per row; flagged rows are left out.
+
+        Returns:
+            tuple: The `k` rows most similar to `query` among the searched lists, most similar
+            first, and their approximate cosine similarities.
+        """
+        if not self.count:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        self._order()
+        query = normalize(query)[0]
+        coarse = self.centroids @ query
+        table = np.einsum(
+            "jw,jcw->jc", query.reshape(self.m, -1), self.codebooks
+        ).ravel()
+        offsets = np.arange(self.m) * 256
+        rows, scores = [], []
+        for probe in top_k(coarse, nprobe or self.nprobe):
+            start, end = self.list_offsets[probe], self.list_offsets[probe + 1]
+            if start == end:
+                continue
+            rows.append(self.list_rows[start:end])
+            scores.append(
+                coarse[probe] + table[self.list_codes[start:end] + offsets].sum(axis=1)
+            )
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        if hidden is not None:
+            scores[hidden[rows]] = -np.inf
+        best = top_k(scores, k)
+        return rows[best], scores[best]
+
+    def memory(self):
+        """
+        Returns:
+            int: The bytes of the codes and row tables.
+        """
+        self._order()
+        appending = 0 if self.codes is None else self.codes.nbytes
+        return self.list_codes.nbytes + self.list_rows.nbytes + appending
+
+    def save(self, path):
+        """
+        Saves the index to the directory `path`, ordered by list.
+
+        The index is written to a new directory next to `path`, which becomes the current one
+        once complete (see `search.versions.publish`), so processes that have the previous
+        index mapped keep reading consistent files, which are never replaced.
+        """
+        self._order()
+        version = new_version(path)
+        os.makedirs(version)
+        for name in (
+            "centroids",
+            "codebooks",
+            "list_offsets",
+            "list_rows",
+            "list_codes",
+        ):
+            np.save(os.path.join(version, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(version, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "nlist": self.nlist,
+                    "m": self.m,
+                    "count": self.count,
+                    "trained_on": self.trained_on,
+                    "version": self.version,
+                    "digest": self.digest,
+                },
+                f,
+            )
+        publish(path, version)
+
+    @classmethod
+    def load(cls, path, nprobe=16):
+        """
+        Loads the current index saved with `save` at `path`, with the codes memory-mapped.
+
+        Raises:
+            OSError: If there is no index at `path`.
+        """
+        path = current_version(path)
+        with open(os.path.join(path, "index.json"), "r") as f:
+            info = json.load(f)
+        index = cls(info["dim"], info["nlist"], info["m"], nprobe)
+        index.count = info["count"]
+        index.trained_on = info["trained_on"]
+        index.version = info["version"]
+        index.digest = info.get("digest")
+        for name in (
+            "centroids",
+            "codebooks",
+            "list_offsets",
+            "list_rows",
+            "list_codes",
+        ):
+            setattr(
+                index, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            )
+        return index
+
+
+def index_path(snapshot_path):
+    """
+    Returns:
+        str: The directory of the IVF-PQ index of a snapshot file.
+    """
+    return os.path.splitext(snapshot_path)[0] + ".ivfpq"
+
+
+def build_for_snapshot(
+    snapshot,
+    path,
+    nlist=None,
+    m=64,
+    train_per_list=40,
+    retrain_growth=2.0,
+    chunk_size=100000,
+    seed=0,
+):
+    """
+    Builds the IVF-PQ index of the rows of a snapshot and saves it to `path`.
+
+    The quantizers of the index already at `path` are reused as long as the snapshot has grown
+    less than `retrain_growth` times the vectors they were trained on (and `nlist` and `m` are
+    unchanged; without `nlist`, that of the previous index is kept). If the snapshot also starts
+    with the rows of the previous index, unchanged (as when entries were only added or
+    tombstoned), only the rows after them are encoded and appended; otherwise every row is
+    encoded again. Once the snapshot has outgrown the quantizers, they are trained again on a
+    random sample of `train_per_list` rows per list.
+
+    Args:
+        snapshot (Snapshot): The snapshot.
+        path (str): The index directory.
+        nlist (int, optional): The number of lists. Defaults to the square root of the rows
+            when the quantizers are trained.
+        m (int, optional): The number of subvectors.
+
+    Returns:
+        IVFPQIndex: The index.
+    """
+    try:
+        previous = IVFPQIndex.load(path)
+    except (OSError, ValueError, KeyError):
+        previous = None
+    digest = hashlib.sha1()
+    start = 0
+    if (
+        previous is not None
+        and (previous.dim, previous.m) == (snapshot.dim, m)
+        and nlist in (None, previous.nlist)
+        and snapshot.count <= previous.trained_on * retrain_growth
+    ):
+        for i in range(0, min(previous.count, snapshot.count), chunk_size):
+            digest.update(snapshot.vectors[i : min(i + chunk_size, previous.count)])
+        if previous.count <= snapshot.count and digest.hexdigest() == previous.digest:
+            index, start = previous, previous.count
+        else:
+            index, digest = previous.empty_copy(), hashlib.sha1()
+        # Copies, as the files of the previous index are removed once it is saved
+        index.centroids = np.array(index.centroids)
+        index.codebooks = np.array(index.codebooks)
+    else:
+        if nlist is None:
+            nlist = max(1, int(np.sqrt(snapshot.count)))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(
+            rng.choice(
+                snapshot.count,
+                min(snapshot.count, max(256, nlist * train_per_list)),
+                replace=False,
+            )
+        )
+        index = IVFPQIndex(snapshot.dim, nlist, m)
+        index.train(snapshot.vectors[sample], seed=seed)
+    for i in range(start, snapshot.count, chunk_size):
+        vectors = snapshot.vectors[i : i + chunk_size]
+        index.add(vectors)
+        digest.update(vectors)
+    index.version = snapshot.version
+    index.digest = digest.hexdigest()
+    index.save(path)
+    return index
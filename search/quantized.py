@@ -0,0 +1,63 @@
+import numpy as np
+
+# Rows scored per step, which keeps the float32 copy of a step of int8 codes small (8 MB at
+# 512 dimensions)
+block_size = 4096
+
+# The sign (+1 or -1) of each of the 8 bits of every byte value, most significant bit first
+# (the order of `np.packbits`)
+byte_signs = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1) * 2.0 - 1
+
+
+def quantize_int8(vectors):
+    """
+    Scalar-quantizes vectors to int8, each scaled by its own largest component.
+
+    Returns:
+        tuple: The int8 codes (one row per vector) and the float32 scale of each row, such
+        that `codes * scales[:, None] / 127` approximates `vectors`.
+    """
+    scales = np.abs(vectors).max(axis=1).astype(np.float32)
+    codes = np.rint(vectors / np.maximum(scales, 1e-12)[:, None] * 127)
+    return codes.astype(np.int8), scales
+
+
+def quantize_binary(vectors):
+    """
+    Returns:
+        np.ndarray: The signs of the components of `vectors` as bits, packed 8 per byte.
+    """
+    return np.packbits(vectors > 0, axis=1)
+
+
+def int8_scores(codes, scales, query):
+    """
+    Returns:
+        np.ndarray: The approximate dot products of `query` with the vectors of int8 codes.
+    """
+    scores = np.empty(len(codes), dtype=np.float32)
+    for i in range(0, len(codes), block_size):
+        block = codes[i : i + block_size].astype(np.float32)
+        scores[i : i + len(block)] = block @ query
+    return scores * scales / 127
+
+
+def binary_scores(codes, query):
+    """
+    Scores binary codes against a full-precision query: the dot product of the query with the
+    signs (+1 or -1) of each vector. A table holds the contribution of every byte value at every
+    byte position, so a vector is scored with one lookup per byte.
+
+    Returns:
+        np.ndarray: The scores, which rank candidates but are not cosine similarities.
+    """
+    width = codes.shape[1]
+    padded = np.zeros(width * 8, dtype=np.float32)
+    padded[: len(query)] = query
+    table = (padded.reshape(width, 8) @ byte_signs.T).astype(np.float32).ravel()
+    offsets = np.arange(width) * 256
+    scores = np.empty(len(codes), dtype=np.float32)
+    for i in range(0, len(codes), block_size):
+        block = codes[i : i + block_size]
+        scores[i : i + len(block)] = table[block + offsets].sum(axis=1)
+    return scores
@@ -0,0 +1,493 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+from search.flat import FlatIndex, SyncedCollection, normalize, top_k
+from search.ivfpq import IVFPQIndex, index_path
+from search.quantized import (
+    binary_scores,
+    int8_scores,
+    quantize_binary,
+    quantize_int8,
+)
+from search.versions import current_version, new_version, publish
+
+# The last bytes of a snapshot file, after the footer and its length
+magic = b"CLPXSNP1"
+
+
+def write_snapshot(path, pages, tag=None):
+    """
+    Writes entries to a snapshot file, which `Snapshot` maps into memory.
+
+    The file holds the normalized float32 embeddings as one contiguous matrix (at offset 0, so
+    rows are page-aligned), their int8 and binary codes (see `search.quantized`), then a live
+    flag per entry, the UTF-8 IDs and the JSON metadata of the entries, each as one blob with an
+    int64 table of the offsets where each entry starts, and finally a JSON footer with the
+    location of each section. Each snapshot is written to a new file next to `path`, which
+    becomes the current one once complete (see `search.versions.publish`), so readers never see
+    a partial snapshot and a snapshot that is mapped is never replaced.
+
+    Args:
+        path (str): The snapshot file.
+        pages (iterable): Tuples of IDs, embeddings and metadatas.
+        tag (str, optional): Identifies the model the embeddings come from (see `Snapshot.tag`).
+
+    Returns:
+        int: The number of entries written.
+    """
+    version = new_version(path)
+    live, ids, metadatas = bytearray(), bytearray(), bytearray()
+    id_offsets, metadata_offsets = [0], [0]
+    count, dim = 0, 0
+    # The codes are collected in temporary files and appended after the vectors
+    codes = {
+        name: tempfile.TemporaryFile() for name in ("int8", "int8_scales", "binary")
+    }
+    with open(version, "wb") as f:
+        for page_ids, embeddings, page_metadatas in pages:
+            if not len(page_ids):
+                continue
+            vectors = normalize(embeddings)
+            dim = vectors.shape[1]
+            f.write(vectors.tobytes())
+            int8, scales = quantize_int8(vectors)
+            codes["int8"].write(int8.tobytes())
+            codes["int8_scales"].write(scales.tobytes())
+            codes["binary"].write(quantize_binary(vectors).tobytes())
+            for id, metadata in zip(page_ids, page_metadatas):
+                metadata = metadata or {}
+                live.append(not metadata.get("deleted_at"))
+                ids += id.encode("utf-8")
+                id_offsets.append(len(ids))
+                metadatas += json.dumps(metadata).encode("utf-8")
+                metadata_offsets.append(len(metadatas))
+            count += len(page_ids)
+        sections = {}
+        for name, code_file in codes.items():
+            f.write(b"\0" * (-f.tell() % 8))
+            sections[name] = f.tell()
+            code_file.seek(0)
+            shutil.copyfileobj(code_file, f)
+            code_file.close()
+        for name, data in [
+            ("live", bytes(live)),
+            ("id_offsets", np.array(id_offsets, dtype=np.int64).tobytes()),
+            ("ids", bytes(ids)),
+            ("metadata_offsets", np.array(metadata_offsets, dtype=np.int64).tobytes()),
+            ("metadatas", bytes(metadatas)),
+        ]:
+            f.write(b"\0" * (-f.tell() % 8))
+            sections[name] = f.tell()
+            f.write(data)
+        footer = {
+            "count": count,
+            "dim": dim,
+            "tag": tag,
+            "version": version.rsplit(".", 1)[1],
+            "sections": sections,
+        }
+        footer = json.dumps(footer).encode("utf-8")
+        f.write(footer + struct.pack("<Q", len(footer)) + magic)
+        f.flush()
+        os.fsync(f.fileno())
+    publish(path, version)
+    return count
+
+
+def collection_pages(collection, page_size=10000):
+    """
+    Yields:
+        tuple: The IDs, embeddings and metadatas of a collection, `page_size` entries at a time.
+    """
+    offset = 0
+    while True:
+        page = collection.get(
+            include=["embeddings", "metadatas"], limit=page_size, offset=offset
+        )
+        yield page["ids"], page["embeddings"], page["metadatas"]
+        offset += len(page["ids"])
+        if len(page["ids"]) < page_size:
+            break
+
+
+def collection_metadata(collection, page_size=10000):
+    """
+    Returns:
+        dict: The metadata of every entry of a collection, by ID (no embeddings are read).
+    """
+    metadata_of = {}
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        metadata_of.update(
+            (id, metadata or {}) for id, metadata in zip(page["ids"], page["metadatas"])
+        )
+        offset += len(page["ids"])
+        if len(page["ids"]) < page_size:
+            break
+    return metadata_of
+
+
+def export_snapshot(collection, path, tag=None, page_size=10000, force=False):
+    """
+    Writes a collection to a snapshot file, unless the file already matches it.
+
+    The snapshot is up to date if its tag matches and it holds the same IDs with the same
+    metadata as the collection, which only takes reading the metadata. Embeddings that change
+    without any metadata change (texts after OCR runs again) need `force`. A `SyncedCollection`
+    is exported with its writes on hold, so the snapshot is consistent.
+
+    Args:
+        collection (Collection): The collection.
+        path (str): The snapshot file.
+        tag (str, optional): Identifies the model the embeddings come from (see `Snapshot.tag`).
+        page_size (int, optional): The number of entries read per request.
+        force (bool, optional): If True, write the snapshot even if it looks up to date.
+
+    Returns:
+        int: The number of entries written, or None if the snapshot was up to date.
+    """
+    if isinstance(collection, SyncedCollection):
+        with collection.write_lock:
+            return export_snapshot(collection.collection, path, tag, page_size, force)
+    if not force:
+        try:
+            snapshot = Snapshot(path)
+        except (OSError, ValueError):
+            snapshot = None
+        if snapshot is not None:
+            try:
+                if (
+                    snapshot.tag == tag
+                    and snapshot.int8 is not None
+                    and snapshot.metadatas()
+                    == collection_metadata(collection, page_size)
+                ):
+                    return None
+            finally:
+                snapshot.close()
+    return write_snapshot(path, collection_pages(collection, page_size), tag)
+
+
+class Snapshot:
+    """
+    A snapshot file (see `write_snapshot`), mapped into memory read-only.
+
+    Opening a snapshot only reads its footer. The embedding matrix is a view of the mapping, so
+    pages are read from disk the first time they are searched, and every process that maps the
+    same file shares them through the page cache. The current snapshot of `path` is opened, and
+    stays mapped when a newer one is written.
+
+    Args:
+        path (str): The snapshot file.
+
+    Raises:
+        ValueError: If the file is not a complete snapshot.
+    """
+
+    def __init__(self, path):
+        path = current_version(path)
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < 16 or self.map[-8:] != magic:
+            raise ValueError(f"{path} is not a snapshot")
+        (length,) = struct.unpack("<Q", self.map[-16:-8])
+        footer = json.loads(self.map[-16 - length : -16])
+        self.count = footer["count"]
+        self.dim = footer["dim"]
+        # Identifies the model the embeddings come from, so a snapshot is not used after a switch
+        self.tag = footer["tag"]
+        # Differs for every snapshot written, to match files derived from it
+        self.version = footer.get("version")
+        sections = footer["sections"]
+        self.vectors = np.frombuffer(
+            self.map, np.float32, self.count * self.dim, 0
+        ).reshape(self.count, self.dim)
+        self.live = np.frombuffer(self.map, np.bool_, self.count, sections["live"])
+        self.id_offsets = np.frombuffer(
+            self.map, np.int64, self.count + 1, sections["id_offsets"]
+        )
+        self.ids_start = sections["ids"]
+        self.metadata_offsets = np.frombuffer(
+            self.map, np.int64, self.count + 1, sections["metadata_offsets"]
+        )
+        self.metadatas_start = sections["metadatas"]
+        # Quantized codes, missing in snapshots written before they were added
+        self.int8 = self.int8_scales = self.binary = None
+        if "int8" in sections:
+            self.int8 = np.frombuffer(
+                self.map, np.int8, self.count * self.dim, sections["int8"]
+            ).reshape(self.count, self.dim)
+            self.int8_scales = np.frombuffer(
+                self.map, np.float32, self.count, sections["int8_scales"]
+            )
+            width = (self.dim + 7) // 8
+            self.binary = np.frombuffer(
+                self.map, np.uint8, self.count * width, sections["binary"]
+            ).reshape(self.count, width)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        """
+        Unmaps the file, so it can be removed once a newer snapshot is written. The snapshot and
+        the arrays taken from it cannot be used afterwards; while such arrays are still
+        referenced, the file stays mapped until they are garbage collected.
+        """
+        self.vectors = self.live = self.id_offsets = self.metadata_offsets = None
+        self.int8 = self.int8_scales = self.binary = None
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+
+    def id(self, row):
+        start = self.ids_start + int(self.id_offsets[row])
+        end = self.ids_start + int(self.id_offsets[row + 1])
+        return self.map[start:end].decode("utf-8")
+
+    def metadata(self, row):
+        start = self.metadatas_start + int(self.metadata_offsets[row])
+        end = self.metadatas_start + int(self.metadata_offsets[row + 1])
+        return json.loads(self.map[start:end])
+
+    def rows(self):
+        """
+        Returns:
+            dict: The row of each ID.
+        """
+        return {self.id(row): row for row in range(self.count)}
+
+    def metadatas(self):
+        """
+        Returns:
+            dict: The metadata of each ID.
+        """
+        return {self.id(row): self.metadata(row) for row in range(self.count)}
+
+
+class SnapshotIndex:
+    """
+    Exact cosine search over a `Snapshot`, with the changes made since kept in a `FlatIndex`.
+
+    The mapped snapshot is never written to. An entry that is upserted or updated moves to the
+    in-memory overlay, and a removed one is hidden, so memory only grows with the changes. A
+    search scores the snapshot rows and the overlay and merges the two. It has the interface of
+    `FlatIndex`, so it can back a `SyncedCollection`.
+
+    With `quantization`, the snapshot rows are first scored with their int8 or binary codes (4
+    and 32 times smaller than the float32 vectors), and only the best `k * rerank_factor`
+    candidates are scored again with their float32 vectors. Every search reads all codes, so they
+    stay in memory, while vectors are only read from disk for candidates and can be evicted.
+    With "ivfpq", candidates come from the `nprobe` nearest lists of an IVF-PQ index of the
+    snapshot (see `search.ivfpq.IVFPQIndex`) instead of from all rows.
+
+    Args:
+        snapshot (Snapshot): The snapshot.
+        quantization (str, optional): "int8", "binary", "ivfpq", or None to score the float32 vectors.
+        rerank_factor (int, optional): The number of candidates reranked per result.
+        ivfpq (IVFPQIndex, optional): The IVF-PQ index of the snapshot, for "ivfpq".
+    """
+
+    def __init__(self, snapshot, quantization=None, rerank_factor=8, ivfpq=None):
+        self.snapshot = snapshot
+        if quantization == "ivfpq" and ivfpq is None:
+            print("The snapshot has no IVF-PQ index, searching float32 vectors")
+            quantization = None
+        elif quantization in ("int8", "binary") and snapshot.int8 is None:
+            print("The snapshot has no quantized codes, searching float32 vectors")
+            quantization = None
+        elif (
+            quantization is not None
+            and snapshot.vectors.nbytes
+            and hasattr(mmap, "MADV_RANDOM")
+        ):
+            # Candidates are scattered, reading ahead of them only evicts codes
+            snapshot.map.madvise(mmap.MADV_RANDOM, 0, snapshot.vectors.nbytes)
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.ivfpq = ivfpq
+        self.lock = threading.Lock()
+        # Tombstoned, removed and moved rows of the snapshot
+        self.hidden = ~snapshot.live
+        self.overlay = FlatIndex()
+        # The row of each ID still in the snapshot, read on first use
+        self.row_of = None
+        self.count = snapshot.count
+
+    def _rows(self):
+        if self.row_of is None:
+            self.row_of = self.snapshot.rows()
+        return self.row_of
+
+    def _take(self, ids):
+        """
+        Takes entries out of the snapshot rows.
+
+        Returns:
+            dict: Whether each taken entry was live, by ID.
+        """
+        rows = self._rows()
+        taken = {}
+        for id in ids:
+            row = rows.pop(id, None)
+            if row is not None:
+                taken[id] = not self.hidden[row]
+                self.hidden[row] = True
+                self.count -= 1
+        return taken
+
+    def __len__(self):
+        return self.count + len(self.overlay)
+
+    def __contains__(self, id):
+        with self.lock:
+            return id in self._rows() or id in self.overlay
+
+    @property
+    def ids(self):
+        with self.lock:
+            return list(self._rows()) + list(self.overlay.ids)
+
+    def memory(self):
+        """
+        Returns:
+            int: The bytes held in process memory; the mapped snapshot is shared page cache.
+        """
+        return self.overlay.memory() + self.hidden.nbytes
+
+    def outdated(self, id, metadata):
+        """
+        Returns:
+            bool: Whether the snapshot row of an entry has a different fingerprint than `metadata`.
+        """
+        with self.lock:
+            row = self._rows().get(id)
+            if row is None:
+                return False
+            stored = self.snapshot.metadata(row)
+        return stored.get("fingerprint") != metadata.get("fingerprint")
+
+    def upsert(self, ids, embeddings, live=None):
+        if not len(ids):
+            return
+        with self.lock:
+            taken = self._take(ids)
+            self.overlay.upsert(ids, embeddings, live)
+            if live is None and taken:
+                self.overlay.set_live(list(taken), list(taken.values()))
+
+    def update(self, ids, embeddings):
+        if not len(ids):
+            return
+        embeddings = normalize(embeddings)
+        with self.lock:
+            taken = self._take(ids)
+            moved = [i for i, id in enumerate(ids) if id in taken]
+            if moved:
+                self.overlay.upsert(
+                    [ids[i] for i in moved],
+                    embeddings[moved],
+                    [taken[ids[i]] for i in moved],
+                )
+            self.overlay.update(ids, embeddings)
+
+    def set_live(self, ids, live):
+        with self.lock:
+            rows = self._rows()
+            for id, is_live in zip(ids, live):
+                row = rows.get(id)
+                if row is not None:
+                    self.hidden[row] = not is_live
+            self.overlay.set_live(ids, live)
+
+    def remove(self, ids):
+        with self.lock:
+            self._take(ids)
+            self.overlay.remove(ids)
+
+    def _search_snapshot(self, query, k, nprobe=None):
+        """
+        Returns:
+            tuple: The `k` best live rows of the snapshot for a normalized query, and their
+            cosine similarities.
+        """
+        snapshot = self.snapshot
+        candidates = k * self.rerank_factor
+        if self.quantization == "ivfpq":
+            rows, _ = self.ivfpq.search(query, candidates, nprobe, self.hidden)
+        else:
+            if self.quantization == "int8":
+                scores = int8_scores(snapshot.int8, snapshot.int8_scales, query)
+            elif self.quantization == "binary":
+                scores = binary_scores(snapshot.binary, query)
+            else:
+                scores = snapshot.vectors @ query
+            scores[self.hidden] = -np.inf
+            rows = top_k(scores, k if self.quantization is None else candidates)
+            if self.quantization is None:
+                return rows, scores[rows]
+        # Reading the candidates in file order keeps the disk reads sequential
+        rows = np.sort(rows)
+        scores = snapshot.vectors[rows] @ query
+        best = top_k(scores, k)
+        return rows[best], scores[best]
+
+    def search(self, query, k, nprobe=None):
+        """
+        Args:
+            query (list): The query embedding.
+            k (int): The number of results.
+            nprobe (int, optional): The number of IVF-PQ lists to search, with "ivfpq".
+
+        Returns:
+            tuple: Two lists: the IDs of the `k` live entries most similar to `query`, most
+            similar first, and their cosine similarities.
+        """
+        query = normalize(query)[0]
+        with self.lock:
+            results = []
+            if self.snapshot.count:
+                rows, scores = self._search_snapshot(query, k, nprobe)
+                results = [
+                    (float(score), self.snapshot.id(row))
+                    for row, score in zip(rows, scores)
+                ]
+            ids, similarities = self.overlay.search(query, k)
+        results += zip(similarities, ids)
+        results.sort(key=lambda result: -result[0])
+        return [id for _, id in results[:k]], [score for score, _ in results[:k]]
+
+
+def open_snapshot(path, tag=None, quantization=None, rerank_factor=8, nprobe=16):
+    """
+    Returns:
+        SnapshotIndex: An index over the snapshot at `path` (see `SnapshotIndex` for the other
+        arguments), or None if there is no usable snapshot (missing, incomplete, or made with
+        another model than `tag`).
+    """
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError):
+        return None
+    if snapshot.tag != tag:
+        print(f"{path} was made with another model, ignoring it")
+        return None
+    ivfpq = None
+    if quantization == "ivfpq":
+        try:
+            ivfpq = IVFPQIndex.load(index_path(path), nprobe)
+        except (OSError, ValueError, KeyError):
+            pass
+        if ivfpq is not None and ivfpq.version != snapshot.version:
+            print(f"{index_path(path)} was built from another snapshot, ignoring it")
+            ivfpq = None
+    return SnapshotIndex(snapshot, quantization, rerank_factor, ivfpq)
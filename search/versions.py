@@ -0,0 +1,61 @@
+import os
+import re
+import shutil
+
+
+def new_version(path):
+    """
+    Returns:
+        str: A new, unused name next to `path` for the next version of it (see `publish`).
+    """
+    return f"{path}.{os.urandom(8).hex()}"
+
+
+def current_version(path):
+    """
+    Returns:
+        str: The file or directory holding the current version of `path` (see `publish`), or
+        `path` itself if no version was published (files written before versions were used).
+    """
+    try:
+        with open(path + ".current", "r") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return path
+    return os.path.join(os.path.dirname(path), name)
+
+
+def publish(path, version):
+    """
+    Makes `version`, a complete new version of `path` written with `new_version`, the current
+    one, and removes the older versions.
+
+    Memory-mapped files are never renamed or replaced, which Windows does not allow: readers
+    keep the version they opened, and only the small `.current` file that names the current
+    version is replaced, so readers that open `path` afterwards switch over atomically. Old
+    versions that cannot be removed yet (on Windows, while a process still maps them) are
+    removed by a later `publish`.
+
+    Args:
+        path (str): The path readers open (see `current_version`).
+        version (str): The new version.
+    """
+    temporary = path + ".current.tmp"
+    with open(temporary, "w") as f:
+        f.write(os.path.basename(version))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path + ".current")
+    directory = os.path.dirname(path) or "."
+    pattern = re.escape(os.path.basename(path)) + r"(\.[0-9a-f]{16})?"
+    for name in os.listdir(directory):
+        old = os.path.join(directory, name)
+        if name == os.path.basename(version) or not re.fullmatch(pattern, name):
+            continue
+        if os.path.isdir(old):
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
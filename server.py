@@ -1,17 +1,58 @@
 from flask import Flask, abort, request, jsonify, send_from_directory
 from flask_cors import CORS
 from Index.create_db import (
+    config,
     create_vectordb,
     get_clip_image,
     get_clip_text,
-    get_text_embeddings,
+    get_text_embeddings_batch,
+    ocr_backlog_file,
+    ocr_threshold,
+    snapshot_files,
+    snapshot_tag,
 )
-
+from Index.manifest import Manifest
+from Index.ocr_backlog import OCRBacklog
+from Index.progress import ocr_progress, progress
+from Index.scan import manifest_file
+from search.flat import SyncedCollection
+from search.snapshot import open_snapshot
+
+import argparse
 import os
 import requests
 from io import BytesIO
 
-image_collection, text_collection = create_vectordb("db")
+# Exact in-memory search below `flat_max_vectors` entries, HNSW above
+search_config = config.get("search", {})
+flat_max_vectors = (
+    search_config.get("flat_max_vectors", 200000)
+    if search_config.get("flat", True)
+    else 0
+)
+
+# Wrapped even without flat search, so background indexing can swap in rebuilt collections
+# (see `Index.create_db.rebuild_hnsw`)
+image_collection, text_collection = (
+    SyncedCollection(collection, flat_max_vectors)
+    for collection in create_vectordb("db")
+)
+if search_config.get("flat", True):
+    # Start from the snapshots exported by the indexer, which are mapped instead of loaded
+    for collection in (image_collection, text_collection):
+        collection.load(
+            open_snapshot(
+                snapshot_files[collection.name],
+                snapshot_tag(collection.name),
+                search_config.get("quantization"),
+                search_config.get("rerank_factor", 8),
+                search_config.get("ivfpq", {}).get("nprobe", 16),
+            )
+            if search_config.get("snapshot", True)
+            else None
+        )
+manifest = Manifest(manifest_file)
+ocr_backlog = OCRBacklog(ocr_backlog_file)
 
 
 def parse_image(image_path, top_k=5, threshold=0):
@@ -37,28 +78,70 @@ def parse_image(image_path, top_k=5, threshold=0):
         return image_path
 
 
-def search_clip_text(text, image_collection, top_k=5, threshold=0):
+def query_live(collection, embedding, top_k=5, nprobe=None):
+    """
+    Query a collection for the nearest neighbors of an embedding, skipping tombstoned entries.
+
+    Tombstoned entries belong to files that vanished but are still within their grace period
+    (see `clean_index`). A collection mirrored in memory (see `search.flat.SyncedCollection`) is
+    searched exactly there. Otherwise the HNSW index of the collection is queried; if some of
+    the first `top_k` results are tombstoned, the query is repeated with more results until
+    `top_k` live entries are found or the collection is exhausted.
+
+    Args:
+        embedding (list): The query embedding.
+        collection: The collection to query.
+        top_k (int, optional): The number of results. Defaults to 5.
+        nprobe (int, optional): The number of IVF-PQ lists to search (see `search.ivfpq`), trading
+            speed for recall. Defaults to `nprobe` of the `ivfpq` section of `config.yaml`.
+
+    Returns:
+        tuple: Two lists: the IDs of the results and their cosine distances.
+    """
+    flat = getattr(collection, "flat", None)
+    if flat is not None:
+        ids, similarities = flat.search(embedding, top_k, nprobe)
+        return ids, [1 - similarity for similarity in similarities]
+    n_results = top_k
+    while True:
+        results = collection.query(
+            embedding, n_results=n_results, include=["metadatas", "distances"]
+        )
+        ids, distances = [], []
+        for id, metadata, distance in zip(
+            results["ids"][0], results["metadatas"][0], results["distances"][0]
+        ):
+            if not (metadata or {}).get("deleted_at"):
+                ids.append(id)
+                distances.append(distance)
+        if len(ids) >= top_k or len(results["ids"][0]) < n_results:
+            return ids[:top_k], distances[:top_k]
+        n_results *= 2
+
+
+def search_clip_text(text, image_collection, top_k=5, threshold=0, nprobe=None):
     """
     Search for images that are semantically similar to the input text.
 
     Args:
         text (str): The input text to search for.
         image_collection: The collection of images to search in.
+        nprobe (int, optional): The number of IVF-PQ lists to search (see `query_live`).
 
     Returns:
         tuple: A tuple containing the paths of the top 5 images and their distances from the input text.
     """
     text_embedding = get_clip_text(text)
-    results = image_collection.query(text_embedding, n_results=top_k)
-    similarities = [1 - d for d in results["distances"][0]]
-    paths, similarities = [
-        p for p, d in zip(results["ids"][0], similarities) if d > threshold
-    ], [d for d in similarities if d > threshold]
+    ids, distances = query_live(image_collection, text_embedding, top_k, nprobe)
+    similarities = [1 - d for d in distances]
+    paths, similarities = [p for p, d in zip(ids, similarities) if d > threshold], [
+        d for d in similarities if d > threshold
+    ]
     return paths, similarities
 
 
 def search_clip_image(
-    image_path, image_collection, top_k=5, threshold=0, get_self=False
+    image_path, image_collection, top_k=5, threshold=0, get_self=False, nprobe=None
 ):
     """
     Search for images that are visually similar to the input image within a given image collection.
@@ -67,15 +150,16 @@ def search_clip_image(
         image_path (str): The path to the input image to search for. This path is stripped of any leading or trailing quotes and adjusted for posix systems.
         image_collection (FaissCollection): The collection of images to search in. This is an object that supports querying for nearest neighbors.
         get_self (bool, optional): If set to True, the function will return the input image as one of the results.
+        nprobe (int, optional): The number of IVF-PQ lists to search (see `query_live`).
     Returns:
         tuple: A tuple containing two lists. The first list contains the paths of the top 5 images (or top 6 if get_self is True). The second list contains the corresponding distances of these images from the input image.
     """
     image_embedding = get_clip_image([image_path])
-    results = image_collection.query(image_embedding, n_results=top_k)
-    similarities = [1 - d for d in results["distances"][0]]
-    paths, similarities = [
-        p for p, d in zip(results["ids"][0], similarities) if d > threshold
-    ], [d for d in similarities if d > threshold]
+    ids, distances = query_live(image_collection, image_embedding, top_k, nprobe)
+    similarities = [1 - d for d in distances]
+    paths, similarities = [p for p, d in zip(ids, similarities) if d > threshold], [
+        d for d in similarities if d > threshold
+    ]
     if not get_self:
         for i in range(len(paths)):
             if paths[i] == image_path:
@@ -85,23 +169,24 @@ def search_clip_image(
     return paths, similarities
 
 
-def search_embed_text(text, text_collection, top_k=5, threshold=0):
+def search_embed_text(text, text_collection, top_k=5, threshold=0, nprobe=None):
     """
     Search for texts that are semantically similar to the input text.
 
     Args:
         text (str): The input text to search for.
         text_collection: The collection of texts to search in.
+        nprobe (int, optional): The number of IVF-PQ lists to search (see `query_live`).
 
     Returns:
         tuple: A tuple containing the paths of the top 5 texts and their distances from the input text.
     """
-    text_embedding = get_text_embeddings(text)
-    results = text_collection.query(text_embedding, n_results=top_k)
-    similarities = [1 - d for d in results["distances"][0]]
-    paths, similarities = [
-        p for p, d in zip(results["ids"][0], similarities) if d > threshold
-    ], [d for d in similarities if d > threshold]
+    text_embedding = get_text_embeddings_batch([text])[0]
+    ids, distances = query_live(text_collection, text_embedding, top_k, nprobe)
+    similarities = [1 - d for d in distances]
+    paths, similarities = [p for p, d in zip(ids, similarities) if d > threshold], [
+        d for d in similarities if d > threshold
+    ]
     return paths, similarities
 
 
@@ -119,6 +204,7 @@ def clip_text_route():
         - query (str): The text query to search for.
         - threshold (float): The minimum similarity threshold. Defaults to 0.
         - top_k (int): The number of top results to return. Defaults to 5.
+        - nprobe (int, optional): The number of IVF-PQ lists to search (see `query_live`).
 
     Calls `search_clip_text` with these parameters to retrieve a list of image
     paths (and their associated distances). Returns the list of image paths as JSON.
@@ -130,7 +216,10 @@ def clip_text_route():
     threshold = float(request.json.get("threshold", 0))
     top_k = int(request.json.get("top_k", 5))
     print(f"threshold: {threshold} top_k: {top_k}")
-    paths, distances = search_clip_text(query, image_collection, top_k, threshold)
+    nprobe = request.json.get("nprobe")
+    paths, distances = search_clip_text(
+        query, image_collection, top_k, threshold, int(nprobe) if nprobe else None
+    )
     print(len(paths))
     return jsonify(paths)
 
@@ -144,6 +233,7 @@ def clip_image_route():
         - query (str): Base64-encoded or URL reference to the image.
         - threshold (float): The minimum similarity threshold. Defaults to 0.
         - top_k (int): The number of top results to return. Defaults to 5.
+        - nprobe (int, optional): The number of IVF-PQ lists to search (see `query_live`).
 
     Calls `parse_image` to transform the input into a usable format, then uses
     `search_clip_image` to find matching images in the collection. Returns the
@@ -156,7 +246,14 @@ def clip_image_route():
     threshold = float(request.json.get("threshold", 0))
     top_k = int(request.json.get("top_k", 5))
     query = parse_image(query)
-    paths, distances = search_clip_image(query, image_collection, top_k, threshold)
+    nprobe = request.json.get("nprobe")
+    paths, distances = search_clip_image(
+        query,
+        image_collection,
+        top_k,
+        threshold,
+        nprobe=int(nprobe) if nprobe else None,
+    )
     return jsonify(paths)
 
 
@@ -169,6 +266,7 @@ def ebmed_text_route():
         - query (str): The text to be embedded and searched.
         - threshold (float): The minimum similarity threshold. Defaults to 0.
         - top_k (int): The number of top results to return. Defaults to 5.
+        - nprobe (int, optional): The number of IVF-PQ lists to search (see `query_live`).
 
     Calls `search_embed_text` to find matching text entries in the collection.
     Returns the list of matching document paths (or identifiers) as JSON.
@@ -179,10 +277,61 @@ def ebmed_text_route():
     query = request.json.get("query", "")
     threshold = float(request.json.get("threshold", 0))
     top_k = int(request.json.get("top_k", 5))
-    paths, distances = search_embed_text(query, text_collection, top_k, threshold)
+    nprobe = request.json.get("nprobe")
+    paths, distances = search_embed_text(
+        query, text_collection, top_k, threshold, int(nprobe) if nprobe else None
+    )
     return jsonify(paths)
 
 
+@app.route("/index_status", methods=["GET"])
+def index_status_route():
+    """
+    Handle a GET request for the progress of background indexing.
+
+    Returns the current phase ("scanning", "planning", "indexing", "cleaning", "exporting", "rebuilding", "watching",
+    "idle" or "failed"), the items done and total of the phase, its elapsed time, rate and estimated time
+    left (seconds), the error of a failed run, the number of scanned files in each index state
+    (see `Index.manifest.Manifest`) and the number of images currently searchable. The progress
+    of the OCR phase is reported under "ocr", with the number of backlog items in each state
+    ("skipped" for those the prescreen skips) and whether it is paused.
+
+    Returns:
+        flask.Response: A JSON response with the indexing progress.
+    """
+    status = progress.snapshot()
+    status["files"] = manifest.counts()
+    status["indexed_images"] = image_collection.count()
+    status["ocr"] = ocr_progress.snapshot()
+    status["ocr"]["backlog"] = ocr_backlog.counts(ocr_threshold)
+    status["ocr"]["paused"] = ocr_backlog.paused()
+    return jsonify(status)
+
+
+@app.route("/ocr/pause", methods=["POST"])
+def pause_ocr_route():
+    """
+    Handle a POST request to pause the OCR phase after its current batch.
+
+    Returns:
+        flask.Response: A JSON response with the new paused state.
+    """
+    ocr_backlog.set_paused(True)
+    return jsonify({"paused": True})
+
+
+@app.route("/ocr/resume", methods=["POST"])
+def resume_ocr_route():
+    """
+    Handle a POST request to resume a paused OCR phase.
+
+    Returns:
+        flask.Response: A JSON response with the new paused state.
+    """
+    ocr_backlog.set_paused(False)
+    return jsonify({"paused": False})
+
+
 @app.route("/")
 def serve_index():
     """
@@ -210,5 +359,22 @@ def serve_image(filename):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="only serve the existing index, without indexing in the background",
+    )
+    parser.add_argument(
+        "--full-scan",
+        action="store_true",
+        help="list every directory again instead of only the ones that changed",
+    )
+    args = parser.parse_args()
+    # Search is served right away, on the existing index, while indexing runs in the background
+    if not args.no_index and config.get("background_indexing", {}).get("enabled", True):
+        from Index.background import start_background_indexing
+
+        start_background_indexing(image_collection, text_collection, args.full_scan)
     port = int(os.getenv("PORT", 23107))
     app.run(host="0.0.0.0", port=port)
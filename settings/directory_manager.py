@@ -27,7 +27,7 @@ class DirectoryManager:
         deep_scan_label.pack(side=tk.LEFT, padx=5, pady=5)
         CreateToolTip(
             deep_scan_label,
-            text="Deepscan ensures if a file content has changed but the file name is the same, it will still be reindexed.\n(It may affect performance for large directories)",
+            text="Deepscan ensures if a file content has changed but the file name is the same, it will still be reindexed.\n(Changes are detected from file size and modification time, or from a content hash if content_hash is set in config.yaml)",
         )
         tk.Checkbutton(deep_scan_frame, variable=self.deep_scan_var).pack(
             side=tk.LEFT, padx=5, pady=5
@@ -37,7 +37,7 @@ class DirectoryManager:
         batch_size_label.pack(side=tk.LEFT, padx=5, pady=5)
         CreateToolTip(
             batch_size_label,
-            text="Batch size for both file IO, CLIP inference and OCR inference.",
+            text="Batch size for file IO, CLIP inference and OCR inference. CLIP and OCR use smaller batches when they run out of memory, or tuned ones with autotune in config.yaml.",
         )
         tk.Entry(deep_scan_frame, textvariable=self.batch_size_var).pack(
             side=tk.LEFT, padx=5, pady=5
@@ -51,3 +51,28 @@ def get_text_embeddings(text, norm=False):
     if norm:
         embeddings = F.normalize(embeddings, p=2, dim=1)
     return embeddings.cpu().squeeze(0).numpy().tolist()
+
+
+def get_text_embeddings_batch(texts, norm=False):
+    """
+    Gets the text embeddings for a batch of texts in a single forward pass.
+
+    The texts are tokenized together and padded to the longest one; padding tokens are
+    excluded by the attention mask in `mean_pooling`.
+
+    Args:
+        texts (list of str): The texts to get embeddings for.
+
+    Returns:
+        list: The text embeddings as a list of lists, in the order of `texts`.
+    """
+    encoded_input = tokenizer(
+        texts, padding=True, truncation=True, return_tensors="pt"
+    ).to(device)
+    with torch.no_grad():
+        model_output = model(**encoded_input)
+
+    embeddings = mean_pooling(model_output, encoded_input["attention_mask"])
+    if norm:
+        embeddings = F.normalize(embeddings, p=2, dim=1)
+    return embeddings.cpu().numpy().tolist()
@@ -27,3 +27,16 @@ def get_text_embeddings(text):
         list: The text embeddings as a list.
     """
     return llm.create_embedding(text)["data"][0]["embedding"]
+
+
+def get_text_embeddings_batch(texts):
+    """
+    Gets the text embeddings for a batch of texts in a single call.
+
+    Args:
+        texts (list of str): The texts to get embeddings for.
+
+    Returns:
+        list: The text embeddings as a list of lists, in the order of `texts`.
+    """
+    return [data["embedding"] for data in llm.create_embedding(texts)["data"]]
@@ -11,3 +11,11 @@ def get_text_embeddings(text):
     )
     outputs = model(inputs["input_ids"], attention_mask=inputs["attention_mask"])
     return outputs.text_embeds.tolist()[0]
+
+
+def get_text_embeddings_batch(texts):
+    inputs = tokenizer.batch_encode_plus(
+        texts, return_tensors="mlx", padding=True, truncation=True, max_length=512
+    )
+    outputs = model(inputs["input_ids"], attention_mask=inputs["attention_mask"])
+    return outputs.text_embeds.tolist()
@@ -27,3 +27,26 @@ def get_text_embeddings(text):
             "Failed to connect to Ollama. Please make sure Ollama is running."
         )
     return response.json()["embedding"]
+
+
+def get_text_embeddings_batch(texts):
+    """
+    Sends a single POST request to the local Ollama API to get embeddings for a batch of texts.
+
+    Uses the `/api/embed` endpoint, which accepts a list of inputs.
+
+    Parameters:
+    texts (list of str): The texts for which to get embeddings.
+
+    Returns:
+    list: The embeddings for the given texts as a list of lists of floats, in the order of `texts`.
+    """
+    try:
+        url = "http://localhost:11434/api/embed"
+        data = {"model": model, "input": texts}
+        response = requests.post(url, data=json.dumps(data))
+    except:
+        raise Exception(
+            "Failed to connect to Ollama. Please make sure Ollama is running."
+        )
+    return response.json()["embeddings"]
@@ -27,3 +27,20 @@ def get_text_embeddings(text):
         input=text,
     )
     return response.data[0].embedding
+
+
+def get_text_embeddings_batch(texts):
+    """
+    Sends a single request to the OpenAI API to get embeddings for a batch of texts.
+
+    Parameters:
+    texts (list of str): The texts for which to get embeddings.
+
+    Returns:
+    list: The embeddings for the given texts as a list of lists of floats, in the order of `texts`.
+    """
+    response = client.embeddings.create(
+        model=openai_model,
+        input=texts,
+    )
+    return [data.embedding for data in sorted(response.data, key=lambda d: d.index)]